@@ -0,0 +1,67 @@
+""" CPU micro-benchmark of the CrossAttention backends
+
+Shapes follow `configs/model/unet_grasp_bps.yaml`: one grasp token of 512 channels, 8 heads
+of 64 channels, attending to the 8 obj_bps tokens or the 16 PointNet2 scene tokens of 512
+channels. The self-attention of longer sequences is measured as well.
+
+    python benchmarks/bench_attention.py --batch_size 20 2000
+"""
+import os
+import sys
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from models.model.utils import CrossAttention
+from benchmarks.common import timeit
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='CrossAttention backend benchmark')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[20, 200, 2000])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=None)
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    ## name: (query tokens, context tokens, context dim or None for self-attention)
+    shapes = {
+        'obj_bps cross-attn': (1, 8, 512),
+        'PointNet2 cross-attn': (1, 16, 512),
+        'self-attn L=16': (16, None, None),
+        'self-attn L=64': (64, None, None),
+    }
+    attn = {backend: CrossAttention(512, context_dim=512, heads=8, dim_head=64, backend=backend).to(args.device).eval()
+            for backend in ['einsum', 'sdpa']}
+    attn['sdpa'].load_state_dict(attn['einsum'].state_dict())
+
+    for name, (L, N, C) in shapes.items():
+        for B in args.batch_size:
+            x = torch.randn(B, L, 512, device=args.device)
+            context, mask = None, None
+            if N is not None:
+                context = torch.randn(B, N, C, device=args.device)
+                mask = torch.rand(B, N, device=args.device) > 0.2
+                mask[:, 0] = True # attend at least one token
+
+            ref = attn['einsum'](x, context=context, mask=mask)
+            err = (attn['sdpa'](x, context=context, mask=mask) - ref).abs().max().item()
+            times = {backend: timeit(lambda: m(x, context=context, mask=mask), args.device, repeats=args.repeats)
+                     for backend, m in attn.items()}
+            logger.info(f'{name:>22s} | B: {B:5d} | einsum: {1000 * times["einsum"]:8.3f} ms | '
+                        f'sdpa: {1000 * times["sdpa"]:8.3f} ms | speedup: {times["einsum"] / times["sdpa"]:5.2f}x | '
+                        f'max abs error: {err:.2e}')
+
+
+if __name__ == '__main__':
+    main()
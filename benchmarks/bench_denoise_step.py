@@ -0,0 +1,65 @@
+""" CPU latency of one denoising step of the UNet, eager against compiled
+
+The eager UNet (einops rearranges, condition cache and time embedding table) is compared against
+the `DenoiseStep` module of `models/model/denoise_step.py`, run eagerly, as TorchScript and, with
+torch>=2.0, through torch.compile. The UNet is randomly initialized.
+
+    python benchmarks/bench_denoise_step.py --batch_size 1 20 200 --threads 1
+"""
+import os
+import sys
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from models import create_unet
+from models.model.denoise_step import compile_denoise_step
+from benchmarks.common import compose_cfg, timeit
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Denoising step benchmark of the UNet')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 20, 200])
+    parser.add_argument('--backends', type=str, nargs='+', default=['eager', 'script', 'inductor'])
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = compose_cfg('bps', args.overrides)
+    unet = create_unet(cfg).eval()
+    t = cfg.diffuser.steps // 2
+    ts = torch.arange(cfg.diffuser.steps)
+
+    steps = {}
+    for backend in args.backends:
+        if backend == 'inductor' and not hasattr(torch, 'compile'):
+            logger.info('skip inductor, torch.compile requires torch>=2.0')
+            continue
+        steps[backend] = compile_denoise_step(unet, backend)
+
+    for B in args.batch_size:
+        x_t = torch.randn(B, cfg.model.d_x)
+        cond = torch.randn(B, 8, cfg.model.context_dim)
+        cond_cache = unet.condition_cache(cond)
+
+        ref_time = timeit(lambda: unet(x_t, t, cond, cond_cache), 'cpu', repeats=args.repeats)
+        msg = f'B: {B:5d} | unet: {1000 * ref_time:8.3f} ms/step'
+        for backend, step in steps.items():
+            ## timeit warms up first, which also triggers the compilation of torch.compile
+            step_time = timeit(lambda: step(x_t, ts[t:t + 1], cond_cache), 'cpu', repeats=args.repeats)
+            msg += f' | {backend}: {1000 * step_time:8.3f} ms/step ({ref_time / step_time:4.2f}x)'
+        logger.info(msg)
+
+
+if __name__ == '__main__':
+    main()
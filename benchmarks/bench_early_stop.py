@@ -0,0 +1,67 @@
+""" Network evaluations against grasp quality of early-stop sampling
+
+Every configuration samples the same conditions from the same seed. With early stop, a grasp is
+frozen at its predicted x0 once it changes by less than the tolerance over `early_stop_patience`
+consecutive steps, and the remaining steps run on the unfinished grasps only. Grasps are scored
+by DexEvaluator.
+
+    python benchmarks/bench_early_stop.py --tols 1e-2 3e-3 1e-3 --solver ddim --steps 50
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from benchmarks.common import compose_cfg, load_sampler, load_evaluator, load_conditions, synchronize
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Early-stop sampling benchmark of DexSampler')
+    parser.add_argument('--model', type=str, default='bps', help='sampler scene model, bps or pn2')
+    parser.add_argument('--tols', type=float, nargs='+', default=[1e-2, 3e-3, 1e-3])
+    parser.add_argument('--solver', type=str, default=None)
+    parser.add_argument('--steps', type=int, default=None)
+    parser.add_argument('--num_objects', type=int, default=20)
+    parser.add_argument('--num_sample', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = compose_cfg(args.model, args.overrides)
+    model = load_sampler(cfg, args.device)
+    evaluator = load_evaluator(cfg, args.device)
+    conditions = load_conditions(cfg, args.num_objects, args.num_sample, args.device)
+
+    base = None
+    for tol in [None] + args.tols:
+        torch.manual_seed(args.seed)
+        p_success, nfe = [], []
+        synchronize(args.device)
+        start = time.perf_counter()
+        for data in conditions:
+            data = {key: value for key, value in data.items() if key not in ['cond', 'cond_cache', 'obj_bps_feat', 'nfe']}
+            outputs = model.sample(data, k=1, solver=args.solver, steps=args.steps, early_stop_tol=tol)[:, 0, -1, :]
+            p_success.append(evaluator({'x_t': outputs, 'obj_bps': data['obj_bps']})['p_success'])
+            nfe.append(data['nfe'].flatten())
+        synchronize(args.device)
+        elapsed = time.perf_counter() - start
+        base = elapsed if base is None else base
+
+        p_success, nfe = torch.cat(p_success), torch.cat(nfe).float()
+        name = 'all steps' if tol is None else f'early stop {tol:g}'
+        logger.info(f'{name:>20s} | nfe/grasp: {nfe.mean().item():6.2f} | p_success: {p_success.mean().item():.4f} | '
+                    f'success rate: {(p_success > 0.5).float().mean().item():.4f} | '
+                    f'{1000 * elapsed / p_success.shape[0]:.3f} ms/grasp | cost: {elapsed / base:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
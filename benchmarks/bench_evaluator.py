@@ -0,0 +1,92 @@
+""" Latency of scoring N grasps per object with the evaluator, with and without the eval-time split
+of the BPS columns of its first layers, of its positional encoding, and the scoring throughput of
+the evaluator fused by `fuse_for_inference`
+
+With the split, the 4096-wide BPS products are computed once per object and only the narrow grasp
+columns are multiplied per grasp. The positional encoding of the grasps is timed against the
+one-term-per-frequency NeRF encoding. The throughput is measured on --throughput grasps scored in
+chunks of --chunk. The evaluator is randomly initialized unless --ckpt is given.
+
+    python benchmarks/bench_evaluator.py --num_grasps 20 200 2000 --num_objects 1 10 --device cpu
+"""
+import os
+import sys
+import copy
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from benchmarks.common import compose_cfg, load_evaluator, timeit
+from benchmarks.check_parity import reference_embed
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Evaluator scoring benchmark')
+    parser.add_argument('--num_grasps', type=int, nargs='+', default=[20, 200, 2000], help='grasps per object')
+    parser.add_argument('--num_objects', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--ckpt', action='store_true', help='load the evaluator ckpt of configs/sample.yaml')
+    parser.add_argument('--throughput', type=int, default=100000, help='grasps of the throughput test')
+    parser.add_argument('--chunk', type=int, default=10000, help='grasps per evaluator call of the throughput test')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = compose_cfg('bps', args.overrides)
+    evaluator = load_evaluator(cfg, args.device, ckpt=args.ckpt)
+
+    for n_obj in args.num_objects:
+        for n in args.num_grasps:
+            ## object-major batch, the grasps of an object share its BPS
+            obj_bps = torch.rand(n_obj, 4096, device=args.device).repeat_interleave(n, dim=0)
+            data = {'x_t': torch.randn(n_obj * n, cfg.model.d_x, device=args.device), 'obj_bps': obj_bps}
+
+            evaluator.split_bps = False
+            ref = evaluator(data)['p_success']
+            full_time = timeit(lambda: evaluator(data), args.device, repeats=args.repeats)
+            evaluator.split_bps = True
+            err = (evaluator(data)['p_success'] - ref).abs().max().item()
+            split_time = timeit(lambda: evaluator(data), args.device, repeats=args.repeats)
+
+            logger.info(f'objects: {n_obj:3d} | grasps/object: {n:5d} | full: {1000 * full_time:8.3f} ms | '
+                        f'split: {1000 * split_time:8.3f} ms ({full_time / split_time:4.2f}x) | max abs error {err:.3e}')
+
+    ## positional encoding of the translation, rotation and joints, as in `DexEvaluator.forward`
+    for n in args.num_grasps:
+        x_t = torch.randn(n, cfg.model.d_x, device=args.device)
+        inputs = [x_t[:, :3], x_t[:, 3:9], x_t[:, 9:]]
+        ref_time = timeit(lambda: [reference_embed(x, m) if m != -1 else x for x, m in zip(inputs, evaluator.pos_enc_multires)],
+                          args.device, repeats=args.repeats)
+        embed_time = timeit(lambda: [fn(x) for x, fn in zip(inputs, evaluator.embed_fn)], args.device, repeats=args.repeats)
+        logger.info(f'grasps: {n:5d} | embedding per term: {1000 * ref_time:8.3f} ms | '
+                    f'vectorized: {1000 * embed_time:8.3f} ms ({ref_time / embed_time:4.2f}x)')
+
+    ## throughput of scoring many grasps of a few objects, with batch norms and dropout folded away
+    fused = copy.deepcopy(evaluator).fuse_for_inference()
+    n_obj = args.num_objects[-1]
+    chunks = []
+    for n in range(0, args.throughput, args.chunk):
+        n = min(args.chunk, args.throughput - n)
+        obj_bps = torch.rand(n_obj, 4096, device=args.device)[torch.arange(n, device=args.device) * n_obj // n]
+        chunks.append({'x_t': torch.randn(n, cfg.model.d_x, device=args.device), 'obj_bps': obj_bps})
+    err = max((fused(data)['p_success'] - evaluator(data)['p_success']).abs().max().item() for data in chunks)
+    elapsed = {}
+    for name, model in [('evaluator', evaluator), ('fused', fused)]:
+        elapsed[name] = timeit(lambda: [model(data) for data in chunks], args.device, warmup=1, repeats=max(1, args.repeats // 10))
+        logger.info(f'{name:>9s} | {args.throughput} grasps of {n_obj} objects: {elapsed[name]:8.3f} s | '
+                    f'{args.throughput / elapsed[name]:10.0f} grasps/s')
+    logger.info(f'fused throughput gain {elapsed["evaluator"] / elapsed["fused"]:4.2f}x | max abs error {err:.3e}')
+
+
+if __name__ == '__main__':
+    main()
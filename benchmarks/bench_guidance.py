@@ -0,0 +1,78 @@
+""" Cost against grasp quality of evaluator-guided sampling (EGD)
+
+Every configuration samples the same conditions from the same seed. The guidance is
+applied on all timesteps, on the last N timesteps only, or every few timesteps, with
+and without reusing the BPS features of the evaluator across the sampling steps.
+Grasps are scored by the same DexEvaluator that guides the sampling.
+
+    python benchmarks/bench_guidance.py --guid_scale 1 --last_steps 50 20 10
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from benchmarks.common import compose_cfg, load_sampler, load_evaluator, load_conditions, synchronize
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Evaluator-guided sampling benchmark of DexSampler')
+    parser.add_argument('--model', type=str, default='bps', help='sampler scene model, bps or pn2')
+    parser.add_argument('--guid_scale', type=float, default=1.0)
+    parser.add_argument('--last_steps', type=int, nargs='+', default=[50, 20, 10])
+    parser.add_argument('--strides', type=int, nargs='+', default=[2, 5], help='guide every stride-th timestep')
+    parser.add_argument('--solver', type=str, default=None)
+    parser.add_argument('--steps', type=int, default=None)
+    parser.add_argument('--num_objects', type=int, default=20)
+    parser.add_argument('--num_sample', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = compose_cfg(args.model, args.overrides)
+    model = load_sampler(cfg, args.device)
+    evaluator = load_evaluator(cfg, args.device)
+    conditions = load_conditions(cfg, args.num_objects, args.num_sample, args.device)
+
+    ## name: guidance parameters, None samples without guidance
+    configs = {'no guidance': None}
+    for reuse_bps in [False, True]:
+        suffix = ' + bps reuse' if reuse_bps else ''
+        guid = {'evaluator': evaluator, 'guid_scale': args.guid_scale, 'reuse_bps': reuse_bps}
+        configs['all steps' + suffix] = guid
+        for n in args.last_steps:
+            configs[f'last {n} steps' + suffix] = {**guid, 'guid_last_steps': n}
+        for stride in args.strides:
+            configs[f'every {stride} steps' + suffix] = {**guid, 'guid_timesteps': list(range(0, model.timesteps, stride))}
+
+    base = None
+    for name, guid_param in configs.items():
+        torch.manual_seed(args.seed)
+        p_success = []
+        synchronize(args.device)
+        start = time.perf_counter()
+        for data in conditions:
+            data = {key: value for key, value in data.items() if key not in ['cond', 'cond_cache', 'obj_bps_feat']}
+            outputs = model.sample(data, k=1, guid_param=guid_param, solver=args.solver, steps=args.steps)[:, 0, -1, :]
+            p_success.append(evaluator({'x_t': outputs, 'obj_bps': data['obj_bps']})['p_success'])
+        synchronize(args.device)
+        elapsed = time.perf_counter() - start
+        base = elapsed if base is None else base
+
+        p_success = torch.cat(p_success)
+        logger.info(f'{name:>28s} | p_success: {p_success.mean().item():.4f} | '
+                    f'success rate: {(p_success > 0.5).float().mean().item():.4f} | '
+                    f'{1000 * elapsed / p_success.shape[0]:.3f} ms/grasp | cost: {elapsed / base:5.2f}x unguided')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+""" Parity and CPU latency of the ONNX Runtime backend against the PyTorch models
+
+The sampler and the evaluator are exported to a temporary directory, then the predicted noise of
+one denoising step and the evaluator scores are compared, and the latencies of a ddim sampling
+loop and of the evaluator are measured.
+Without --ckpt the models are randomly initialized.
+
+    python benchmarks/bench_onnx.py --batch_size 1 20 200 --threads 1
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+sys.path.append(os.getcwd())
+
+import numpy as np
+import torch
+from loguru import logger
+
+from utils.onnx_export import export_sampler, export_evaluator
+from utils.ort_backend import OrtSampler, OrtEvaluator
+from benchmarks.common import compose_cfg, load_sampler, load_evaluator, timeit
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='ONNX Runtime backend benchmark')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 20, 200])
+    parser.add_argument('--steps', type=int, default=10, help='ddim steps of the timed sampling loop')
+    parser.add_argument('--ckpt', action='store_true', help='load the ckpts of configs/sample.yaml')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = compose_cfg('bps', args.overrides)
+    model = load_sampler(cfg, 'cpu', ckpt=args.ckpt)
+    evaluator = load_evaluator(cfg, 'cpu', ckpt=args.ckpt)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        export_sampler(model, model_dir, 'bps')
+        export_evaluator(evaluator, model_dir, d_x=cfg.model.d_x)
+        ort_sampler = OrtSampler(model_dir, 'bps', threads=args.threads)
+        ort_evaluator = OrtEvaluator(model_dir, threads=args.threads)
+
+        t = cfg.diffuser.steps // 2
+        for B in args.batch_size:
+            obj_bps = torch.rand(B, 4096)
+            x_t = torch.randn(B, cfg.model.d_x)
+            cond = model.eps_model.condition({'obj_bps': obj_bps})
+            cond_cache = model.eps_model.condition_cache(cond)
+            ort_cache = ort_sampler.condition_cache(obj_bps.numpy())
+
+            ## parity
+            ref = model.eps_model(x_t, t, cond, cond_cache).numpy()
+            err = np.abs(ort_sampler.predict_noise(x_t.numpy(), t, ort_cache) - ref).max()
+            ref_score = evaluator({'x_t': x_t, 'obj_bps': obj_bps})['p_success'].numpy()
+            score_err = np.abs(ort_evaluator(x_t.numpy(), obj_bps.numpy()) - ref_score).max()
+
+            ## latency of a deterministic ddim loop and of the evaluator
+            data = {'x': x_t, 'obj_bps': obj_bps}
+            torch_time = timeit(lambda: model.sample(data, solver='ddim', steps=args.steps), 'cpu', warmup=1, repeats=args.repeats)
+            ort_time = timeit(lambda: ort_sampler.sample(obj_bps.numpy(), solver='ddim', steps=args.steps), 'cpu', warmup=1, repeats=args.repeats)
+            torch_eval_time = timeit(lambda: evaluator({'x_t': x_t, 'obj_bps': obj_bps}), 'cpu', repeats=args.repeats)
+            ort_eval_time = timeit(lambda: ort_evaluator(x_t.numpy(), obj_bps.numpy()), 'cpu', repeats=args.repeats)
+
+            logger.info(f'B: {B:5d} | step max abs error {err:.3e} | evaluator max abs error {score_err:.3e}')
+            logger.info(f'B: {B:5d} | sampler torch: {1000 * torch_time:8.3f} ms | ort: {1000 * ort_time:8.3f} ms '
+                        f'({torch_time / ort_time:4.2f}x) | evaluator torch: {1000 * torch_eval_time:8.3f} ms | '
+                        f'ort: {1000 * ort_eval_time:8.3f} ms ({torch_eval_time / ort_eval_time:4.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
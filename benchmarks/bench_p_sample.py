@@ -0,0 +1,54 @@
+""" CPU latency of one DDPM reverse step at small batch sizes
+
+The fused step of `DDPM.p_sample` (one gather-free affine update with python float
+coefficients) is compared against the step from `p_mean_variance`, which gathers and
+reshapes the schedule coefficients of a batch of timesteps. The DDPM is randomly initialized.
+
+    python benchmarks/bench_p_sample.py --batch_size 1 20 200 --threads 1
+"""
+import os
+import sys
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from models import create_ddpm
+from benchmarks.common import compose_cfg, timeit
+from benchmarks.check_parity import reference_p_sample
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Reverse step benchmark of DDPM')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 20, 200])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = compose_cfg('bps', args.overrides)
+    model = create_ddpm(cfg).to(args.device).eval()
+    t = cfg.diffuser.steps // 2
+
+    for B in args.batch_size:
+        x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+        cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+        data = {'cond': cond, 'cond_cache': model.eps_model.condition_cache(cond)}
+
+        ref_time = timeit(lambda: reference_p_sample(model, x_t, t, data), args.device, repeats=args.repeats)
+        fused_time = timeit(lambda: model.p_sample(x_t, t, data), args.device, repeats=args.repeats)
+        logger.info(f'B: {B:5d} | posterior mean/variance: {1000 * ref_time:8.3f} ms/step | '
+                    f'fused: {1000 * fused_time:8.3f} ms/step | speedup: {ref_time / fused_time:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
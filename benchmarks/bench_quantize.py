@@ -0,0 +1,107 @@
+""" Speed and accuracy of the int8 quantized sampler and evaluator against the float models on CPU
+
+The quantized ckpts come from `quantize.py`. The evaluator is measured by its AUC on the
+DexGraspNet evaluator test data, and the sampler by the success of its grasps, scored by
+the float evaluator. Every sampler sees the same conditions from the same seed.
+
+    python quantize.py diffuser=ddpm model=unet_grasp_bps task=grasp_gen_ur_dexgn_slurm quantization.mode=dynamic
+    python benchmarks/bench_quantize.py --ckpt_dir ckpts/int8 --modes dynamic static
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from utils.quantize import load_quantized_ckpt
+from dataset import create_dataset_evaluator, collate_fn_general
+from benchmarks.common import compose_cfg, load_sampler, load_evaluator, load_conditions, roc_auc
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='int8 quantization benchmark')
+    parser.add_argument('--model', type=str, default='bps', help='sampler scene model, bps or pn2')
+    parser.add_argument('--ckpt_dir', type=str, default='ckpts/int8')
+    parser.add_argument('--modes', type=str, nargs='+', default=['dynamic', 'static'])
+    parser.add_argument('--num_objects', type=int, default=5)
+    parser.add_argument('--num_sample', type=int, default=20)
+    parser.add_argument('--num_eval', type=int, default=20000, help='evaluator test grasps for the AUC')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def evaluate_evaluator(evaluator, batches) -> tuple:
+    scores, labels = [], []
+    start = time.perf_counter()
+    for data in batches:
+        scores.append(evaluator({'x_t': data['x_t'], 'obj_bps': data['obj_bps']})['p_success'])
+        labels.append(data['label'])
+    elapsed = time.perf_counter() - start
+    scores, labels = torch.cat(scores), torch.cat(labels)
+    return roc_auc(scores, labels), elapsed / scores.shape[0]
+
+
+@torch.no_grad()
+def evaluate_sampler(model, evaluator, conditions, seed) -> tuple:
+    torch.manual_seed(seed)
+    p_success = []
+    start = time.perf_counter()
+    for data in conditions:
+        outputs = model.sample(data, k=1)[:, 0, -1, :]
+        p_success.append(evaluator({'x_t': outputs, 'obj_bps': data['obj_bps']})['p_success'])
+    elapsed = time.perf_counter() - start
+    p_success = torch.cat(p_success)
+    return (p_success > 0.5).float().mean().item(), elapsed / p_success.shape[0]
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = compose_cfg(args.model, args.overrides)
+    name = args.model
+
+    ## evaluator AUC on a slice of the test data
+    eval_cfg = compose_cfg(args.model, args.overrides, task='evaluator_dexgn_slurm')
+    dataloader = create_dataset_evaluator(eval_cfg, 'test').get_dataloader(
+        batch_size=args.batch_size, collate_fn=collate_fn_general, num_workers=0, shuffle=True)
+    batches = []
+    for data in dataloader:
+        batches.append({key: data[key].detach() for key in ['x_t', 'obj_bps', 'label']})
+        if len(batches) * args.batch_size >= args.num_eval:
+            break
+
+    evaluator = load_evaluator(cfg, 'cpu')
+    evaluators = {'float': evaluator}
+    for mode in args.modes:
+        evaluators[mode] = load_quantized_ckpt(load_evaluator(cfg, 'cpu', ckpt=False), os.path.join(args.ckpt_dir, f'evaluator_int8_{mode}.pth'))
+    base = None
+    for mode, m in evaluators.items():
+        auc, latency = evaluate_evaluator(m, batches)
+        base = base or (auc, latency)
+        logger.info(f'[evaluator {mode:>7s}] AUC: {auc:.4f} ({auc - base[0]:+.4f}) | '
+                    f'{1e6 * latency:.2f} us/grasp | speedup: {base[1] / latency:5.2f}x')
+
+    ## sampler success, scored by the float evaluator
+    conditions = load_conditions(cfg, args.num_objects, args.num_sample, 'cpu')
+    samplers = {'float': load_sampler(cfg, 'cpu')}
+    for mode in args.modes:
+        samplers[mode] = load_quantized_ckpt(load_sampler(cfg, 'cpu', ckpt=False), os.path.join(args.ckpt_dir, f'sampler_{name}_int8_{mode}.pth'))
+    base = None
+    for mode, m in samplers.items():
+        success, latency = evaluate_sampler(m, evaluator, conditions, args.seed)
+        base = base or (success, latency)
+        logger.info(f'[sampler {mode:>7s}] success rate: {success:.4f} ({success - base[0]:+.4f}) | '
+                    f'{1000 * latency:.3f} ms/grasp | speedup: {base[1] / latency:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
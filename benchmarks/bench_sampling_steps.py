@@ -0,0 +1,64 @@
+""" Grasp quality against the number of sampling steps
+
+Every configuration samples the same conditions from the same seed and scores the
+normalized grasps with DexEvaluator, as evaluator-guided sampling does.
+
+    python benchmarks/bench_sampling_steps.py --solvers ddim dpmsolver++2m heun --steps 20 10 5
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from models.dm.solver import create_solver
+from benchmarks.common import compose_cfg, load_sampler, load_evaluator, load_conditions, synchronize
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Sampling steps benchmark of DexSampler')
+    parser.add_argument('--model', type=str, default='bps', help='sampler scene model, bps or pn2')
+    parser.add_argument('--solvers', type=str, nargs='+', default=['ddim', 'dpmsolver++2m', 'dpmsolver++3m', 'heun'])
+    parser.add_argument('--steps', type=int, nargs='+', default=[100, 50, 20, 10, 5])
+    parser.add_argument('--eta', type=float, default=0.0)
+    parser.add_argument('--num_objects', type=int, default=20)
+    parser.add_argument('--num_sample', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = compose_cfg(args.model, args.overrides)
+    model = load_sampler(cfg, args.device)
+    evaluator = load_evaluator(cfg, args.device)
+    conditions = load_conditions(cfg, args.num_objects, args.num_sample, args.device)
+
+    ## reference: full ancestral chain
+    configs = [('ddpm', None)] + [(solver, steps) for solver in args.solvers for steps in args.steps]
+    for solver, steps in configs:
+        nfe = model.timesteps if solver == 'ddpm' else create_solver(solver, model.make_timesteps(steps)).nfe
+        torch.manual_seed(args.seed)
+        p_success = []
+        synchronize(args.device)
+        start = time.perf_counter()
+        for data in conditions:
+            outputs = model.sample(data, k=1, solver=solver, steps=steps, eta=args.eta)[:, 0, -1, :]
+            p_success.append(evaluator({'x_t': outputs, 'obj_bps': data['obj_bps']})['p_success'])
+        synchronize(args.device)
+        elapsed = time.perf_counter() - start
+
+        p_success = torch.cat(p_success)
+        logger.info(f'[{solver:>13s}] steps: {str(steps or model.timesteps):>4s} | nfe: {nfe:4d} | '
+                    f'p_success: {p_success.mean().item():.4f} | success rate: {(p_success > 0.5).float().mean().item():.4f} | '
+                    f'{1000 * elapsed / p_success.shape[0]:.3f} ms/grasp')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+""" Per-step latency of the UNet denoising step
+
+The UNet is randomly initialized from `configs/model/unet_grasp_bps.yaml`, the condition
+has 8 tokens as the obj_bps condition, and 16 tokens as the PointNet2 scene features.
+
+    python benchmarks/bench_unet_step.py --device cpu --batch_size 20 200 2000
+"""
+import os
+import sys
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from models import create_unet
+from benchmarks.common import compose_cfg, timeit, set_single_token_fast_path
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Denoising step benchmark of the UNet')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[20, 200, 2000])
+    parser.add_argument('--tokens', type=int, nargs='+', default=[8, 16], help='condition tokens, 8 for obj_bps and 16 for PointNet2')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = compose_cfg('bps', args.overrides)
+    unet = create_unet(cfg).to(args.device).eval()
+
+    for tokens in args.tokens:
+        for B in args.batch_size:
+            x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+            ts = torch.full((B, ), cfg.diffuser.steps - 1, device=args.device, dtype=torch.long)
+            cond = torch.randn(B, tokens, cfg.model.context_dim, device=args.device)
+
+            cache_time = timeit(lambda: unet.condition_cache(cond), args.device, repeats=args.repeats)
+            cond_cache = unet.condition_cache(cond)
+            ## name: (forward, single token fast path, time embedding table)
+            t = cfg.diffuser.steps - 1
+            variants = {
+                'baseline': (lambda: unet(x_t, ts, cond), False, False),
+                'cond cache': (lambda: unet(x_t, ts, cond, cond_cache), False, False),
+                '+ 1-token attn': (lambda: unet(x_t, ts, cond, cond_cache), True, False),
+                '+ time table': (lambda: unet(x_t, t, cond, cond_cache), True, True),
+            }
+
+            times = {}
+            for name, (fn, fast_path, time_table) in variants.items():
+                set_single_token_fast_path(unet, fast_path)
+                unet.timesteps = cfg.diffuser.steps if time_table else None
+                times[name] = timeit(fn, args.device, repeats=args.repeats)
+            base = times['baseline']
+            for name, step_time in times.items():
+                logger.info(f'tokens: {tokens:3d} | B: {B:5d} | {name:>16s} | {1000 * step_time:8.3f} ms/step | '
+                            f'speedup: {base / step_time:5.2f}x')
+            logger.info(f'tokens: {tokens:3d} | B: {B:5d} | cond cache is built once in {1000 * cache_time:.3f} ms, '
+                        f'saving {1000 * (base - times["cond cache"]) * cfg.diffuser.steps:.1f} ms over {cfg.diffuser.steps} steps')
+
+
+if __name__ == '__main__':
+    main()
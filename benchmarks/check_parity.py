@@ -0,0 +1,407 @@
+""" Numerical parity checks of the inference fast paths against their reference paths
+
+Models are randomly initialized, so no checkpoint or dataset is needed.
+
+    python benchmarks/check_parity.py --device cpu
+"""
+import os
+import sys
+import argparse
+
+sys.path.append(os.getcwd())
+
+import copy
+import torch
+from loguru import logger
+
+from models import create_unet, create_ddpm, create_evaluator
+from utils.quantize import convert_pointwise_conv1d
+from models.model.denoise_step import compile_denoise_step
+from models.dm.rng import condition_seeds
+from models.model.utils import get_embedder
+from utils.scoring import score_grasps, bytes_per_grasp
+from utils.ranking import segmented_topk, diverse_topk
+from utils.utils import autocast
+from utils.rot6d import robust_compute_rotation_matrix_from_ortho6d
+from benchmarks.common import compose_cfg, set_single_token_fast_path
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Parity checks of the inference fast paths')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+def assert_close(name: str, out: torch.Tensor, ref: torch.Tensor, atol: float=1e-5, rtol: float=1e-4) -> None:
+    max_err = (out - ref).abs().max().item()
+    assert torch.allclose(out, ref, atol=atol, rtol=rtol), f'{name}: max abs error {max_err:.3e}'
+    logger.info(f'{name:<40s} ok | max abs error {max_err:.3e}')
+
+
+@torch.no_grad()
+def check_single_token_attention(cfg, args) -> None:
+    unet = create_unet(cfg).to(args.device).eval()
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    ts = torch.randint(0, cfg.diffuser.steps, (B, ), device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+
+    set_single_token_fast_path(unet, False)
+    ref = unet(x_t, ts, cond)
+    set_single_token_fast_path(unet, True)
+    assert_close('single token self-attention (folded)', unet(x_t, ts, cond), ref)
+    unet.train()
+    for m in unet.modules():
+        if isinstance(m, torch.nn.Dropout):
+            m.p = 0.
+    assert_close('single token self-attention (unfolded)', unet(x_t, ts, cond), ref)
+
+
+@torch.no_grad()
+def check_sdpa_backend(cfg, args) -> None:
+    ref_unet = create_unet(cfg).to(args.device).eval()
+    cfg.model.attention_backend = 'sdpa'
+    unet = create_unet(cfg).to(args.device).eval()
+    cfg.model.attention_backend = 'einsum'
+    unet.load_state_dict(ref_unet.state_dict())
+
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    ts = torch.randint(0, cfg.diffuser.steps, (B, ), device=args.device)
+    for tokens in [8, 16]:
+        cond = torch.randn(B, tokens, cfg.model.context_dim, device=args.device)
+        assert_close(f'sdpa attention backend ({tokens} tokens)', unet(x_t, ts, cond), ref_unet(x_t, ts, cond))
+
+
+@torch.no_grad()
+def check_time_embed_table(cfg, args) -> None:
+    unet = create_unet(cfg).to(args.device).eval()
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+    t = cfg.diffuser.steps // 2
+    ts = torch.full((B, ), t, device=args.device, dtype=torch.long)
+
+    unet.timesteps = None
+    ref = unet(x_t, ts, cond)
+    unet.timesteps = cfg.diffuser.steps
+    assert_close('time embedding table (gather)', unet(x_t, ts, cond), ref)
+    assert_close('time embedding table (broadcast)', unet(x_t, t, cond), ref)
+
+    ## the table follows in-place weight updates
+    unet.time_embed[0].bias.add_(1.)
+    unet.timesteps = None
+    ref = unet(x_t, ts, cond)
+    unet.timesteps = cfg.diffuser.steps
+    assert_close('time embedding table (updated weights)', unet(x_t, t, cond), ref)
+
+
+@torch.no_grad()
+def check_shared_condition(cfg, args) -> None:
+    B, k = args.batch_size, 4
+    x_t = torch.randn(k * B, cfg.model.d_x, device=args.device)
+    ts = torch.randint(0, cfg.diffuser.steps, (k * B, ), device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+    for backend in ['einsum', 'sdpa']:
+        cfg.model.attention_backend = backend
+        unet = create_unet(cfg).to(args.device).eval()
+        cfg.model.attention_backend = 'einsum'
+
+        ## k samples folded into the batch with the sample index as the outer dimension
+        ref = unet(x_t, ts, cond.repeat(k, 1, 1))
+        assert_close(f'shared condition ({backend})', unet(x_t, ts, cond), ref)
+        assert_close(f'shared condition cache ({backend})', unet(x_t, ts, cond, unet.condition_cache(cond)), ref)
+
+
+@torch.no_grad()
+def check_evaluator_bps_features(cfg, args) -> None:
+    evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+    evaluator.device = args.device
+    evaluator.to(args.device).eval()
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    obj_bps = torch.rand(B, 4096, device=args.device)
+
+    evaluator.split_bps = False
+    ref = evaluator({'x_t': x_t, 'obj_bps': obj_bps})['p_success']
+    obj_bps_feat = evaluator.bps_features(obj_bps)
+    assert_close('evaluator bps features', evaluator({'x_t': x_t, 'obj_bps_feat': obj_bps_feat})['p_success'], ref)
+
+    ## eval-time split of the BPS columns, with one, a few and all distinct objects in the batch
+    for n_obj in [1, 3, B]:
+        bps = obj_bps[torch.arange(B, device=args.device) % n_obj]
+        evaluator.split_bps = False
+        ref = evaluator({'x_t': x_t, 'obj_bps': bps})['p_success']
+        evaluator.split_bps = True
+        assert_close(f'evaluator split bps ({n_obj} objects)', evaluator({'x_t': x_t, 'obj_bps': bps})['p_success'], ref)
+
+
+@torch.no_grad()
+def check_evaluator_fusion(cfg, args) -> None:
+    evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+    evaluator.device = args.device
+    ## non-trivial running statistics, a fresh batch norm is an identity
+    for m in evaluator.modules():
+        if isinstance(m, torch.nn.BatchNorm1d):
+            m.running_mean.uniform_(-1, 1)
+            m.running_var.uniform_(0.5, 2)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    evaluator.to(args.device).eval()
+    B = args.batch_size
+    data = {'x_t': torch.randn(B, cfg.model.d_x, device=args.device), 'obj_bps': torch.rand(B, 4096, device=args.device)}
+
+    ref = evaluator(data)['p_success']
+    fused = copy.deepcopy(evaluator).fuse_for_inference()
+    assert_close('evaluator fusion', fused(data)['p_success'], ref)
+    fused.split_bps = True
+    assert_close('evaluator fusion with split bps', fused(data)['p_success'], ref)
+
+
+@torch.no_grad()
+def check_score_grasps(cfg, args) -> None:
+    evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+    evaluator.device = args.device
+    evaluator.to(args.device).eval()
+    N, M = 10 * args.batch_size, 4
+    grasps = torch.randn(N, cfg.model.d_x)
+    obj_bps_index = torch.rand(M, 4096)
+    object_ids = torch.randint(0, M, (N, )).sort().values
+
+    evaluator.split_bps = False
+    ref = evaluator({'x_t': grasps.to(args.device), 'obj_bps': obj_bps_index[object_ids].to(args.device)})['p_success'][:, 0]
+    ## a budget of a few grasps per chunk
+    max_mem = 7 * bytes_per_grasp(evaluator)
+    assert_close('score grasps', torch.from_numpy(score_grasps(evaluator, grasps, obj_bps_index, object_ids, max_mem)),
+                 ref.cpu())
+
+
+def reference_diverse_topk(x, scores, group, k, blocks):
+    """ Greedy diverse top-k with one python pass per group, filled with the best duplicates """
+    keep = []
+    for g in group.unique().tolist():
+        idx = (group == g).nonzero()[:, 0]
+        idx = idx[torch.sort(scores[idx], descending=True, stable=True).indices].tolist()
+        kept = []
+        for i in idx:
+            dup = any(all((x[i, s:e] - x[j, s:e]).norm() < tol for s, e, tol in blocks) for j in kept)
+            if len(kept) < k and not dup:
+                kept.append(i)
+        kept += [i for i in idx if i not in kept][:max(0, k - len(kept))]
+        keep += sorted(kept, key=idx.index)
+    return torch.tensor(keep, dtype=torch.long)
+
+
+def check_ranking(cfg, args) -> None:
+    G, M, k = 6, 50, 10
+    ## coarse grasps so that duplicates occur, groups are shuffled and of different sizes
+    x = torch.randint(0, 3, (G * M, cfg.model.d_x)).float()
+    scores = torch.rand(G * M)
+    group = torch.arange(G).repeat_interleave(M)
+    perm = torch.randperm(G * M)[:G * M - 7]
+    x, scores, group = x[perm], scores[perm], group[perm]
+
+    ref = torch.cat([(group == g).nonzero()[:, 0][torch.sort(scores[group == g], descending=True, stable=True).indices[:k]]
+                     for g in range(G)])
+    assert torch.equal(segmented_topk(scores, group, k), ref), 'segmented top-k'
+    blocks = [(0, 3, 1.5), (3, 9, 2.5), (9, cfg.model.d_x, 5.5)]
+    out = diverse_topk(x, scores, group, k, blocks)
+    assert torch.equal(out, reference_diverse_topk(x, scores, group, k, blocks)), 'diverse top-k'
+    logger.info(f'{"ranking":<40s} ok')
+
+
+def reference_embed(x, multires):
+    """ NeRF positional encoding with one term per (frequency, periodic function) """
+    freq_bands = 2. ** torch.linspace(0., multires - 1, steps=multires)
+    return torch.cat([x] + [p_fn(x * freq) for freq in freq_bands for p_fn in [torch.sin, torch.cos]], -1)
+
+
+@torch.no_grad()
+def check_embedder(cfg, args) -> None:
+    x = torch.randn(args.batch_size, 16, device=args.device)
+    for multires in [10, 4]:
+        embed_fn, out_dim = get_embedder(multires, in_dim=16)
+        out = embed_fn.to(args.device)(x)
+        assert out.shape[-1] == out_dim, 'embedder output dim'
+        ## same order of the terms, the values only differ by the rounding of the sin and cos kernels
+        assert_close(f'embedder ({multires} frequencies)', out, reference_embed(x, multires), atol=1e-6, rtol=0.)
+
+
+def reference_p_sample(model, x_t, t, data, seed=None):
+    """ DDPM reverse step from the posterior mean and variance of a batch of timesteps """
+    ts = torch.full((x_t.shape[0], ), t, device=x_t.device, dtype=torch.long)
+    model_mean, _, model_log_variance = model.p_mean_variance(x_t, ts, data['cond'], data['cond_cache'])
+    if seed is not None:
+        torch.manual_seed(seed)
+    noise = torch.randn_like(x_t) if t > 0 else 0.
+    return model_mean + (0.5 * model_log_variance).exp() * noise
+
+
+@torch.no_grad()
+def check_coef_pack(cfg, args) -> None:
+    model = create_ddpm(cfg).to(args.device).eval()
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+    data = {'cond': cond, 'cond_cache': model.eps_model.condition_cache(cond)}
+    for t in [cfg.diffuser.steps - 1, cfg.diffuser.steps // 2, 1, 0]:
+        ref = reference_p_sample(model, x_t, t, data, args.seed)
+        torch.manual_seed(args.seed)
+        assert_close(f'fused p_sample step (t={t})', model.p_sample(x_t, t, data), ref)
+
+
+@torch.no_grad()
+def check_pointwise_conv1d(cfg, args) -> None:
+    unet = create_unet(cfg).to(args.device).eval()
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    ts = torch.randint(0, cfg.diffuser.steps, (B, ), device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+    ## the layers quantized as nn.Linear
+    assert_close('pointwise conv1d as linear', convert_pointwise_conv1d(copy.deepcopy(unet))(x_t, ts, cond), unet(x_t, ts, cond))
+
+
+@torch.no_grad()
+def check_denoise_step(cfg, args) -> None:
+    unet = create_unet(cfg).to(args.device).eval()
+    B, k = args.batch_size, 4
+    x_t = torch.randn(k * B, cfg.model.d_x, device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+    cond_cache = unet.condition_cache(cond)
+    ts = torch.arange(cfg.diffuser.steps, device=args.device)
+    for backend in ['eager', 'script']:
+        step = compile_denoise_step(unet, backend)
+        for t in [cfg.diffuser.steps - 1, 0]:
+            assert_close(f'denoise step ({backend}, t={t})', step(x_t, ts[t:t + 1], cond_cache), unet(x_t, t, cond, cond_cache))
+
+    ## the compiled step inside the DDPM reverse step
+    model = create_ddpm(cfg).to(args.device).eval()
+    data = {'cond': cond, 'cond_cache': model.eps_model.condition_cache(cond)}
+    t = cfg.diffuser.steps // 2
+    torch.manual_seed(args.seed)
+    ref = model.p_sample(x_t, t, data)
+    model.compile = True
+    torch.manual_seed(args.seed)
+    assert_close(f'compiled p_sample step ({model.compile_backend})', model.p_sample(x_t, t, data), ref)
+
+
+@torch.no_grad()
+def check_bf16_autocast(cfg, args) -> None:
+    """ bf16 has an 8-bit mantissa, so the tolerances are those of a relative error of about 1e-2 """
+    model = create_ddpm(cfg).to(args.device).eval()
+    evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+    evaluator.device = args.device
+    evaluator.to(args.device).eval()
+    B = args.batch_size
+    x_t = torch.randn(B, cfg.model.d_x, device=args.device)
+    obj_bps = torch.rand(B, 4096, device=args.device)
+    cond = torch.randn(B, 8, cfg.model.context_dim, device=args.device)
+    data = {'cond': cond, 'cond_cache': model.eps_model.condition_cache(cond)}
+    t = cfg.diffuser.steps // 2
+
+    ref_noise = model.eps_model(x_t, t, cond, data['cond_cache'])
+    torch.manual_seed(args.seed)
+    ref_step = model.p_sample(x_t, t, data)
+    ref_score = evaluator({'x_t': x_t, 'obj_bps': obj_bps})['p_success']
+    ref_rot = robust_compute_rotation_matrix_from_ortho6d(x_t[:, 3:9])
+    with autocast(args.device, 'bf16'):
+        data['cond_cache'] = model.eps_model.condition_cache(cond)
+        noise = model.eps_model(x_t, t, cond, data['cond_cache'])
+        torch.manual_seed(args.seed)
+        step = model.p_sample(x_t, t, data)
+        score = evaluator({'x_t': x_t, 'obj_bps': obj_bps})['p_success']
+        rot = robust_compute_rotation_matrix_from_ortho6d(x_t[:, 3:9])
+
+    assert step.dtype == torch.float32 and score.dtype == torch.float32 and rot.dtype == torch.float32
+    scale = ref_noise.abs().max().item()
+    assert_close('bf16 autocast unet', noise.float(), ref_noise, atol=5e-2 * scale, rtol=5e-2)
+    assert_close('bf16 autocast p_sample step', step, ref_step, atol=5e-2 * scale, rtol=5e-2)
+    assert_close('bf16 autocast evaluator', score, ref_score, atol=2e-2, rtol=5e-2)
+    ## float32 island
+    assert_close('bf16 autocast rot6d to matrix', rot, ref_rot, atol=0., rtol=0.)
+
+
+@torch.no_grad()
+def check_iter_sample(cfg, args) -> None:
+    model = create_ddpm(cfg).to(args.device).eval()
+    B, k = args.batch_size, 2
+    data = {'x': torch.randn(B, cfg.model.d_x, device=args.device), 'obj_bps': torch.rand(B, 4096, device=args.device)}
+    for solver, steps in [('ddpm', None), ('ddim', 10), ('dpmsolver++2m', 10)]:
+        torch.manual_seed(args.seed)
+        ref = model.p_sample_loop(data, solver=solver, steps=steps, return_trajectory=True, trajectory_stride=3, k=k)
+        torch.manual_seed(args.seed)
+        items = list(model.iter_sample(data, solver=solver, steps=steps, stride=3, k=k))
+        out = torch.stack([x_t for _, x_t, _ in items], dim=1)
+        assert_close(f'iter_sample trajectory ({solver})', out, ref[:, 1:])
+        ## the last predicted x0 is the final sample of the deterministic solvers
+        if solver != 'ddpm':
+            assert_close(f'iter_sample last pred_x0 ({solver})', items[-1][2], items[-1][1])
+
+
+@torch.no_grad()
+def check_early_stop(cfg, args) -> None:
+    model = create_ddpm(cfg).to(args.device).eval()
+    B, k = args.batch_size, 2
+    data = {'x': torch.randn(B, cfg.model.d_x, device=args.device), 'obj_bps': torch.rand(B, 4096, device=args.device)}
+    for solver, steps in [('ddpm', None), ('ddim', 10), ('dpmsolver++2m', 10), ('heun', 5)]:
+        torch.manual_seed(args.seed)
+        ref = model.p_sample_loop(data, solver=solver, steps=steps, k=k)
+        nfe = data['nfe']
+        ## a zero tolerance never freezes a sample, so the loop of the early stop must match the full one
+        torch.manual_seed(args.seed)
+        out = model.p_sample_loop(data, solver=solver, steps=steps, k=k, early_stop_tol=0.)
+        assert_close(f'early stop without freezing ({solver})', out, ref)
+        assert torch.equal(data['nfe'], nfe), f'early stop nfe ({solver})'
+
+        ## an infinite tolerance freezes every sample after `early_stop_patience` steps
+        torch.manual_seed(args.seed)
+        out = model.p_sample_loop(data, solver=solver, steps=steps, k=k, early_stop_tol=float('inf'))
+        logger.info(f'early stop ({solver}) nfe/sample: {data["nfe"].float().mean().item():.2f} of {nfe.float().mean().item():.2f}')
+
+
+def check_counter_rng(cfg, args) -> None:
+    model = create_ddpm(cfg).to(args.device).eval()
+    B, k = args.batch_size, 4
+    keys = [(f'object_{i}', 0.1, i % 3) for i in range(B)]
+    data = {'x': torch.randn(B, cfg.model.d_x, device=args.device), 'obj_bps': torch.rand(B, 4096, device=args.device),
+            'seed': condition_seeds(keys, args.seed, args.device)}
+    for solver, steps, eta in [('ddpm', None, 0.), ('ddim', 10, 1.)]:
+        ref = model.sample(data, k=k, solver=solver, steps=steps, eta=eta)
+        ## the same grasps whatever the global RNG, the batch and its split into micro batches
+        torch.manual_seed(args.seed + 1)
+        i = B - 1
+        single = {'x': data['x'][i:i + 1], 'obj_bps': data['obj_bps'][i:i + 1], 'seed': data['seed'][i:i + 1]}
+        out = model.sample(single, k=k, solver=solver, steps=steps, eta=eta, micro_batch=1)
+        assert_close(f'counter rng of one condition ({solver})', out[0], ref[i])
+        out = model.sample(data, k=k, solver=solver, steps=steps, eta=eta, early_stop_tol=0.)
+        assert_close(f'counter rng with early stop ({solver})', out, ref)
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    cfg = compose_cfg('bps', args.overrides)
+
+    check_single_token_attention(cfg, args)
+    check_sdpa_backend(cfg, args)
+    check_time_embed_table(cfg, args)
+    check_shared_condition(cfg, args)
+    check_evaluator_bps_features(cfg, args)
+    check_embedder(cfg, args)
+    check_evaluator_fusion(cfg, args)
+    check_score_grasps(cfg, args)
+    check_ranking(cfg, args)
+    check_coef_pack(cfg, args)
+    check_pointwise_conv1d(cfg, args)
+    check_denoise_step(cfg, args)
+    check_bf16_autocast(cfg, args)
+    check_iter_sample(cfg, args)
+    check_early_stop(cfg, args)
+    check_counter_rng(cfg, args)
+
+
+if __name__ == '__main__':
+    main()
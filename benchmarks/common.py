@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+from typing import Callable, Dict, List
+
+sys.path.append(os.getcwd())
+
+import torch
+from hydra import compose, initialize
+from omegaconf import DictConfig
+
+from models import create_ddpm, create_evaluator
+from models.model.utils import CrossAttention
+from utils.utils import load_ckpt
+
+with open('dataset/test_split.txt', 'r') as file:
+    dexgraspnet_test = [line.strip() for line in file]
+
+object_scale_list = ['0.06', '0.08', '0.1', '0.12', '0.15']
+
+
+def compose_cfg(model: str='bps', overrides: List[str]=None, task: str='grasp_gen_ur_dexgn_slurm') -> DictConfig:
+    """ Compose the sampling configuration, as `scripts/sample.sh` does
+
+    Args:
+        model: sampler scene model, 'bps' or 'pn2'
+        overrides: extra hydra overrides, e.g. ['diffuser.solver=ddim']
+        task: task config, 'evaluator_dexgn_slurm' gives the evaluator dataset
+
+    Return:
+        Composed configuration
+    """
+    with initialize(version_base=None, config_path='../configs'):
+        cfg = compose(config_name='sample', overrides=[
+            'diffuser=ddpm',
+            f'model=unet_grasp_{model}',
+            f'task={task}',
+        ] + list(overrides or []))
+    return cfg
+
+
+def load_sampler(cfg: DictConfig, device: str, ckpt: bool=True) -> torch.nn.Module:
+    """ Create the DexSampler and optionally load its checkpoint from the config
+    """
+    model = create_ddpm(cfg)
+    if ckpt:
+        if cfg.model.scene_model.name == 'obj_bps':
+            load_ckpt(model, path=cfg.sampler_bps_ckpt_pth)
+        elif cfg.model.scene_model.name == 'PointNet2':
+            load_ckpt(model, path=cfg.sampler_pn2_ckpt_pth)
+        else:
+            raise NotImplementedError
+    model.to(device=device)
+    model.eval()
+    return model
+
+
+def load_evaluator(cfg: DictConfig, device: str, ckpt: bool=True) -> torch.nn.Module:
+    """ Create the DexEvaluator used in `sample.py` and optionally load its checkpoint
+    """
+    evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+    if ckpt:
+        load_ckpt(evaluator, path=cfg.evaluator_ckpt_pth)
+    evaluator.device = device
+    evaluator.to(device=device)
+    evaluator.eval()
+    return evaluator
+
+
+def load_conditions(cfg: DictConfig, num_objects: int, num_sample: int, device: str, cam_view: int=0) -> List[Dict]:
+    """ Build sampling inputs for the first `num_objects` DexGraspNet test objects, one per scale
+
+    Return:
+        List of data dicts in the format used by `GraspGenURVisualizer.sample_grasps`
+    """
+    obj_bps_all = torch.load(os.path.join(cfg.data_root, 'obj_bps_dist_full.pt'))
+    scene_pcds = None
+    if cfg.model.scene_model.name == 'PointNet2':
+        scene_pcds = torch.load(os.path.join(cfg.data_root, 'scene_pcd_all.pt'))
+
+    conditions = []
+    for object_name in dexgraspnet_test[:num_objects]:
+        for object_scale in object_scale_list:
+            obj_bps = obj_bps_all[object_name][object_scale][cam_view].reshape(1, -1).repeat(num_sample, 1)
+            data = {'x': torch.randn(num_sample, cfg.model.d_x, device=device),
+                    'obj_bps': obj_bps.to(device),
+                    'scene_id': [object_name for _ in range(num_sample)]}
+            if scene_pcds is not None:
+                data['pos'] = scene_pcds[object_name][object_scale][cam_view].unsqueeze(0).repeat(num_sample, 1, 1).to(device)
+            conditions.append(data)
+    return conditions
+
+
+def set_single_token_fast_path(model: torch.nn.Module, enabled: bool) -> None:
+    for m in model.modules():
+        if isinstance(m, CrossAttention):
+            m.single_token_fast_path = enabled
+
+
+def synchronize(device: str) -> None:
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn: Callable, device: str, warmup: int=3, repeats: int=20) -> float:
+    """ Average wall time of `fn` in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def roc_auc(scores: torch.Tensor, labels: torch.Tensor) -> float:
+    """ Area under the ROC curve, i.e., the probability that a positive is scored above a negative
+    """
+    scores, labels = scores.flatten().double(), labels.flatten().bool()
+    ranks = torch.empty_like(scores)
+    ranks[scores.argsort()] = torch.arange(1, scores.numel() + 1, dtype=scores.dtype, device=scores.device)
+    n_pos = labels.sum().item()
+    n_neg = labels.numel() - n_pos
+    return ((ranks[labels].sum().item() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg))
@@ -0,0 +1,76 @@
+""" Grasp quality of distilled samplers against their number of sampling steps
+
+The teacher samples with the full DDPM chain, every progressively distilled student with
+deterministic DDIM on its halving timestep grid, and a consistency model in 1 and 2 steps.
+All samplers see the same conditions from the same seed, and the grasps are scored by DexEvaluator.
+
+    python benchmarks/eval_distill.py --ckpt_dir ckpts/<exp>/ckpts --steps 50 25 13 7 4
+    python benchmarks/eval_distill.py --ckpt_dir ckpts/<exp>/ckpts --steps --consistency consistency
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.getcwd())
+
+import torch
+from loguru import logger
+
+from utils.utils import load_ckpt
+from benchmarks.common import compose_cfg, load_sampler, load_evaluator, load_conditions, synchronize
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Evaluation of progressively distilled samplers')
+    parser.add_argument('--model', type=str, default='bps', help='sampler scene model, bps or pn2')
+    parser.add_argument('--ckpt_dir', type=str, required=True, help='directory of the student_<steps>.pth checkpoints')
+    parser.add_argument('--steps', type=int, nargs='*', default=[50, 25, 13, 7, 4])
+    parser.add_argument('--consistency', type=str, default=None, help='name of the consistency model ckpt, e.g. consistency')
+    parser.add_argument('--consistency_steps', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--num_objects', type=int, default=20)
+    parser.add_argument('--num_sample', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('overrides', nargs='*', help='extra hydra overrides of configs/sample.yaml')
+    return parser.parse_args()
+
+
+def evaluate(model, evaluator, conditions, solver, steps, args, mode='diffusion') -> None:
+    torch.manual_seed(args.seed)
+    p_success = []
+    synchronize(args.device)
+    start = time.perf_counter()
+    for data in conditions:
+        outputs = model.sample(data, k=1, solver=solver, steps=steps, mode=mode)[:, 0, -1, :]
+        p_success.append(evaluator({'x_t': outputs, 'obj_bps': data['obj_bps']})['p_success'])
+    synchronize(args.device)
+    elapsed = time.perf_counter() - start
+
+    p_success = torch.cat(p_success)
+    logger.info(f'[{solver:>11s}] steps: {str(steps or model.timesteps):>4s} | '
+                f'p_success: {p_success.mean().item():.4f} | success rate: {(p_success > 0.5).float().mean().item():.4f} | '
+                f'{1000 * elapsed / p_success.shape[0]:.3f} ms/grasp')
+
+
+def main():
+    args = parse_args()
+    cfg = compose_cfg(args.model, ['diffuser.timestep_spacing=halving'] + list(args.overrides))
+    evaluator = load_evaluator(cfg, args.device)
+    conditions = load_conditions(cfg, args.num_objects, args.num_sample, args.device)
+
+    ## teacher: full ancestral chain
+    evaluate(load_sampler(cfg, args.device), evaluator, conditions, 'ddpm', None, args)
+    for steps in args.steps:
+        model = load_sampler(cfg, args.device, ckpt=False)
+        load_ckpt(model, path=os.path.join(args.ckpt_dir, f'student_{steps}.pth'))
+        evaluate(model, evaluator, conditions, 'ddim', steps, args)
+    if args.consistency is not None:
+        model = load_sampler(cfg, args.device, ckpt=False)
+        load_ckpt(model, path=os.path.join(args.ckpt_dir, f'{args.consistency}.pth'))
+        for steps in args.consistency_steps:
+            evaluate(model, evaluator, conditions, 'consistency', steps, args, mode='consistency')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import os
+import copy
+import functools
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from loguru import logger
+
+from utils.io import mkdir_if_not_exists
+from utils.plot import Ploter
+from utils.utils import save_ckpt, load_ckpt, autocast
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from models import create_ddpm
+from models.dm.distillation import halving_stride, progressive_distillation_loss, consistency_loss, ema_update
+from dataset import create_dataset_sampler, collate_fn_general
+
+
+def train_student(cfg, student, dataloader, loss_fn, name: str, device: str, after_step=None) -> None:
+    """ Train the student with the given distillation loss and save it as `<name>.pth`
+
+    Args:
+        cfg: configuration dict
+        student: student DDPM, initialized from the teacher
+        dataloader: training dataloader of the sampler
+        loss_fn: distillation loss of a batch of data
+        name: name of the student, used for logging and the ckpt file
+        device: training device
+        after_step: called after every optimization step, e.g., to update the EMA target
+    """
+    params = [p for p in student.parameters() if p.requires_grad]
+    optimizer = torch.optim.Adam([{'params': params, 'lr': cfg.distill.lr}])
+
+    step = 0
+    for epoch in range(0, cfg.distill.num_epochs):
+        for it, data in enumerate(dataloader):
+            for key in data:
+                if torch.is_tensor(data[key]):
+                    data[key] = data[key].to(device)
+
+            optimizer.zero_grad()
+            with autocast(device, cfg.get('amp_dtype', None)):
+                outputs = loss_fn(data)
+            loss = outputs['loss'].mean()
+            loss.backward()
+            optimizer.step()
+            if after_step is not None:
+                after_step()
+
+            ## plot loss
+            if (step + 1) % cfg.distill.log_step == 0:
+                logger.info(f'[DISTILL {name}] ==> Epoch: {epoch+1:3d} | Iter: {it+1:5d} | Step: {step+1:7d} | Loss: {loss:.3f}')
+                Ploter.write({
+                    f'{name}/loss': {'plot': True, 'value': loss, 'step': step},
+                    f'{name}/epoch': {'plot': True, 'value': epoch, 'step': step},
+                })
+            step += 1
+
+    save_ckpt(
+        model=student, epoch=cfg.distill.num_epochs, step=step,
+        path=os.path.join(cfg.ckpt_dir, f'{name}.pth'),
+        save_scene_model=cfg.save_scene_model,
+    )
+
+
+def distill(cfg) -> None:
+    """ distillation portal, progressive distillation into few-step students, or consistency
+    distillation / training into a consistency model
+
+    Args:
+        cfg: configuration dict
+    """
+    if cfg.gpu is not None:
+        device = f'cuda:{cfg.gpu}'
+    else:
+        device = 'cpu'
+
+    dataset = create_dataset_sampler(cfg, 'train')
+    logger.info(f'Load train dataset size: {len(dataset)}')
+    dataloader = dataset.get_dataloader(
+        batch_size=cfg.task.train.batch_size,
+        collate_fn=collate_fn_general,
+        num_workers=cfg.task.train.num_workers,
+        pin_memory=True,
+        shuffle=True,
+    )
+
+    teacher = create_ddpm(cfg)
+    load_ckpt(teacher, path=cfg.teacher_ckpt_pth)
+    teacher.to(device=device)
+
+    stride = halving_stride(teacher.timesteps, cfg.distill.teacher_steps)
+    if cfg.distill.method == 'progressive':
+        ## every round halves the sampling steps, the student of a round is the teacher of the next one
+        while len(range(teacher.timesteps - 1, -1, -2 * stride)) >= cfg.distill.student_steps:
+            teacher.eval()
+            student = copy.deepcopy(teacher)
+            student.train()
+            student_steps = len(range(teacher.timesteps - 1, -1, -2 * stride))
+            logger.info(f'distill {len(range(teacher.timesteps - 1, -1, -stride))} teacher steps into {student_steps} student steps')
+
+            loss_fn = functools.partial(progressive_distillation_loss, student, teacher, stride=stride)
+            train_student(cfg, student, dataloader, loss_fn, f'student_{student_steps}', device)
+            teacher = student
+            stride *= 2
+    elif cfg.distill.method in ['consistency', 'consistency_training']:
+        ## consistency distillation from the teacher grid, or consistency training without teacher
+        teacher.eval()
+        student = copy.deepcopy(teacher)
+        student.train()
+        target = copy.deepcopy(teacher)
+        target.eval()
+        target.requires_grad_(False)
+        logger.info(f'{cfg.distill.method} on {len(range(teacher.timesteps - 1, -1, -stride))} timesteps')
+
+        loss_fn = functools.partial(consistency_loss, student, target, stride=stride,
+                                    teacher=teacher if cfg.distill.method == 'consistency' else None)
+        after_step = functools.partial(ema_update, target, student, cfg.distill.ema_decay)
+        train_student(cfg, student, dataloader, loss_fn, cfg.distill.method, device, after_step=after_step)
+    else:
+        raise Exception('Unsupported distillation method.')
+
+
+@hydra.main(version_base=None, config_path="./configs", config_name="distill")
+def main(cfg: DictConfig) -> None:
+
+    if os.environ.get('SLURM') is not None:
+        cfg.slurm = True # update slurm config
+        logger.remove(handler_id=0) # remove default handler
+
+    logger.add(cfg.exp_dir + '/runtime.log')
+
+    mkdir_if_not_exists(cfg.tb_dir)
+    mkdir_if_not_exists(cfg.ckpt_dir)
+
+    writer = SummaryWriter(log_dir=cfg.tb_dir)
+    Ploter.setWriter(writer)
+
+    ## Begin distillation progress
+    logger.info('Configuration: \n' + OmegaConf.to_yaml(cfg))
+    logger.info('Begin distillation..')
+
+    distill(cfg) # distillation portal
+
+    ## Distillation is over!
+    writer.close() # close summarywriter and flush all data to disk
+    logger.info('End distillation..')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import torch
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+import hydra
+
+from utils.utils import load_ckpt
+from utils.io import mkdir_if_not_exists
+from utils.onnx_export import export_sampler, export_evaluator
+from models import create_ddpm, create_evaluator
+
+
+@hydra.main(version_base=None, config_path="./configs", config_name="sample")
+def main(cfg: DictConfig) -> None:
+    ## the graphs are traced on CPU in float32, see utils/ort_backend.py for the runtime
+    mkdir_if_not_exists(cfg.onnx.output_dir)
+    logger.info('ONNX export: \n' + OmegaConf.to_yaml(cfg.onnx))
+
+    if 'sampler' in cfg.onnx.models:
+        model = create_ddpm(cfg)
+        if cfg.model.scene_model.name == 'obj_bps':
+            sampler_pth, name = cfg.sampler_bps_ckpt_pth, 'bps'
+        else:
+            raise Exception('Unsupported scene model for onnx export, PointNet2 needs its custom CUDA ops.')
+        load_ckpt(model, path=sampler_pth)
+        model.eval()
+        export_sampler(model, cfg.onnx.output_dir, name, opset=cfg.onnx.opset)
+
+    if 'evaluator' in cfg.onnx.models:
+        evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+        load_ckpt(evaluator, path=cfg.evaluator_ckpt_pth)
+        evaluator.device = 'cpu'
+        evaluator.eval()
+        export_evaluator(evaluator, cfg.onnx.output_dir, opset=cfg.onnx.opset, d_x=cfg.model.d_x)
+
+    logger.info('done!')
+
+if __name__ == '__main__':
+    main()
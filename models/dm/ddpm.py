@@ -1,12 +1,17 @@
-from typing import Dict, Tuple
+from typing import Dict, Generator, List, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from omegaconf import DictConfig
 from utils.handmodel import angle_denormalize, trans_denormalize
-from models.dm.schedule import make_schedule_ddpm
+from models.dm.schedule import make_schedule_ddpm, make_coef_pack, COEF, COEF_PACK_KEYS
+from models.dm.solver import create_solver
+from models.dm.rng import sample_seeds, counter_randn
+from models.dm.distillation import halving_timesteps
 import numpy as np
 from utils.rot6d import robust_compute_rotation_matrix_from_ortho6d, compute_pitch
+from models.model.utils import params_version
+from models.model.denoise_step import compile_denoise_step
 
 # @DIFFUSER.register()
 class DDPM(nn.Module):
@@ -17,11 +22,30 @@ class DDPM(nn.Module):
         self.timesteps = cfg.diffuser.steps
         self.schedule_cfg = cfg.diffuser.schedule_cfg
         self.rand_t_type = cfg.diffuser.rand_t_type
+        self.solver = cfg.diffuser.get('solver', 'ddpm') # 'ddpm', 'ddim', 'dpmsolver++2m', 'dpmsolver++3m' or 'heun'
+        self.sample_steps = cfg.diffuser.get('sample_steps', None) # None uses all diffusion steps
+        self.eta = cfg.diffuser.get('eta', 0.0) # stochasticity of ddim, 0 is deterministic
+        self.micro_batch = cfg.diffuser.get('micro_batch', None) # None samples all k samples in one batch
+        self.timestep_spacing = cfg.diffuser.get('timestep_spacing', 'linspace') # 'linspace' or 'halving' for distilled students
+        self.mode = cfg.diffuser.get('mode', 'diffusion') # 'diffusion', or 'consistency' for consistency models
+        self.consistency_steps = cfg.diffuser.get('consistency_steps', 1) # network evaluations of consistency sampling
+        self.early_stop_tol = cfg.diffuser.get('early_stop_tol', None) # None walks all steps for every sample
+        self.early_stop_patience = cfg.diffuser.get('early_stop_patience', 2)
+        self.compile = cfg.diffuser.get('compile', False) # run the eval-time denoising step as a compiled module
+        self.compile_backend = cfg.diffuser.get('compile_backend', 'script') # 'script', 'inductor' or 'eager'
 
         self.has_observation = has_obser # used in some task giving observation
 
         for k, v in make_schedule_ddpm(self.timesteps, **self.schedule_cfg).items():
             self.register_buffer(k, v)
+        ## coefficient pack of all timesteps, rebuilt when the schedule buffers change, e.g., loaded or moved
+        self._coef_pack = None
+        self._coef_rows = None
+        self._coef_pack_version = None
+        ## compiled denoising step, rebuilt when the weights of eps_model change
+        self._denoise_step = None
+        self._denoise_step_ts = None
+        self._denoise_step_version = None
         
         if cfg.diffuser.loss_type == 'l1':
             self.criterion = F.l1_loss
@@ -37,7 +61,64 @@ class DDPM(nn.Module):
     @property
     def device(self):
         return self.betas.device
+
+    def coef_pack(self) -> torch.Tensor:
+        """ Per-timestep coefficients stacked into one tensor, so one gather serves a whole step
+
+        Return:
+            Coefficient pack, <T, K>, the columns are indexed by `COEF`
+        """
+        schedule = {k: getattr(self, k) for k in ['betas'] + [k for k in COEF_PACK_KEYS if not k.startswith('step_')]}
+        version = params_version(*schedule.values())
+        if self._coef_pack_version != version:
+            self._coef_pack = make_coef_pack(schedule)
+            ## python floats of every row, the scalar timestep path needs no tensor indexing
+            self._coef_rows = self._coef_pack.tolist()
+            self._coef_pack_version = version
+        return self._coef_pack
+
+    def coef_row(self, t: int) -> List[float]:
+        """ Coefficients of an int timestep as python floats, indexed by `COEF`
+        """
+        self.coef_pack()
+        return self._coef_rows[t]
+
+    def gather_coefs(self, t: torch.Tensor, ndim: int) -> torch.Tensor:
+        """ Coefficients of a batch of timesteps, broadcastable to a batch of data with `ndim` dimensions
+
+        Return:
+            Coefficients, <B, K, 1, ...>, e.g. `coefs[:, COEF['posterior_variance']]` is <B, 1, ...>
+        """
+        coefs = self.coef_pack()[t]
+        return coefs.reshape(*coefs.shape, *((1, ) * (ndim - 1)))
     
+    def denoise_step(self) -> nn.Module:
+        """ Compiled denoising step of eps_model, see `models/model/denoise_step.py`, built on the first
+        call and rebuilt when the weights of eps_model change
+
+        Return:
+            Module computing the predicted noise of `(x_t, ts, cond_cache)`
+        """
+        version = params_version(*self.eps_model.parameters())
+        if self._denoise_step_version != version:
+            self._denoise_step = compile_denoise_step(self.eps_model, self.compile_backend)
+            ## 1-element timestep tensors are sliced from one arange, so no tensor is created per step
+            self._denoise_step_ts = torch.arange(self.timesteps, device=self.device)
+            self._denoise_step_version = version
+        return self._denoise_step
+
+    def eps_predict(self, x_t: torch.Tensor, t: torch.Tensor, cond: torch.Tensor, cond_cache: List=None) -> torch.Tensor:
+        """ Noise prediction of eps_model, through the compiled denoising step if `compile` is set and
+        the step is an eval-time one, i.e., an int timestep with the condition cache
+        """
+        if self.compile and not self.training and isinstance(t, int) and cond_cache is not None:
+            step = self._denoise_step if self._denoise_step is not None else self.denoise_step()
+            pred_noise = step(x_t, self._denoise_step_ts[t:t + 1], cond_cache)
+        else:
+            pred_noise = self.eps_model(x_t, t, cond, cond_cache)
+        ## under autocast, the schedule math on the prediction stays in the dtype of x_t
+        return pred_noise.to(x_t.dtype)
+
     def apply_observation(self, x_t: torch.Tensor, data: Dict) -> torch.Tensor:
         """ Apply observation to x_t, if self.has_observation if False, this method will return the input
 
@@ -47,14 +128,16 @@ class DDPM(nn.Module):
         """
         ## has start observation, used in path planning and start-conditioned motion generation
         if self.has_observation and 'start' in data:
+            ## x_t may hold k samples per observation folded into the batch, <k * B, T, D>
+            x_view = x_t.view(-1, data['start'].shape[0], *x_t.shape[1:])
             start = data['start'] # <B, T, D>
             T = start.shape[1]
-            x_t[:, 0:T, :] = start[:, 0:T, :].clone()
+            x_view[:, :, 0:T, :] = start[:, 0:T, :].clone()
         
             if 'obser' in data:
                 obser = data['obser']
                 O = obser.shape[1]
-                x_t[:, T:T+O, :] = obser.clone()
+                x_view[:, :, T:T+O, :] = obser.clone()
         
         return x_t
     
@@ -72,9 +155,8 @@ class DDPM(nn.Module):
         Return:
             Diffused samples
         """
-        B, *x_shape = x0.shape
-        x_t = self.sqrt_alphas_cumprod[t].reshape(B, *((1, ) * len(x_shape))) * x0 + \
-            self.sqrt_one_minus_alphas_cumprod[t].reshape(B, *((1, ) * len(x_shape))) * noise
+        coefs = self.gather_coefs(t, x0.dim())
+        x_t = coefs[:, COEF['sqrt_alphas_cumprod']] * x0 + coefs[:, COEF['sqrt_one_minus_alphas_cumprod']] * noise
 
         return x_t
 
@@ -112,7 +194,7 @@ class DDPM(nn.Module):
 
         ## predict noise
         condtion = self.eps_model.condition(data)
-        output = self.eps_model(x_t, ts, condtion)
+        output = self.eps_model(x_t, ts, condtion).to(x_t.dtype) # the loss is computed in float32 under autocast
         ## apply observation after forwarding to eps model
         ## this operation will detach gradient from the loss of the observation tokens
         ## because the target and output of the observation tokens all are constants
@@ -123,28 +205,32 @@ class DDPM(nn.Module):
 
         return {'loss': loss}
     
-    def model_predict(self, x_t: torch.Tensor, t: torch.Tensor, cond: torch.Tensor) -> Tuple:
+    def model_predict(self, x_t: torch.Tensor, t: torch.Tensor, cond: torch.Tensor, cond_cache: List=None) -> Tuple:
         """ Get and process model prediction
 
         $x_0 = \frac{1}{\sqrt{\bar{\alpha}_t}}(x_t - \sqrt{1 - \bar{\alpha}_t}\epsilon_t)$
 
         Args:
             x_t: denoised sample at timestep t
-            t: denoising timestep
+            t: denoising timestep, 1-D batch of timesteps or an int timestep shared by the whole batch
             cond: condition tensor
+            cond_cache: precomputed cross-attention keys and values of the condition
         
         Return:
             The predict target `(pred_noise, pred_x0)`, currently we predict the noise, which is as same as DDPM
         """
-        B, *x_shape = x_t.shape
-
-        pred_noise = self.eps_model(x_t, t, cond)
-        pred_x0 = self.sqrt_recip_alphas_cumprod[t].reshape(B, *((1, ) * len(x_shape))) * x_t - \
-            self.sqrt_recipm1_alphas_cumprod[t].reshape(B, *((1, ) * len(x_shape))) * pred_noise
+        pred_noise = self.eps_predict(x_t, t, cond, cond_cache)
+        if isinstance(t, int):
+            ## timestep shared by the whole batch
+            coefs = self.coef_row(t)
+            pred_x0 = (x_t * coefs[COEF['sqrt_recip_alphas_cumprod']]).sub_(pred_noise, alpha=coefs[COEF['sqrt_recipm1_alphas_cumprod']])
+        else:
+            coefs = self.gather_coefs(t, x_t.dim())
+            pred_x0 = coefs[:, COEF['sqrt_recip_alphas_cumprod']] * x_t - coefs[:, COEF['sqrt_recipm1_alphas_cumprod']] * pred_noise
 
         return pred_noise, pred_x0
     
-    def p_mean_variance(self, x_t: torch.Tensor, t: torch.Tensor, cond: torch.Tensor) -> Tuple:
+    def p_mean_variance(self, x_t: torch.Tensor, t: torch.Tensor, cond: torch.Tensor, cond_cache: List=None) -> Tuple:
         """ Calculate the mean and variance, we adopt the following first equation.
 
         $\tilde{\mu} = \frac{\sqrt{\alpha_t}(1-\bar{\alpha}_{t-1})}{1-\bar{\alpha}_t}x_t + \frac{\sqrt{\bar{\alpha}_{t-1}}\beta_t}{1 - \bar{\alpha}_t}x_0$
@@ -154,24 +240,48 @@ class DDPM(nn.Module):
             x_t: denoised sample at timestep t
             t: denoising timestep
             cond: condition tensor
+            cond_cache: precomputed cross-attention keys and values of the condition
         
         Return:
             (model_mean, posterior_variance, posterior_log_variance)
         """
-        B, *x_shape = x_t.shape
-
         ## predict noise and x0 with model $p_\theta$
-        pred_noise, pred_x0 = self.model_predict(x_t, t, cond)
+        pred_noise, pred_x0 = self.model_predict(x_t, t, cond, cond_cache)
 
         ## calculate mean and variance
-        model_mean = self.posterior_mean_coef1[t].reshape(B, *((1, ) * len(x_shape))) * pred_x0 + \
-            self.posterior_mean_coef2[t].reshape(B, *((1, ) * len(x_shape))) * x_t
-        posterior_variance = self.posterior_variance[t].reshape(B, *((1, ) * len(x_shape)))
-        posterior_log_variance = self.posterior_log_variance_clipped[t].reshape(B, *((1, ) * len(x_shape))) # clipped variance
+        coefs = self.gather_coefs(t, x_t.dim())
+        model_mean = coefs[:, COEF['posterior_mean_coef1']] * pred_x0 + coefs[:, COEF['posterior_mean_coef2']] * x_t
+        posterior_variance = coefs[:, COEF['posterior_variance']]
+        posterior_log_variance = coefs[:, COEF['posterior_log_variance_clipped']] # clipped variance
 
         return model_mean, posterior_variance, posterior_log_variance
     
-    def cond_fn(self, x_t, t, obj_bps, evaluator, guid_scale):
+    def use_guidance(self, t: int, guid_param: Dict=None) -> bool:
+        """ Whether evaluator guidance is applied at timestep t
+
+        Args:
+            t: denoising timestep
+            guid_param: evaluator and guidance scale, optionally with a guidance schedule, 'guid_timesteps' lists
+                the guided timesteps and 'guid_last_steps' guides only the timesteps t < guid_last_steps
+
+        Return:
+            True if the evaluator gradient is applied at timestep t
+        """
+        if guid_param is None:
+            return False
+        if guid_param.get('guid_timesteps', None) is not None and t not in guid_param['guid_timesteps']:
+            return False
+        if guid_param.get('guid_last_steps', None) is not None and t >= guid_param['guid_last_steps']:
+            return False
+        return True
+
+    def guidance_grad(self, x_t: torch.Tensor, t: int, data: Dict, guid_param: Dict) -> torch.Tensor:
+        """ Evaluator gradient at timestep t, using the precomputed BPS features of the evaluator if available
+        """
+        return self.cond_fn(x_t, t, data['obj_bps'], guid_param['evaluator'], guid_param['guid_scale'],
+                            obj_bps_feat=data.get('obj_bps_feat', None))
+
+    def cond_fn(self, x_t, t, obj_bps, evaluator, guid_scale, obj_bps_feat=None):
         
         # x_c = x_t.clone()
         # if self.normalize_x:
@@ -188,17 +298,28 @@ class DDPM(nn.Module):
         #     # Concatenate the trans-denormalized part with the rest of x_t_clone
         #     x_t = torch.cat([trans_denormalized_part, x_t[:, 3:]], dim=1)
         
+        ## the k samples folded into the batch share the object features of the B conditions
+        if obj_bps_feat is not None:
+            if obj_bps_feat[0][0].shape[0] != x_t.shape[0]:
+                n = x_t.shape[0] // obj_bps_feat[0][0].shape[0]
+                obj_bps_feat = [tuple(feat.repeat(n, 1) for feat in feats) for feats in obj_bps_feat]
+            evaluator_data = {'obj_bps_feat': obj_bps_feat}
+        else:
+            if obj_bps.shape[0] != x_t.shape[0]:
+                obj_bps = obj_bps.repeat(x_t.shape[0] // obj_bps.shape[0], 1)
+            evaluator_data = {'obj_bps': obj_bps}
+
         with torch.enable_grad():
             x_in = x_t.detach().requires_grad_(True)
             p_success = evaluator({'x_t':x_in,
-                                   'obj_bps':obj_bps})['p_success']
+                                   **evaluator_data})['p_success']
             p_success_clip = torch.clamp(p_success, 1e-5, 1-1e-5)
             c_energy = torch.mean(torch.log(p_success_clip)) * guid_scale * np.log(self.timesteps - t + 1)
             
         return torch.autograd.grad(c_energy, x_in)[0]
 
     @torch.no_grad()
-    def p_sample(self, x_t: torch.Tensor, t: int, data: Dict, guid_param:Dict=None) -> torch.Tensor:
+    def p_sample(self, x_t: torch.Tensor, t: int, data: Dict, guid_param:Dict=None, return_pred_x0: bool=False) -> torch.Tensor:
         """ One step of reverse diffusion process
 
         $x_{t-1} = \tilde{\mu} + \sqrt{\tilde{\beta}} * z$
@@ -207,76 +328,422 @@ class DDPM(nn.Module):
             x_t: denoised sample at timestep t
             t: denoising timestep
             data: data dict that provides original data and computed conditional feature
+            return_pred_x0: also return the predicted x0 of the network
 
         Return:
-            Predict data in the previous step, i.e., $x_{t-1}$
+            Predict data in the previous step, i.e., $x_{t-1}$, and the predicted x0 if `return_pred_x0`
         """
-        B, *_ = x_t.shape
-        batch_timestep = torch.full((B, ), t, device=self.device, dtype=torch.long)
-
         if 'cond' in data:
             ## use precomputed conditional feature
             cond = data['cond']
         else:
             ## recompute conditional feature every sampling step
             cond = self.eps_model.condition(data)
-        model_mean, model_variance, model_log_variance = self.p_mean_variance(x_t, batch_timestep, cond)
-        
-        noise = torch.randn_like(x_t) if t > 0 else 0. # no noise if t == 0
-
-        if guid_param is not None:
-            model_mean = model_mean + self.cond_fn(x_t, t, data['obj_bps'], guid_param['evaluator'], guid_param['guid_scale']) * model_variance
-        pred_x = model_mean + (0.5 * model_log_variance).exp() * noise
 
+        ## the mean and the noise of the step are fused into one affine map with python float coefficients
+        ## $x_{t-1} = a_t x_t + b_t \epsilon_t + \sqrt{\tilde{\beta}} z$, see `make_coef_pack`
+        coefs = self.coef_row(t)
+        pred_noise = self.eps_predict(x_t, t, cond, data.get('cond_cache', None))
+        if return_pred_x0:
+            ## taken before the noise buffer is reused in place
+            pred_x0 = (x_t * coefs[COEF['sqrt_recip_alphas_cumprod']]).sub_(pred_noise, alpha=coefs[COEF['sqrt_recipm1_alphas_cumprod']])
+        pred_x = pred_noise.mul_(coefs[COEF['step_eps_coef']]).add_(x_t, alpha=coefs[COEF['step_x_coef']])
+        if t > 0:
+            pred_x.add_(self.noise_like(x_t, t + 1, data), alpha=coefs[COEF['step_std']]) # no noise if t == 0
+        if self.use_guidance(t, guid_param):
+            pred_x.add_(self.guidance_grad(x_t, t, data, guid_param), alpha=coefs[COEF['posterior_variance']])
+
+        if return_pred_x0:
+            return pred_x, pred_x0
         return pred_x
 
+    def guided_predict(self, x_t: torch.Tensor, t: int, data: Dict, guid_param: Dict=None) -> Tuple:
+        """ Model prediction at an integer timestep shared by the whole batch, used by the strided solvers.
+        Evaluator guidance is applied on the predicted noise, i.e., as a correction of the score.
+
+        Args:
+            x_t: denoised sample at timestep t
+            t: denoising timestep
+            data: data dict that provides original data and computed conditional feature
+            guid_param: evaluator and guidance scale used for evaluator-guided sampling
+
+        Return:
+            The predict target `(pred_noise, pred_x0)`
+        """
+        if 'cond' in data:
+            cond = data['cond']
+        else:
+            cond = self.eps_model.condition(data)
+        pred_noise, pred_x0 = self.model_predict(x_t, t, cond, data.get('cond_cache', None))
+
+        if self.use_guidance(t, guid_param):
+            ## shift the predicted noise with the evaluator score, then recompute x0 accordingly
+            alpha_bar = self.alphas_cumprod[t]
+            grad = self.guidance_grad(x_t, t, data, guid_param)
+            pred_noise = pred_noise - (1 - alpha_bar).sqrt() * grad
+            pred_x0 = (x_t - (1 - alpha_bar).sqrt() * pred_noise) / alpha_bar.sqrt()
+
+        return pred_noise, pred_x0
+
     @torch.no_grad()
-    def p_sample_loop(self, data: Dict, guid_param: Dict = None) -> torch.Tensor:
-        """ Reverse diffusion process loop, iteratively sampling
+    def ddim_sample(self, x_t: torch.Tensor, t: int, t_prev: int, data: Dict, eta: float=0., guid_param: Dict=None,
+                    return_pred_x0: bool=False) -> torch.Tensor:
+        """ One step of DDIM reverse process, jumping from timestep t to an earlier timestep t_prev
+
+        $x_{t'} = \sqrt{\bar{\alpha}_{t'}}x_0 + \sqrt{1 - \bar{\alpha}_{t'} - \sigma_t^2}\epsilon_t + \sigma_t z$
 
         Args:
-            data: test data, data['x'] gives the target data shape
+            x_t: denoised sample at timestep t
+            t: denoising timestep
+            t_prev: target timestep, -1 denotes the clean sample
+            data: data dict that provides original data and computed conditional feature
+            eta: stochasticity, 0 gives deterministic DDIM and 1 recovers the DDPM posterior variance
+            return_pred_x0: also return the predicted x0
+
+        Return:
+            Predict data in timestep t_prev, and the predicted x0 if `return_pred_x0`
+        """
+        pred_noise, pred_x0 = self.guided_predict(x_t, t, data, guid_param)
+
+        alpha_bar = self.alphas_cumprod[t]
+        alpha_bar_prev = self.alphas_cumprod[t_prev] if t_prev >= 0 else torch.ones_like(alpha_bar)
+
+        sigma = eta * ((1 - alpha_bar_prev) / (1 - alpha_bar) * (1 - alpha_bar / alpha_bar_prev)).sqrt()
+        dir_x_t = (1 - alpha_bar_prev - sigma ** 2).clamp(min=0).sqrt() * pred_noise
+        noise = self.noise_like(x_t, t + 1, data) if t_prev >= 0 else 0. # no noise for the last step
+
+        x_prev = alpha_bar_prev.sqrt() * pred_x0 + dir_x_t + sigma * noise
+        if return_pred_x0:
+            return x_prev, pred_x0
+        return x_prev
+
+    def make_timesteps(self, steps: int=None) -> List[int]:
+        """ Strided subset of the diffusion timesteps used for sampling, in descending order
+
+        Args:
+            steps: number of sampling steps, None uses all diffusion steps
         
         Return:
-            Sampled data, <B, T, ...>
+            Timesteps to visit, always starting at the last diffusion step
+        """
+        if steps is None or steps >= self.timesteps:
+            return list(reversed(range(0, self.timesteps)))
+        assert steps > 0, 'Sampling steps must be positive.'
+
+        if self.timestep_spacing == 'linspace':
+            ts = np.linspace(0, self.timesteps - 1, steps).round().astype(np.int64)
+            return sorted(set(ts.tolist()), reverse=True)
+        elif self.timestep_spacing == 'halving':
+            ## every other timestep of the grid with twice the steps, the grids of progressive distillation
+            return halving_timesteps(self.timesteps, steps)
+        else:
+            raise Exception('Unsupported timestep spacing.')
+
+    def consistency_timesteps(self, steps: int=None) -> List[int]:
+        """ Timesteps of multistep consistency sampling, the first step starts at the last diffusion step
+
+        Args:
+            steps: number of sampling steps, i.e., network evaluations, 1 maps the noise to x0 in one step
+        
+        Return:
+            Timesteps to visit, e.g., [99] for one step and [99, 50] for two steps of 100 diffusion steps
+        """
+        steps = min(self.consistency_steps if steps is None else steps, self.timesteps)
+        assert steps > 0, 'Sampling steps must be positive.'
+
+        ts = np.linspace(self.timesteps - 1, 0, steps + 1)[:-1].round().astype(np.int64)
+        return ts.tolist()
+
+    def noise_like(self, x: torch.Tensor, counter: int, data: Dict) -> torch.Tensor:
+        """ Gaussian noise of the sampling loop, drawn from the per-sample seeds data['noise_seeds'] if given,
+        see `models/dm/rng.py`, otherwise from the global RNG
+
+        Args:
+            x: sample of the folded batch, gives the shape, dtype and device of the noise
+            counter: index of the draw, 0 for the initial noise and t + 1 for the noise added at timestep t
+            data: data dict of the sampling loop
+
+        Return:
+            Noise, the same shape as x
         """
+        if 'noise_seeds' in data:
+            return counter_randn(data['noise_seeds'], counter, x.shape[1:], x.dtype)
+        return torch.randn_like(x)
+
+    def init_sample(self, data: Dict, guid_param: Dict = None, k: int = 1, k_offset: int = 0) -> torch.Tensor:
+        """ Draw the initial noise of k samples per condition and precompute the step-invariant features
 
+        Args:
+            data: test data, data['x'] gives the target data shape, the condition feature, its cross-attention
+                keys and values, and the BPS features of the evaluator if reused, are added to it;
+                data['seed'] <B>, e.g., from `rng.condition_seeds`, seeds the noise of every sample from its
+                condition and sample index, so a sample does not depend on the batch it is sampled in
+            guid_param: evaluator and guidance scale used for evaluator-guided sampling
+            k: the number of samples per condition, folded into the batch as <k * B, ...> with the sample index
+                as the outer dimension, the condition is computed once for the B inputs and shared by the k samples
+            k_offset: sample index of the first of the k samples, only used with data['seed']
+
+        Return:
+            Initial noise, <k * B, ...>
+        """
         # TODO: add classifier, remember the forward kinematic and denormalization, also check the gradient pass
-        x_t = torch.randn_like(data['x'], device=self.device)
+        x_t = torch.empty((k * data['x'].shape[0], *data['x'].shape[1:]), dtype=data['x'].dtype, device=self.device)
+        if 'seed' in data:
+            data['noise_seeds'] = sample_seeds(torch.as_tensor(data['seed'], device=self.device), k, k_offset)
+        x_t = self.noise_like(x_t, 0, data)
         ## apply observation to x_t
         x_t = self.apply_observation(x_t, data)
         
-        ## precompute conditional feature, which will be used in every sampling step
+        ## precompute conditional feature and its cross-attention keys and values, which will be used in every sampling step
         condition = self.eps_model.condition(data)
         data['cond'] = condition
+        data['cond_cache'] = self.eps_model.condition_cache(condition)
+        if self.compile:
+            ## refreshed once per loop, the steps use the built module
+            self.denoise_step()
+        ## obj_bps is fixed as well, so its products with the evaluator weights are computed once,
+        ## not for the quantized evaluators, whose layers can not be split
+        if guid_param is not None and guid_param.get('reuse_bps', False) and guid_param['evaluator'].can_split_bps():
+            data['obj_bps_feat'] = guid_param['evaluator'].bps_features(data['obj_bps'])
 
-        ## iteratively sampling
-        all_x_t = [x_t]
-        for t in reversed(range(0, self.timesteps)):
-            x_t = self.p_sample(x_t, t, data, guid_param)
+        return x_t
+
+    def compact_condition(self, data: Dict, rows: torch.Tensor) -> Dict:
+        """ Step-invariant condition data of a subset of the rows of the folded batch, row r uses condition r % B
+
+        Args:
+            data: data dict with the precomputed features of `init_sample`, of B conditions
+            rows: kept rows of the folded batch
+
+        Return:
+            Data dict of one condition per kept row
+        """
+        B = data['cond'].shape[0]
+        idx = rows % B
+        out = dict(data)
+        out['cond'] = data['cond'][idx]
+        ## per-head keys and values, <(B h), n, d>
+        out['cond_cache'] = [[tuple(t.unflatten(0, (B, -1))[idx].flatten(0, 1) for t in kv) for kv in block]
+                             for block in data['cond_cache']]
+        if 'obj_bps' in data:
+            out['obj_bps'] = data['obj_bps'][idx]
+        if 'noise_seeds' in data:
+            ## one seed per row
+            out['noise_seeds'] = data['noise_seeds'][rows]
+        if 'obj_bps_feat' in data:
+            out['obj_bps_feat'] = [tuple(f[idx] for f in feat) for feat in data['obj_bps_feat']]
+        return out
+
+    def iter_steps(self, x_t: torch.Tensor, data: Dict, guid_param: Dict = None, solver: str = None, steps: int = None,
+                   eta: float = None, stride: int = None, mode: str = None, early_stop_tol: float = None) -> Generator:
+        """ Reverse diffusion steps from the initial noise of `init_sample`, see `iter_sample` for the arguments,
+        the number of network evaluations of every sample is kept in data['nfe']
+
+        Yields:
+            `(t, x_t, pred_x0)` every `stride`-th step and at the last step, None only yields the last step
+        """
+        mode = self.mode if mode is None else mode
+        if mode == 'diffusion':
+            solver = self.solver if solver is None else solver
+            steps = self.sample_steps if steps is None else steps
+        elif mode == 'consistency':
+            solver = 'consistency'
+        else:
+            raise Exception('Unsupported sampling mode.')
+        eta = self.eta if eta is None else eta
+        early_stop_tol = self.early_stop_tol if early_stop_tol is None else early_stop_tol
+
+        if solver == 'ddpm':
+            timesteps, strided_solver = list(reversed(range(0, self.timesteps))), None
+        else:
+            timesteps = self.consistency_timesteps(steps) if solver == 'consistency' else self.make_timesteps(steps)
+            strided_solver = create_solver(solver, timesteps, eta)
+        if early_stop_tol is not None:
+            yield from self.iter_steps_early_stop(x_t, data, guid_param, timesteps, strided_solver, stride, early_stop_tol)
+            return
+        data['nfe'] = torch.full((x_t.shape[0], ), len(timesteps) if strided_solver is None else strided_solver.nfe, device=self.device)
+
+        n = len(timesteps)
+        for i, t in enumerate(timesteps):
+            keep = i == n - 1 or (stride is not None and (i + 1) % stride == 0)
+            if strided_solver is None:
+                ## the predicted x0 is only computed for the yielded steps
+                out = self.p_sample(x_t, t, data, guid_param, return_pred_x0=keep)
+                x_t, pred_x0 = out if keep else (out, None)
+            else:
+                x_t = strided_solver.step(self, x_t, i, data, guid_param)
+                pred_x0 = strided_solver.pred_x0
             ## apply observation to x_t
             x_t = self.apply_observation(x_t, data)
-            
+
+            if keep:
+                yield t, x_t, pred_x0
+
+    def iter_steps_early_stop(self, x_t: torch.Tensor, data: Dict, guid_param: Dict, timesteps: List[int], strided_solver,
+                              stride: int, tol: float) -> Generator:
+        """ Reverse diffusion steps that freeze the samples whose predicted x0 has converged, i.e., changed by less
+        than `tol` (max abs) over `early_stop_patience` consecutive steps. A frozen sample is set to its predicted x0,
+        and the remaining steps only run on the compacted batch of the unfinished samples.
+
+        Yields:
+            `(t, x_t, pred_x0)` of the whole batch as `iter_steps`, the frozen rows keep their final values
+        """
+        if self.has_observation:
+            raise Exception('Unsupported early stop with observation.')
+        N = x_t.shape[0]
+        active = torch.arange(N, device=x_t.device)
+        x_full, x0_full = x_t.clone(), torch.zeros_like(x_t)
+        nfe = torch.zeros(N, dtype=torch.long, device=x_t.device)
+        stable = torch.zeros(N, dtype=torch.long, device=x_t.device)
+        prev_x0 = None
+        step_data = data
+
+        n = len(timesteps)
+        for i, t in enumerate(timesteps):
+            if strided_solver is None:
+                x_t, pred_x0 = self.p_sample(x_t, t, step_data, guid_param, return_pred_x0=True)
+                nfe[active] += 1
+            else:
+                x_t = strided_solver.step(self, x_t, i, step_data, guid_param)
+                pred_x0 = strided_solver.pred_x0
+                nfe[active] += strided_solver.nfe_per_step if i < n - 1 else 1
+
+            if prev_x0 is not None:
+                delta = (pred_x0 - prev_x0).flatten(1).abs().amax(dim=1)
+                stable = torch.where(delta < tol, stable + 1, torch.zeros_like(stable))
+            prev_x0 = pred_x0
+
+            done = stable >= self.early_stop_patience
+            last = i == n - 1 or bool(done.all())
+            if not last and bool(done.any()):
+                ## converged samples are frozen at their predicted x0, the others go on in a compacted batch
+                x_full[active[done]] = pred_x0[done]
+                x0_full[active[done]] = pred_x0[done]
+                keep = (~done).nonzero()[:, 0]
+                active, x_t, prev_x0, stable = active[keep], x_t[keep], prev_x0[keep], stable[keep]
+                step_data = self.compact_condition(step_data, keep)
+                if strided_solver is not None:
+                    strided_solver.compact(keep)
+
+            if last or (stride is not None and (i + 1) % stride == 0):
+                if last:
+                    ## all samples left are converged or at the clean sample
+                    x_full[active] = pred_x0 if i < n - 1 else x_t
+                else:
+                    x_full[active] = x_t
+                x0_full[active] = prev_x0
+                yield t, x_full.clone(), x0_full.clone()
+            if last:
+                break
+
+        data['nfe'] = nfe
+
+    @torch.no_grad()
+    def iter_sample(self, data: Dict, guid_param: Dict = None, solver: str = None, steps: int = None, eta: float = None,
+                    stride: int = 1, k: int = 1, mode: str = None, early_stop_tol: float = None, k_offset: int = 0) -> Generator:
+        """ Reverse diffusion process as a generator, so that the intermediate samples and predicted x0 can be
+        consumed while sampling, e.g., scored early or visualized, without keeping the trajectory.
+        Breaking out of the loop stops the sampling.
+
+        Args:
+            data: test data, data['x'] gives the target data shape
+            guid_param: evaluator and guidance scale used for evaluator-guided sampling, see `p_sample_loop`
+            solver: sampling solver, defaults to `cfg.diffuser.solver`
+            steps: number of sampling steps, defaults to `cfg.diffuser.sample_steps`
+            eta: stochasticity of ddim, defaults to `cfg.diffuser.eta`
+            stride: yield every `stride`-th sampling step, the last step is always yielded, None only yields the last step
+            k: the number of samples per condition, folded into the batch as in `p_sample_loop`
+            mode: 'diffusion' or 'consistency', defaults to `cfg.diffuser.mode`
+            early_stop_tol: freeze the samples whose predicted x0 has converged, see `iter_steps_early_stop`,
+                defaults to `cfg.diffuser.early_stop_tol`, None walks all steps
+            k_offset: sample index of the first of the k samples, see `init_sample`
+
+        Yields:
+            `(t, x_t, pred_x0)`, the timestep of the step, the sample after the step and the predicted x0 at t,
+            each sample is <k * B, ...>, the final sample is yielded with t = 0 for 'ddpm'
+        """
+        x_t = self.init_sample(data, guid_param, k, k_offset)
+        yield from self.iter_steps(x_t, data, guid_param, solver, steps, eta, stride, mode, early_stop_tol)
+
+    @torch.no_grad()
+    def p_sample_loop(self, data: Dict, guid_param: Dict = None, solver: str = None, steps: int = None, eta: float = None,
+                      return_trajectory: bool = False, trajectory_stride: int = 1, k: int = 1, mode: str = None,
+                      early_stop_tol: float = None, k_offset: int = 0) -> torch.Tensor:
+        """ Reverse diffusion process loop, iteratively sampling
+
+        Args:
+            data: test data, data['x'] gives the target data shape
+            guid_param: evaluator and guidance scale used for evaluator-guided sampling, see `use_guidance` for the
+                guidance schedule, 'reuse_bps' precomputes the BPS features of the evaluator once for the whole loop
+            solver: 'ddpm' walks all diffusion steps, the others ('ddim', 'dpmsolver++2m', 'dpmsolver++3m', 'heun')
+                walk a strided subset of them, see `models/dm/solver.py`
+            steps: number of sampling steps of the strided solvers
+            eta: stochasticity of ddim
+            return_trajectory: keep the intermediate samples, otherwise only the final sample is kept
+            trajectory_stride: keep every `trajectory_stride`-th sampling step of the trajectory, the final sample is always kept
+            k: the number of samples per condition, folded into the batch as <k * B, ...> with the sample index
+                as the outer dimension, the condition is computed once for the B inputs and shared by the k samples
+            mode: 'diffusion' samples with `solver`, 'consistency' samples a consistency model in `steps` network
+                evaluations, defaults to `cfg.diffuser.mode`
+            early_stop_tol: freeze the samples whose predicted x0 has converged and go on with the others only, see
+                `iter_steps_early_stop`, defaults to `cfg.diffuser.early_stop_tol`, None walks all steps for every sample
+            k_offset: sample index of the first of the k samples, with data['seed'] the noise of every sample is drawn
+                from the seed of its condition and its sample index, see `init_sample`
+        
+        Return:
+            Sampled data, <k * B, T, ...>, T is 1 if the trajectory is not returned,
+            the network evaluations of every sample are kept in data['nfe'], <k * B>
+        """
+        x_t = self.init_sample(data, guid_param, k, k_offset)
+
+        ## iteratively sampling, only the kept steps of the trajectory are stored
+        all_x_t = [x_t] if return_trajectory else []
+        stride = trajectory_stride if return_trajectory else None
+        for _, x_t, _ in self.iter_steps(x_t, data, guid_param, solver, steps, eta, stride, mode, early_stop_tol):
             all_x_t.append(x_t)
         return torch.stack(all_x_t, dim=1)
     
     @torch.no_grad()
-    def sample(self, data: Dict, k: int=1, guid_param: Dict = None) -> torch.Tensor:
+    def sample(self, data: Dict, k: int=1, guid_param: Dict = None, solver: str = None, steps: int = None, eta: float = None,
+               return_trajectory: bool = False, trajectory_stride: int = 1, micro_batch: int = None, mode: str = None,
+               early_stop_tol: float = None) -> torch.Tensor:
         """ Reverse diffusion process, sampling with the given data containing condition
         In this method, the sampled results are unnormalized and converted to absolute representation.
 
         Args:
-            data: test data, data['x'] gives the target data shape
+            data: test data, data['x'] gives the target data shape, data['seed'] <B> optionally seeds the noise of
+                every sample from its condition and sample index, see `models/dm/rng.py`
             k: the number of sampled data
+            guid_param: evaluator and guidance scale used for evaluator-guided sampling
+            solver: sampling solver, defaults to `cfg.diffuser.solver`
+            steps: number of sampling steps, defaults to `cfg.diffuser.sample_steps`
+            eta: stochasticity of ddim, defaults to `cfg.diffuser.eta`
+            return_trajectory: return the denoising trajectory instead of only the final sample
+            trajectory_stride: keep every `trajectory_stride`-th step of the returned trajectory
+            micro_batch: upper bound of the folded batch size k * B of one reverse diffusion loop, defaults to
+                `cfg.diffuser.micro_batch`, None samples all k samples in one loop
+            mode: 'diffusion', or 'consistency' to sample a consistency model in 1-2 steps, defaults to `cfg.diffuser.mode`
+            early_stop_tol: early stop of the converged samples, see `p_sample_loop`, defaults to `cfg.diffuser.early_stop_tol`
         
         Return:
-            Sampled results, the shape is <B, k, T, ...>
+            Sampled results, the shape is <B, k, T, ...>, the final sample is at T = -1,
+            the network evaluations of every sample are kept in data['nfe'], <B, k>
         """
-        ksamples = []
-        for _ in range(k):
-            ksamples.append(self.p_sample_loop(data, guid_param))
+        micro_batch = self.micro_batch if micro_batch is None else micro_batch
+        B = data['x'].shape[0]
+        kc = k if micro_batch is None else max(1, micro_batch // B)
+
+        ## the k samples are folded into the batch, at most kc samples per condition in one loop
+        ksamples, knfe = [], []
+        for k0 in range(0, k, kc):
+            kn = min(kc, k - k0)
+            samples = self.p_sample_loop(data, guid_param, solver, steps, eta, return_trajectory, trajectory_stride, k=kn, mode=mode,
+                                         early_stop_tol=early_stop_tol, k_offset=k0)
+            ksamples.append(samples.reshape(kn, B, *samples.shape[1:]))
+            knfe.append(data['nfe'].reshape(kn, B))
         
-        ksamples = torch.stack(ksamples, dim=1)
+        ksamples = torch.cat(ksamples, dim=0).transpose(0, 1)
+        data['nfe'] = torch.cat(knfe, dim=0).transpose(0, 1)
         
         ## for sequence, normalize and convert repr
         if 'normalizer' in data and data['normalizer'] is not None:
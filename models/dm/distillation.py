@@ -0,0 +1,153 @@
+from typing import Dict, List, Tuple
+import torch
+import torch.nn as nn
+
+
+def halving_stride(timesteps: int, steps: int) -> int:
+    """ Smallest power-of-two stride whose grid over the diffusion timesteps has at most `steps` steps
+    """
+    stride = 1
+    while (timesteps + stride - 1) // stride > steps:
+        stride *= 2
+    return stride
+
+def halving_timesteps(timesteps: int, steps: int) -> List[int]:
+    """ Timesteps T-1, T-1-s, T-1-2s, ... with the stride s of `halving_stride`, in descending order
+
+    Halving the number of steps keeps every other timestep, i.e., a student of progressive
+    distillation does one step where its teacher did two, e.g., 100 -> 50 -> 25 -> 13 -> 7 -> 4 steps
+    for 100 diffusion steps.
+    """
+    return list(range(timesteps - 1, -1, -halving_stride(timesteps, steps)))
+
+def gather_alpha_sigma(ddpm: nn.Module, t: torch.Tensor, ndim: int) -> Tuple:
+    """ sqrt(alpha_bar_t) and sqrt(1 - alpha_bar_t) of a batch of timesteps, t = -1 gives the clean sample
+
+    Return:
+        (alpha, sigma), each is <B, 1, ...> broadcastable to a batch of data with `ndim` dimensions
+    """
+    alpha_bar = torch.where(t >= 0, ddpm.alphas_cumprod[t.clamp(min=0)], torch.ones_like(ddpm.alphas_cumprod[0]))
+    alpha_bar = alpha_bar.reshape(-1, *((1, ) * (ndim - 1)))
+    return alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+
+@torch.no_grad()
+def teacher_ddim_step(teacher: nn.Module, x_t: torch.Tensor, t: torch.Tensor, t_prev: torch.Tensor, cond: torch.Tensor) -> torch.Tensor:
+    """ Deterministic DDIM step of the teacher from a batch of timesteps t to t_prev, rows with t = -1 are kept
+    """
+    alpha, sigma = gather_alpha_sigma(teacher, t, x_t.dim())
+    alpha_prev, sigma_prev = gather_alpha_sigma(teacher, t_prev, x_t.dim())
+
+    pred_noise = teacher.eps_model(x_t, t.clamp(min=0), cond)
+    pred_x0 = (x_t - sigma * pred_noise) / alpha
+    x_prev = alpha_prev * pred_x0 + sigma_prev * pred_noise
+
+    return torch.where((t >= 0).reshape(alpha.shape), x_prev, x_t)
+
+def progressive_distillation_loss(student: nn.Module, teacher: nn.Module, data: Dict, stride: int) -> Dict:
+    """ Progressive distillation loss (Salimans & Ho, 2022), one DDIM step of the student on the grid of
+    stride 2 * `stride` matches two DDIM steps of the teacher on the grid of stride `stride`
+
+    Args:
+        student: student DDPM, initialized from the teacher
+        teacher: teacher DDPM, sampling with `halving_timesteps` of stride `stride`
+        data: training data, data['x'] gives the target data
+        stride: timestep stride of the teacher grid
+
+    Return:
+        Computed loss
+    """
+    x0 = data['x']
+    B = x0.shape[0]
+    T = student.timesteps
+
+    ## random step of the student grid, t -> t'' in one student step or t -> t' -> t'' in two teacher steps
+    student_steps = len(range(T - 1, -1, -2 * stride))
+    t = T - 1 - 2 * stride * torch.randint(0, student_steps, (B, ), device=x0.device)
+    t_mid = (t - stride).clamp(min=-1)
+    t_prev = (t - 2 * stride).clamp(min=-1)
+
+    noise = torch.randn_like(x0)
+    x_t = student.q_sample(x0=x0, t=t, noise=noise)
+    x_t = student.apply_observation(x_t, data)
+
+    with torch.no_grad():
+        cond_teacher = teacher.eps_model.condition(data)
+        x_mid = teacher_ddim_step(teacher, x_t, t, t_mid, cond_teacher)
+        x_prev = teacher_ddim_step(teacher, x_mid, t_mid, t_prev, cond_teacher)
+
+        ## x0 and noise for which one DDIM step of the student lands on x_prev
+        alpha, sigma = gather_alpha_sigma(student, t, x0.dim())
+        alpha_prev, sigma_prev = gather_alpha_sigma(student, t_prev, x0.dim())
+        ratio = sigma_prev / sigma
+        target_x0 = (x_prev - ratio * x_t) / (alpha_prev - ratio * alpha)
+        target_noise = (x_t - alpha * target_x0) / sigma
+
+    output = student.eps_model(x_t, t, student.eps_model.condition(data))
+    output = student.apply_observation(output, data)
+    target_noise = student.apply_observation(target_noise, data)
+
+    loss = student.criterion(output, target_noise)
+
+    return {'loss': loss}
+
+def consistency_function(ddpm: nn.Module, x_t: torch.Tensor, t: torch.Tensor, cond: torch.Tensor) -> torch.Tensor:
+    """ Consistency function f(x_t, t) as the predicted x0 of the noise prediction model, it is
+    the identity at t = -1, i.e., the boundary condition of consistency models holds by construction
+    """
+    alpha, sigma = gather_alpha_sigma(ddpm, t, x_t.dim())
+    pred_noise = ddpm.eps_model(x_t, t.clamp(min=0), cond)
+    pred_x0 = (x_t - sigma * pred_noise) / alpha
+
+    return torch.where((t >= 0).reshape(alpha.shape), pred_x0, x_t)
+
+def consistency_loss(student: nn.Module, target: nn.Module, data: Dict, stride: int, teacher: nn.Module=None) -> Dict:
+    """ Consistency distillation loss, or consistency training loss without a teacher (Song et al., 2023)
+
+    The student at timestep t and the EMA target at the adjacent timestep t - `stride` must predict
+    the same x0. x_{t - stride} is a DDIM step of the teacher from x_t, or, without a teacher, the
+    diffused x0 with the same noise as x_t.
+
+    Args:
+        student: consistency model being trained
+        target: EMA of the student
+        data: training data, data['x'] gives the target data
+        stride: timestep stride of the discretization
+        teacher: pretrained DDPM for consistency distillation, None for consistency training
+
+    Return:
+        Computed loss
+    """
+    x0 = data['x']
+    B = x0.shape[0]
+    T = student.timesteps
+
+    steps = len(range(T - 1, -1, -stride))
+    t = T - 1 - stride * torch.randint(0, steps, (B, ), device=x0.device)
+    t_prev = (t - stride).clamp(min=-1)
+
+    noise = torch.randn_like(x0)
+    x_t = student.q_sample(x0=x0, t=t, noise=noise)
+    x_t = student.apply_observation(x_t, data)
+
+    with torch.no_grad():
+        if teacher is not None:
+            x_prev = teacher_ddim_step(teacher, x_t, t, t_prev, teacher.eps_model.condition(data))
+        else:
+            alpha_prev, sigma_prev = gather_alpha_sigma(student, t_prev, x0.dim())
+            x_prev = student.apply_observation(alpha_prev * x0 + sigma_prev * noise, data)
+        target_x0 = consistency_function(target, x_prev, t_prev, target.eps_model.condition(data))
+
+    output = consistency_function(student, x_t, t, student.eps_model.condition(data))
+    output = student.apply_observation(output, data)
+    target_x0 = student.apply_observation(target_x0, data)
+
+    loss = student.criterion(output, target_x0)
+
+    return {'loss': loss}
+
+@torch.no_grad()
+def ema_update(target: nn.Module, model: nn.Module, decay: float) -> None:
+    """ target = decay * target + (1 - decay) * model, for the parameters
+    """
+    for p_target, p in zip(target.parameters(), model.parameters()):
+        p_target.mul_(decay).add_(p, alpha=1. - decay)
@@ -0,0 +1,84 @@
+import hashlib
+from typing import Hashable, List, Sequence
+import math
+import torch
+
+## splitmix64 constants as signed int64, the int64 arithmetic of torch wraps around
+GOLDEN = 0x9E3779B97F4A7C15 - (1 << 64)
+MIX1 = 0xBF58476D1CE4E5B9 - (1 << 64)
+MIX2 = 0x94D049BB133111EB - (1 << 64)
+MASK32 = (1 << 32) - 1
+
+
+def _shr(x: torch.Tensor, s: int) -> torch.Tensor:
+    """ Logical right shift of int64 """
+    return (x >> s) & ((1 << (64 - s)) - 1)
+
+def _mix(x: torch.Tensor) -> torch.Tensor:
+    """ splitmix64 finalizer, a bijective hash of int64 """
+    x = x + GOLDEN
+    x = (x ^ _shr(x, 30)) * MIX1
+    x = (x ^ _shr(x, 27)) * MIX2
+    return x ^ _shr(x, 31)
+
+def condition_seeds(keys: List[Sequence[Hashable]], seed: int=0, device='cpu') -> torch.Tensor:
+    """ Seeds of the conditions from their keys, e.g., (object_name, object_scale, cam_view)
+
+    The keys are hashed from their string form, so the seeds are the same in every process and run.
+
+    Args:
+        keys: one key per condition
+        seed: global seed
+        device: device of the seeds
+
+    Return:
+        Seeds, <B>, int64
+    """
+    seeds = []
+    for key in keys:
+        key = key if isinstance(key, (tuple, list)) else (key, )
+        digest = hashlib.blake2b('|'.join(str(k) for k in (seed, *key)).encode(), digest_size=8).digest()
+        seeds.append(int.from_bytes(digest, 'little', signed=True))
+    return torch.tensor(seeds, dtype=torch.long, device=device)
+
+def sample_seeds(cond_seeds: torch.Tensor, k: int, k_offset: int=0) -> torch.Tensor:
+    """ Seeds of k samples per condition, folded sample-major into the batch as in `DDPM.p_sample_loop`
+
+    Args:
+        cond_seeds: seeds of the B conditions, <B>
+        k: the number of samples per condition
+        k_offset: index of the first sample, i.e., row r is sample `k_offset + r // B` of condition `r % B`
+
+    Return:
+        Seeds, <k * B>
+    """
+    B = cond_seeds.shape[0]
+    sample_idx = torch.arange(k_offset, k_offset + k, device=cond_seeds.device).repeat_interleave(B)
+    return _mix(cond_seeds.repeat(k) ^ _mix(sample_idx))
+
+def counter_randn(seeds: torch.Tensor, counter: int, shape: Sequence[int], dtype=torch.float32) -> torch.Tensor:
+    """ Standard normal noise that only depends on the seed of every row and on a counter, e.g., the timestep,
+    so a sample draws the same noise whatever the batch it is sampled in
+
+    Every element hashes (seed, counter, element index) into 64 random bits, turned into a normal with the
+    Box-Muller transform.
+
+    Args:
+        seeds: per-row seeds, <N>
+        counter: index of the draw, every draw of a sample must use a different counter
+        shape: shape of one row
+        dtype: dtype of the noise
+
+    Return:
+        Noise, <N, *shape>
+    """
+    n = math.prod(shape)
+    key = _mix(seeds ^ _mix(torch.tensor(counter, dtype=torch.long, device=seeds.device)))
+    idx = torch.arange(n, dtype=torch.long, device=seeds.device)
+    bits = _mix(key[:, None] + idx[None, :] * GOLDEN)
+
+    ## two 32-bit uniforms, u1 in (0, 1] to keep the log finite
+    u1 = (_shr(bits, 32) + 1).to(torch.float64) / 2 ** 32
+    u2 = (bits & MASK32).to(torch.float64) / 2 ** 32
+    noise = (-2 * u1.log()).sqrt() * torch.cos(2 * math.pi * u2)
+    return noise.to(dtype).reshape(seeds.shape[0], *shape)
@@ -38,6 +38,43 @@ def make_schedule_ddpm(timesteps: int, beta: List, beta_schedule: str, s=0.008)
         'posterior_mean_coef2': (1 - alphas_cumprod_prev) * torch.sqrt(alphas) / (1. - alphas_cumprod)
     }
 
+## columns of the per-timestep coefficient pack
+COEF_PACK_KEYS = [
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'step_x_coef', # x_{t-1} = step_x_coef * x_t + step_eps_coef * eps + step_std * z
+    'step_eps_coef',
+    'step_std',
+]
+COEF = {k: i for i, k in enumerate(COEF_PACK_KEYS)}
+
+def make_coef_pack(schedule: Dict) -> torch.Tensor:
+    """ Stack the schedule coefficients of every timestep into one tensor, with the
+    coefficients of the DDPM reverse step fused into one affine map of x_t and the predicted noise
+
+    Args:
+        schedule: schedule buffers from `make_schedule_ddpm`
+
+    Return:
+        Coefficient pack, <T, K>, the columns follow `COEF_PACK_KEYS`
+    """
+    coef1 = schedule['posterior_mean_coef1'].double()
+    coef2 = schedule['posterior_mean_coef2'].double()
+    step_std = torch.exp(0.5 * schedule['posterior_log_variance_clipped'].double())
+    step_std[0] = 0. # no noise at the last step
+    fused = {
+        'step_x_coef': coef1 * schedule['sqrt_recip_alphas_cumprod'].double() + coef2,
+        'step_eps_coef': -coef1 * schedule['sqrt_recipm1_alphas_cumprod'].double(),
+        'step_std': step_std,
+    }
+    return torch.stack([fused[k] if k in fused else schedule[k].double() for k in COEF_PACK_KEYS], dim=1).to(schedule['betas'].dtype)
+
 if __name__ == '__main__':
     make_schedule_ddpm(10, [0, 0.9], 'linear', **{'s': 0.01})
     
\ No newline at end of file
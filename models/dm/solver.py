@@ -0,0 +1,178 @@
+from typing import Dict, List
+import torch
+import torch.nn as nn
+
+
+class Solver():
+    """ Base class of the strided samplers over the discrete timesteps of DDPM
+
+    A solver walks `timesteps` in order, the step at index i goes from timesteps[i]
+    to timesteps[i + 1], and the last step goes to -1, i.e., the clean sample.
+    Every step keeps the predicted x0 at timesteps[i] in `pred_x0`.
+    """
+    nfe_per_step = 1
+
+    def __init__(self, timesteps: List[int]) -> None:
+        self.timesteps = list(timesteps)
+        self.prev_timesteps = self.timesteps[1:] + [-1]
+        self.pred_x0 = None
+
+    def __len__(self) -> int:
+        return len(self.timesteps)
+
+    @property
+    def nfe(self) -> int:
+        """ Number of network evaluations of a full sampling loop, the last step is always first order
+        """
+        return self.nfe_per_step * (len(self) - 1) + 1
+
+    def step(self, ddpm: nn.Module, x_t: torch.Tensor, i: int, data: Dict, guid_param: Dict=None) -> torch.Tensor:
+        raise NotImplementedError
+
+    def compact(self, keep: torch.Tensor) -> None:
+        """ Keep the given rows of the per-sample solver state, when finished samples leave the batch
+        """
+        if self.pred_x0 is not None:
+            self.pred_x0 = self.pred_x0[keep]
+
+    @staticmethod
+    def alpha_sigma(ddpm: nn.Module, t: int) -> tuple:
+        """ VP coefficients sqrt(alpha_bar_t) and sqrt(1 - alpha_bar_t), t = -1 gives the clean sample
+        """
+        alpha_bar = ddpm.alphas_cumprod[t] if t >= 0 else torch.ones_like(ddpm.alphas_cumprod[0])
+        return alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+
+
+class DDIMSolver(Solver):
+    """ DDIM, first order
+    """
+    def __init__(self, timesteps: List[int], eta: float=0.) -> None:
+        super(DDIMSolver, self).__init__(timesteps)
+        self.eta = eta
+
+    def step(self, ddpm, x_t, i, data, guid_param=None):
+        x_prev, self.pred_x0 = ddpm.ddim_sample(x_t, self.timesteps[i], self.prev_timesteps[i], data, self.eta, guid_param,
+                                                return_pred_x0=True)
+        return x_prev
+
+
+class DPMSolverPP(Solver):
+    """ Multistep DPM-Solver++ in data prediction form, https://arxiv.org/abs/2211.01095
+
+    The order is lowered for the warm-up steps and for the last steps, which keeps
+    few-step sampling (<= 20 steps) stable.
+    """
+    def __init__(self, timesteps: List[int], order: int=2) -> None:
+        super(DPMSolverPP, self).__init__(timesteps)
+        assert order in [1, 2, 3], 'Unsupported DPM-Solver++ order.'
+        self.order = order
+        self.model_outputs = [] # predicted x0 of the previous steps, the latest one at the end
+        self.lambdas = []
+
+    def step(self, ddpm, x_t, i, data, guid_param=None):
+        t, t_prev = self.timesteps[i], self.prev_timesteps[i]
+        _, pred_x0 = ddpm.guided_predict(x_t, t, data, guid_param)
+        self.pred_x0 = pred_x0
+        if t_prev < 0:
+            ## lambda is infinite at the clean sample, the update reduces to the predicted x0
+            return pred_x0
+
+        alpha_s, sigma_s = self.alpha_sigma(ddpm, t)
+        alpha_t, sigma_t = self.alpha_sigma(ddpm, t_prev)
+        lambda_s = torch.log(alpha_s) - torch.log(sigma_s)
+        lambda_t = torch.log(alpha_t) - torch.log(sigma_t)
+
+        self.model_outputs = (self.model_outputs + [pred_x0])[-self.order:]
+        self.lambdas = (self.lambdas + [lambda_s])[-self.order:]
+        order = min(self.order, len(self.model_outputs), len(self) - 1 - i)
+
+        h = lambda_t - lambda_s
+        phi_1 = torch.expm1(-h)
+        m0 = self.model_outputs[-1]
+        x_prev = (sigma_t / sigma_s) * x_t - alpha_t * phi_1 * m0
+        if order == 2:
+            m1 = self.model_outputs[-2]
+            r0 = (self.lambdas[-1] - self.lambdas[-2]) / h
+            D1_0 = (m0 - m1) / r0
+            x_prev = x_prev - 0.5 * alpha_t * phi_1 * D1_0
+        elif order == 3:
+            m1, m2 = self.model_outputs[-2], self.model_outputs[-3]
+            r0 = (self.lambdas[-1] - self.lambdas[-2]) / h
+            r1 = (self.lambdas[-2] - self.lambdas[-3]) / h
+            D1_0 = (m0 - m1) / r0
+            D1_1 = (m1 - m2) / r1
+            D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+            D2 = (D1_0 - D1_1) / (r0 + r1)
+            phi_2 = phi_1 / h + 1.
+            phi_3 = phi_2 / h - 0.5
+            x_prev = x_prev + alpha_t * phi_2 * D1 - alpha_t * phi_3 * D2
+        return x_prev
+
+    def compact(self, keep: torch.Tensor) -> None:
+        super(DPMSolverPP, self).compact(keep)
+        self.model_outputs = [m[keep] for m in self.model_outputs]
+
+
+class HeunSolver(Solver):
+    """ Heun's second order method on the probability flow ODE, in the EDM parameterization
+    x = x_t / sqrt(alpha_bar_t) and sigma = sqrt(1 - alpha_bar_t) / sqrt(alpha_bar_t), https://arxiv.org/abs/2206.00364
+
+    Each step costs two network evaluations except the last one, which is an Euler step to the clean sample.
+    """
+    nfe_per_step = 2
+
+    def step(self, ddpm, x_t, i, data, guid_param=None):
+        t, t_prev = self.timesteps[i], self.prev_timesteps[i]
+        pred_noise, pred_x0 = ddpm.guided_predict(x_t, t, data, guid_param)
+        self.pred_x0 = pred_x0
+        if t_prev < 0:
+            return pred_x0
+
+        alpha_s, sigma_s = self.alpha_sigma(ddpm, t)
+        alpha_t, sigma_t = self.alpha_sigma(ddpm, t_prev)
+        ## dx/dsigma is the predicted noise in the EDM parameterization
+        x_s = x_t / alpha_s
+        dsigma = sigma_t / alpha_t - sigma_s / alpha_s
+        x_euler = (x_s + dsigma * pred_noise) * alpha_t
+        pred_noise_euler, _ = ddpm.guided_predict(x_euler, t_prev, data, guid_param)
+
+        return (x_s + dsigma * 0.5 * (pred_noise + pred_noise_euler)) * alpha_t
+
+
+class ConsistencySolver(Solver):
+    """ Multistep consistency sampling, https://arxiv.org/abs/2303.01469
+
+    The predicted x0 of a consistency-trained model is its consistency function. Every step maps
+    x_t to x0, and all steps but the last diffuse x0 back to the next timestep with fresh noise.
+    """
+    def step(self, ddpm, x_t, i, data, guid_param=None):
+        t, t_prev = self.timesteps[i], self.prev_timesteps[i]
+        _, pred_x0 = ddpm.guided_predict(x_t, t, data, guid_param)
+        self.pred_x0 = pred_x0
+        if t_prev < 0:
+            return pred_x0
+
+        alpha_t, sigma_t = self.alpha_sigma(ddpm, t_prev)
+        return alpha_t * pred_x0 + sigma_t * ddpm.noise_like(pred_x0, t + 1, data)
+
+
+def create_solver(name: str, timesteps: List[int], eta: float=0.) -> Solver:
+    """ Create a strided solver by name
+
+    Args:
+        name: 'ddim', 'dpmsolver++2m', 'dpmsolver++3m', 'heun', or 'consistency' for consistency models
+        timesteps: descending timesteps to visit
+        eta: stochasticity of ddim
+    """
+    if name == 'ddim':
+        return DDIMSolver(timesteps, eta)
+    elif name == 'dpmsolver++2m':
+        return DPMSolverPP(timesteps, order=2)
+    elif name == 'dpmsolver++3m':
+        return DPMSolverPP(timesteps, order=3)
+    elif name == 'heun':
+        return HeunSolver(timesteps)
+    elif name == 'consistency':
+        return ConsistencySolver(timesteps)
+    else:
+        raise Exception('Unsupported solver.')
@@ -0,0 +1,150 @@
+from typing import List, Tuple
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.model.utils import CrossAttention, BasicTransformerBlock, SpatialTransformer
+
+
+class StepAttention(nn.Module):
+    """ CrossAttention of the denoising step, with static reshapes in place of einops, and the
+    keys and values of the cross-attention given by the condition cache
+    """
+    def __init__(self, attn: CrossAttention) -> None:
+        super().__init__()
+        self.heads = attn.heads
+        self.scale = attn.scale
+        self.to_q = attn.to_q
+        self.to_k = attn.to_k
+        self.to_v = attn.to_v
+        self.to_out = attn.to_out[0]
+
+        ## self-attention over a single token, to_v and to_out folded into one linear layer
+        self.fold = attn.single_token_fast_path and isinstance(attn.to_v, nn.Linear) and isinstance(attn.to_out[0], nn.Linear)
+        if self.fold:
+            weight, bias = attn.folded_value_out()
+        else:
+            weight, bias = torch.empty(0), torch.empty(0)
+        self.register_buffer('value_out_weight', weight.detach().clone(), persistent=False)
+        self.register_buffer('value_out_bias', bias.detach().clone(), persistent=False)
+
+    def split_heads(self, x: torch.Tensor) -> torch.Tensor:
+        """ <B, N, (h d)> -> <(B h), N, d> """
+        B, N, _ = x.shape
+        return x.reshape(B, N, self.heads, -1).permute(0, 2, 1, 3).reshape(B * self.heads, N, -1)
+
+    def attend(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+        """ Attention of per-head queries <(B h), L, d> to keys and values <(b h), N, d>, B may be a multiple of b """
+        Bh, L, d = q.shape
+        q = q.reshape(-1, k.shape[0], L, d) # queries sharing one context are broadcast over the keys and values
+        attn = torch.softmax(torch.matmul(q, k.transpose(-1, -2)) * self.scale, dim=-1)
+        out = torch.matmul(attn, v).reshape(Bh // self.heads, self.heads, L, d)
+        return self.to_out(out.permute(0, 2, 1, 3).reshape(Bh // self.heads, L, self.heads * d))
+
+    def self_attention(self, x: torch.Tensor) -> torch.Tensor:
+        if x.shape[1] == 1:
+            if self.fold:
+                return F.linear(x, self.value_out_weight, self.value_out_bias)
+            return self.to_out(self.to_v(x))
+        return self.attend(self.split_heads(self.to_q(x)), self.split_heads(self.to_k(x)), self.split_heads(self.to_v(x)))
+
+    def cross_attention(self, x: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+        return self.attend(self.split_heads(self.to_q(x)), k, v)
+
+
+class StepTransformerBlock(nn.Module):
+    def __init__(self, block: BasicTransformerBlock) -> None:
+        super().__init__()
+        self.attn1 = StepAttention(block.attn1)
+        self.attn2 = StepAttention(block.attn2)
+        self.ff = block.ff
+        self.norm1 = block.norm1
+        self.norm2 = block.norm2
+        self.norm3 = block.norm3
+
+    def forward(self, x: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+        x = self.attn1.self_attention(self.norm1(x)) + x
+        x = self.attn2.cross_attention(self.norm2(x), k, v) + x
+        x = self.ff(self.norm3(x)) + x
+        return x
+
+
+class StepBlock(nn.Module):
+    """ ResBlock followed by the SpatialTransformer of one UNet block
+    """
+    def __init__(self, resblock: nn.Module, transformer: SpatialTransformer) -> None:
+        super().__init__()
+        self.resblock = resblock
+        self.norm = transformer.norm
+        self.proj_in = transformer.proj_in
+        self.transformer_blocks = nn.ModuleList([StepTransformerBlock(b) for b in transformer.transformer_blocks])
+        self.proj_out = transformer.proj_out
+
+    def forward(self, x: torch.Tensor, t_emb: torch.Tensor, context_kv: List[Tuple[torch.Tensor, torch.Tensor]]) -> torch.Tensor:
+        x = self.resblock(x, t_emb)
+        x_in = x
+        x = self.proj_in(self.norm(x)).permute(0, 2, 1)
+        for i, block in enumerate(self.transformer_blocks):
+            k, v = context_kv[i]
+            x = block(x, k, v)
+        x = self.proj_out(x.permute(0, 2, 1))
+        return x + x_in
+
+
+class DenoiseStep(nn.Module):
+    """ Noise prediction of UNetModel at eval time as a TorchScript / torch.compile friendly function of
+    `(x_t, t, cond_cache)`, sharing the weights of the UNet
+
+    The time embeddings are taken from the table of the UNet at construction, so the module is rebuilt
+    when the weights change. Dropout is left out and the condition is given by its cross-attention cache.
+    """
+    def __init__(self, unet: nn.Module) -> None:
+        super().__init__()
+        if unet.use_position_embedding:
+            raise Exception('Unsupported position embedding in the denoising step.')
+        self.register_buffer('time_table', unet.time_embed_table().detach().clone(), persistent=False)
+        self.in_layers = unet.in_layers
+        self.blocks = nn.ModuleList([StepBlock(unet.layers[i * 2], unet.layers[i * 2 + 1]) for i in range(unet.nblocks)])
+        self.out_layers = unet.out_layers
+
+    def forward(self, x_t: torch.Tensor, ts: torch.Tensor, cond_cache: List[List[Tuple[torch.Tensor, torch.Tensor]]]) -> torch.Tensor:
+        """ Apply the model to an input batch
+
+        Args:
+            x_t: the input data, <B, C> or <B, L, C>
+            ts: timesteps, <1> shared by the whole batch or <B>
+            cond_cache: cross-attention keys and values from `UNetModel.condition_cache`
+
+        Return:
+            The predicted noise, in the shape of x_t
+        """
+        squeeze = x_t.dim() == 2
+        h = x_t.unsqueeze(1) if squeeze else x_t
+        t_emb = self.time_table.index_select(0, ts)
+
+        h = self.in_layers(h.permute(0, 2, 1))
+        for i, block in enumerate(self.blocks):
+            h = block(h, t_emb, cond_cache[i])
+        h = self.out_layers(h).permute(0, 2, 1)
+
+        return h.squeeze(1) if squeeze else h
+
+
+def compile_denoise_step(unet: nn.Module, backend: str='script') -> nn.Module:
+    """ Build the denoising step of an eval-mode UNet and compile it
+
+    Args:
+        unet: UNetModel in eval mode
+        backend: 'script' for TorchScript, 'inductor' for torch.compile (torch>=2.0), or 'eager'
+    """
+    step = DenoiseStep(unet).eval()
+    if backend == 'script':
+        return torch.jit.script(step)
+    elif backend == 'inductor':
+        if not hasattr(torch, 'compile'):
+            raise Exception('inductor backend requires torch>=2.0.')
+        return torch.compile(step, dynamic=True)
+    elif backend == 'eager':
+        return step
+    else:
+        raise Exception('Unsupported compile backend.')
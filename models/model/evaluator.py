@@ -1,14 +1,15 @@
 from re import T
 import time
 
-from flask.cli import F
 import torch
+import torch.nn.functional as F
 # from FFHNet.utils import utils
 from torch import nn
 from torch.optim import lr_scheduler
 from utils.rot6d import robust_compute_rotation_matrix_from_ortho6d
 # from FFHNet.models import losses
-from models.model.utils import get_embedder 
+from models.model.utils import get_embedder, params_version
+from utils.utils import fp32_island
 
 class ResBlock(nn.Module):
     def __init__(self, Fin, Fout, n_neurons=256):
@@ -26,11 +27,45 @@ class ResBlock(nn.Module):
             self.fc3 = nn.Linear(Fin, Fout)
 
         self.ll = nn.LeakyReLU(negative_slope=0.2)
+        ## fc1 and fc3 weights without the BPS columns, cached in eval mode until the weights change
+        self._grasp_weights = None
+        self._grasp_weights_version = None
 
-    def forward(self, x, final_nl=True):
-        Xin = x if self.Fin == self.Fout else self.ll(self.fc3(x))
+    def grasp_weights(self, bps_cols):
+        """ Weights of fc1 and fc3 without the input columns `bps_cols`, i.e., the grasp column blocks
+        """
+        start, end = bps_cols
+        fcs = (self.fc1, self.fc3)
+        if self.training:
+            return [torch.cat([fc.weight[:, :start], fc.weight[:, end:]], dim=1) for fc in fcs]
+        version = (bps_cols, params_version(*[fc.weight for fc in fcs]))
+        if self._grasp_weights_version != version:
+            self._grasp_weights = [torch.cat([fc.weight[:, :start], fc.weight[:, end:]], dim=1).detach().contiguous() for fc in fcs]
+            self._grasp_weights_version = version
+        return self._grasp_weights
+
+    @torch.no_grad()
+    def fuse_bn(self):
+        """ Fold the eval-time affine of bn1 and bn2 into fc1 and fc2, the batch norms become identities
+        """
+        for fc, name in [(self.fc1, 'bn1'), (self.fc2, 'bn2')]:
+            bn = getattr(self, name)
+            scale = bn.weight / (bn.running_var + bn.eps).sqrt()
+            fc.weight.mul_(scale[:, None])
+            fc.bias.sub_(bn.running_mean).mul_(scale).add_(bn.bias)
+            setattr(self, name, nn.Identity())
 
-        Xout = self.fc1(x)
+    def forward(self, x, final_nl=True, bps_feat=None, bps_cols=None):
+        """ bps_feat are the products of fc1 and fc3 with the input columns `bps_cols` left out of x,
+        biases included, <B, n> or <1, n> shared by the batch, see `DexEvaluator.bps_features`
+        """
+        if bps_feat is None:
+            Xin = x if self.Fin == self.Fout else self.ll(self.fc3(x))
+            Xout = self.fc1(x)
+        else:
+            weight1, weight3 = self.grasp_weights(bps_cols)
+            Xin = self.ll(torch.addmm(bps_feat[1], x, weight3.t()))
+            Xout = torch.addmm(bps_feat[0], x, weight1.t())
         Xout = self.bn1(Xout)
         Xout = self.ll(Xout)
 
@@ -54,18 +89,27 @@ class DexEvaluator(nn.Module):
                  dtype=torch.float32,
                  device = 'cuda',
                  pos_enc_multires = None,
+                 split_bps = False,
                  **kwargs):
         super(DexEvaluator, self).__init__()
         self.cfg = cfg
         self.device = device
         self.pos_enc_multires = pos_enc_multires
+        self.in_bps = in_bps
+        self.n_neurons = n_neurons
         self.use_bn = False
         self.use_drop_out = True
+        ## opt-in inference mode for batches of repeated objects: in eval mode, multiply the BPS columns of the
+        ## first layers once per unique object, see `bps_features`; callers that know their objects can instead
+        ## pass obj_bps_feat, e.g., `score_grasps` or the guidance of `DDPM`
+        self.split_bps = split_bps
+        self.fused = False
 
         if pos_enc_multires is None:
             in_dim = in_bps + in_pose + 16
         else:
-            self.embed_fn = [] 
+            ## modules, so that the frequency buffers move with the evaluator
+            self.embed_fn = nn.ModuleList()
             out_dim_embd = 0
             x_dims = [3,6,16]
             for i,pos_enc in enumerate(pos_enc_multires):
@@ -73,6 +117,8 @@ class DexEvaluator(nn.Module):
                 out_dim_embd += out_dim
                 self.embed_fn.append(embed_fn)
             in_dim = in_bps + out_dim_embd
+        ## width of the grasp columns of the input, i.e., its embedding
+        self.grasp_dim = in_dim - in_bps
             
         if self.use_bn:
             self.bn1 = nn.BatchNorm1d(in_dim)
@@ -86,6 +132,7 @@ class DexEvaluator(nn.Module):
 
         self.BCE_loss = torch.nn.BCELoss(reduction='mean')
 
+    @fp32_island
     def compute_loss(self, pred_success_p, gt_label):
         """
             Computes the binary cross entropy loss between predicted success-label and true success
@@ -100,11 +147,74 @@ class DexEvaluator(nn.Module):
         eva_input = torch.cat([rot9d, x[:,:3], x[:,9:]], dim=1)
         return eva_input
 
+    def bps_features(self, obj_bps, dedup=False):
+        """Products of obj_bps with the weights of the first linear layers of every residual block, biases included.
+        They only depend on the object, so they can be reused for all grasps of the same object.
+
+        Args:
+            obj_bps (tensor, batch_size*in_bps): basis point set of the objects
+            dedup (bool): compute the products once per unique object and gather them back to the batch,
+                a single object gives 1*n_neurons products broadcast to the batch
+
+        Returns:
+            bps_feat (list): (fc1, fc3) products of rb1, rb2 and rb3, each of batch_size*n_neurons
+        """
+        if not self.can_split_bps():
+            raise Exception('Unsupported BPS features with the input batch norm or quantized layers.')
+        obj_bps = obj_bps.to(dtype=self.dtype, device=self.device)
+        inverse = None
+        if dedup and obj_bps.shape[0] > 1:
+            unique_bps, inverse = torch.unique(obj_bps, dim=0, return_inverse=True)
+            if unique_bps.shape[0] == 1:
+                obj_bps, inverse = unique_bps, None
+            elif unique_bps.shape[0] < obj_bps.shape[0]:
+                obj_bps = unique_bps
+            else:
+                inverse = None
+
+        bps_feat = []
+        for rb, start in [(self.rb1, 0), (self.rb2, self.n_neurons), (self.rb3, self.n_neurons)]:
+            feat = tuple(F.linear(obj_bps, fc.weight[:, start:start + self.in_bps], fc.bias) for fc in (rb.fc1, rb.fc3))
+            bps_feat.append(feat if inverse is None else tuple(f[inverse] for f in feat))
+        return bps_feat
+
+    def fuse_for_inference(self):
+        """Fold the batch norms of the residual blocks into their linear layers and strip the dropout,
+        the outputs of eval mode are unchanged. The fused evaluator can not be trained, and its state dict
+        has no batch norms, so save the ckpts before fusing.
+
+        Returns:
+            self (DexEvaluator): the fused evaluator in eval mode, modified in place
+        """
+        if self.use_bn:
+            raise Exception('Unsupported fusion of the input batch norm.')
+        if not all(isinstance(fc, nn.Linear) for rb in (self.rb1, self.rb2, self.rb3) for fc in (rb.fc1, rb.fc2)):
+            raise Exception('Unsupported fusion of quantized layers, fuse before quantization.')
+        self.eval()
+        for rb in (self.rb1, self.rb2, self.rb3):
+            rb.fuse_bn()
+        self.use_drop_out = False
+        self.dout = nn.Identity()
+        self.fused = True
+        return self
+
+    def train(self, mode=True):
+        if mode and self.fused:
+            raise Exception('Unsupported training of a fused evaluator.')
+        return super(DexEvaluator, self).train(mode)
+
+    def can_split_bps(self):
+        """ Whether the BPS columns of the first layers can be split off, not with the input batch norm or
+        with quantized layers
+        """
+        return not self.use_bn and all(isinstance(fc, nn.Linear) for rb in (self.rb1, self.rb2, self.rb3) for fc in (rb.fc1, rb.fc3))
+
     def forward(self, data):
         """Run one forward iteration to evaluate the success probability of given grasps
 
         Args:
             data (dict): keys should be rot_matrix, transl, joint_conf, obj_bps,
+                or obj_bps_feat from `bps_features` instead of obj_bps
 
         Returns:
             p_success (tensor, batch_size*1): Probability that a grasp will be successful.
@@ -113,32 +223,44 @@ class DexEvaluator(nn.Module):
         if 'label' in data.keys():
             gt_label = data["label"].to(dtype=self.dtype, device=self.device).unsqueeze(-1)
         
+        ## the precomputed BPS features replace the obj_bps columns of the input
+        bps_feat = data.get('obj_bps_feat', None)
+        if bps_feat is None and self.split_bps and not self.training and self.can_split_bps():
+            ## grasps of the same object share the wide BPS products, only the grasp columns are per grasp
+            bps_feat = self.bps_features(data['obj_bps'], dedup=True)
+        obj_bps = [] if bps_feat is not None else [data['obj_bps']]
         if self.pos_enc_multires is None:
-            X = torch.cat([data['obj_bps'], data['x_t']], dim=1).to(dtype=self.dtype, device=self.device).contiguous()
+            X = torch.cat(obj_bps + [data['x_t']], dim=1).to(dtype=self.dtype, device=self.device).contiguous()
         else:
             embedded_trans = self.embed_fn[0](data['x_t'][:,:3]).to(dtype=self.dtype, device=self.device)
             embedded_rot = self.embed_fn[1](data['x_t'][:,3:9]).to(dtype=self.dtype, device=self.device)
             embedded_joint = self.embed_fn[2](data['x_t'][:,9:]).to(dtype=self.dtype, device=self.device)
-            X = torch.cat([data['obj_bps'], embedded_trans, embedded_rot, embedded_joint], dim=1).to(dtype=self.dtype, device=self.device).contiguous()
+            X = torch.cat(obj_bps + [embedded_trans, embedded_rot, embedded_joint], dim=1).to(dtype=self.dtype, device=self.device).contiguous()
         
+        if bps_feat is None:
+            rb_args = [{}, {}, {}]
+        else:
+            assert not self.use_bn, 'the BPS features are taken before the input batch norm'
+            rb_args = [{'bps_feat': bps_feat[0], 'bps_cols': (0, self.in_bps)}] + \
+                      [{'bps_feat': feat, 'bps_cols': (self.n_neurons, self.n_neurons + self.in_bps)} for feat in bps_feat[1:]]
 
         #X0 = self.bn1(X)
         if self.use_bn:
             X0 = self.bn1(X)
         else:
             X0=X
-        X = self.rb1(X)
+        X = self.rb1(X, **rb_args[0])
         if self.use_drop_out:
             X = self.dout(X)
-        X = self.rb2(torch.cat([X, X0], dim=1))
+        X = self.rb2(torch.cat([X, X0], dim=1), **rb_args[1])
         if self.use_drop_out:
             X = self.dout(X)
-        X = self.rb3(torch.cat([X, X0], dim=1))
+        X = self.rb3(torch.cat([X, X0], dim=1), **rb_args[2])
         if self.use_drop_out:
             X = self.dout(X)
         X = self.out_success(X)
 
-        p_success = self.sigmoid(X)
+        p_success = self.sigmoid(X.float()) # float32 scores under autocast
 
         if 'label' in data.keys():
             loss = self.compute_loss(p_success, gt_label)
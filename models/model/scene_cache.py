@@ -0,0 +1,78 @@
+import os
+from collections import OrderedDict
+from typing import Callable, Hashable
+import torch
+from loguru import logger
+
+
+class SceneFeatureCache():
+    """ LRU cache of the condition features of the scene model, keyed by e.g. (object, scale, cam_view)
+
+    The features depend on the weights of the scene model, so a cache saved to disk records a tag,
+    e.g., the sampler ckpt path, and is only loaded for the same tag.
+    """
+    def __init__(self, max_size: int=1024, tag: str=None) -> None:
+        self.max_size = max_size
+        self.tag = tag
+        self.features = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.features
+
+    def get(self, key: Hashable, device=None) -> torch.Tensor:
+        """ Cached feature of key moved to device, None if not cached
+        """
+        if key not in self.features:
+            return None
+        self.features.move_to_end(key)
+        feat = self.features[key]
+        return feat if device is None else feat.to(device)
+
+    def put(self, key: Hashable, feat: torch.Tensor) -> None:
+        self.features[key] = feat.detach()
+        self.features.move_to_end(key)
+        while len(self.features) > self.max_size:
+            self.features.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable, device=None) -> torch.Tensor:
+        """ Cached feature of key, computed with `compute()` and cached on a miss
+
+        Args:
+            key: cache key, e.g., (object_name, object_scale, cam_view)
+            compute: computes the feature of one scene, <1, L, C>
+            device: device of the returned feature
+        """
+        feat = self.get(key, device)
+        if feat is None:
+            self.misses += 1
+            feat = compute()
+            self.put(key, feat)
+        else:
+            self.hits += 1
+        return feat
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save({
+            'tag': self.tag,
+            'features': OrderedDict((k, v.cpu()) for k, v in self.features.items()),
+        }, path)
+        logger.info(f'Saved {len(self)} scene features to {path} | hits: {self.hits} | misses: {self.misses}')
+
+    def load(self, path: str, device=None) -> None:
+        """ Load the features saved with `save`, nothing is loaded if the file is missing or its tag differs
+        """
+        if not os.path.exists(path):
+            return
+        saved = torch.load(path, map_location='cpu')
+        if saved['tag'] != self.tag:
+            logger.warning(f'Skip the scene features of {path}, saved for {saved["tag"]} instead of {self.tag}')
+            return
+        for k, v in saved['features'].items():
+            self.put(k, v if device is None else v.to(device))
+        logger.info(f'Loaded {len(self)} scene features from {path}')
@@ -1,12 +1,13 @@
-from typing import Dict
+from typing import Dict, List
 from einops import rearrange
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from omegaconf import DictConfig
 
-from models.model.utils import timestep_embedding
+from models.model.utils import timestep_embedding, params_version
 from models.model.utils import ResBlock, SpatialTransformer
+from utils.utils import no_autocast
 
 
 
@@ -24,6 +25,7 @@ class UNetModel(nn.Module):
         self.transformer_depth = cfg.model.transformer_depth
         self.transformer_mult_ff = cfg.model.transformer_mult_ff
         self.context_dim = cfg.model.context_dim
+        self.attention_backend = cfg.model.get('attention_backend', 'einsum') # 'einsum' or 'sdpa'
         self.use_position_embedding = cfg.model.use_position_embedding # for input sequence x
         self.scene_model_name = cfg.model.scene_model.name # 'obj_bps','random_condition', 'PointNet2'
         self.freeze_scene_model = cfg.model.freeze_scene_model
@@ -61,6 +63,10 @@ class UNetModel(nn.Module):
             nn.SiLU(),
             nn.Linear(time_embed_dim, time_embed_dim),
         )
+        ## post-MLP embeddings of all discrete timesteps, built lazily at eval time
+        self.timesteps = cfg.diffuser.steps if 'diffuser' in cfg else None
+        self._time_embed_table = None
+        self._time_embed_table_version = None
         
         self.in_layers = nn.Sequential(
             nn.Conv1d(self.d_x, self.d_model, 1)
@@ -85,6 +91,7 @@ class UNetModel(nn.Module):
                     dropout=self.transformer_dropout,
                     mult_ff=self.transformer_mult_ff,
                     context_dim=self.context_dim,
+                    attn_backend=self.attention_backend,
                 )
             )
         
@@ -94,13 +101,49 @@ class UNetModel(nn.Module):
             nn.Conv1d(self.d_model, self.d_x, 1),
         )
         
-    def forward(self, x_t: torch.Tensor, ts: torch.Tensor, cond: torch.Tensor) -> torch.Tensor:
+    def time_embed_table(self) -> torch.Tensor:
+        """ Post-MLP time embeddings of all discrete timesteps, rebuilt when the weights of `time_embed` change
+
+        Return:
+            Time embedding table, <T, time_embed_dim>
+        """
+        version = params_version(*self.time_embed.parameters())
+        if self._time_embed_table_version != version:
+            ## cached in float32, also when first built inside an autocast region
+            with torch.no_grad(), no_autocast():
+                ts = torch.arange(self.timesteps, device=self.time_embed[0].weight.device)
+                self._time_embed_table = self.time_embed(timestep_embedding(ts, self.d_model))
+            self._time_embed_table_version = version
+        return self._time_embed_table
+
+    def time_embedding(self, ts) -> torch.Tensor:
+        """ Time embedding of the given timesteps
+
+        Args:
+            ts: 1-D batch of timesteps, or an int timestep shared by the whole batch
+        
+        Return:
+            Time embedding, <B, time_embed_dim>, or <1, time_embed_dim> that broadcasts to the batch for an int timestep
+        """
+        if not self.training and self.timesteps is not None:
+            if isinstance(ts, int):
+                return self.time_embed_table()[ts:ts + 1]
+            if not torch.is_floating_point(ts):
+                return self.time_embed_table()[ts]
+
+        if isinstance(ts, int):
+            ts = torch.tensor([ts], device=self.time_embed[0].weight.device)
+        t_emb = timestep_embedding(ts, self.d_model)
+        return self.time_embed(t_emb)
+
+    def forward(self, x_t: torch.Tensor, ts: torch.Tensor, cond: torch.Tensor, cond_cache: List=None) -> torch.Tensor:
         """ Apply the model to an input batch
 
         Args:
             x_t: the input data, <B, C> or <B, L, C>
-            ts: timestep, 1-D batch of timesteps
+            ts: timestep, 1-D batch of timesteps, or an int timestep shared by the whole batch
             cond: condition feature
+            cond_cache: cross-attention keys and values of `cond` from `condition_cache`, recomputed if None
         
         Return:
             the denoised target data, i.e., $x_{t-1}$
@@ -111,8 +154,7 @@ class UNetModel(nn.Module):
         assert len(x_t.shape) == 3
 
         ## time embedding
-        t_emb = timestep_embedding(ts, self.d_model)
-        t_emb = self.time_embed(t_emb)
+        t_emb = self.time_embedding(ts)
 
         h = rearrange(x_t, 'b l c -> b c l')
         h = self.in_layers(h) # <B, d_model, L>
@@ -127,7 +169,7 @@ class UNetModel(nn.Module):
 
         for i in range(self.nblocks):
             h = self.layers[i * 2 + 0](h, t_emb)
-            h = self.layers[i * 2 + 1](h, context=cond)
+            h = self.layers[i * 2 + 1](h, context=cond, context_kv=None if cond_cache is None else cond_cache[i])
         h = self.out_layers(h)
         h = rearrange(h, 'b c l -> b l c')
 
@@ -137,15 +179,30 @@ class UNetModel(nn.Module):
 
         return h
 
+    def condition_cache(self, cond: torch.Tensor) -> List:
+        """ Precompute the cross-attention keys and values of the condition feature, which are
+        fixed during the whole reverse diffusion process
+
+        Args:
+            cond: condition feature from `condition`
+
+        Return:
+            Keys and values of every transformer block, indexed by [block][depth]
+        """
+        return [self.layers[i * 2 + 1].context_kv(cond) for i in range(self.nblocks)]
+
     def condition(self, data: Dict) -> torch.Tensor:
         """ Obtain scene feature with scene model
 
         Args:
-            data: dataloader-provided data
+            data: dataloader-provided data, data['scene_feat'] gives a precomputed condition feature, e.g., from
+                `SceneFeatureCache`, which is returned as is
 
         Return:
             Condition feature
         """
+        if 'scene_feat' in data:
+            return data['scene_feat']
             
         if self.scene_model_name == 'PointTransformer':
             b = data['offset'].shape[0]
@@ -159,8 +216,20 @@ class UNetModel(nn.Module):
         elif self.scene_model_name == 'PointNet2':
             b = data['pos'].shape[0]
             pos = data['pos'].to(torch.float32)
-            _, scene_feat_list = self.scene_model(pos)
+            inverse = None
+            if not self.training and b > 1:
+                ## encode every unique point cloud once, e.g., one object repeated for several grasps
+                unique_pos, inverse = torch.unique(pos, dim=0, return_inverse=True)
+                if unique_pos.shape[0] < b:
+                    pos = unique_pos
+                else:
+                    inverse = None
+            ## the custom CUDA ops of PointNet2 take float32 features
+            with no_autocast():
+                _, scene_feat_list = self.scene_model(pos)
             scene_feat = scene_feat_list[-1].transpose(1, 2)
+            if inverse is not None:
+                scene_feat = scene_feat[inverse]
         elif self.scene_model_name == 'obj_bps':
             b = data['obj_bps'].shape[0]
             scene_feat = data['obj_bps'].reshape(b, -1, self.context_dim)
@@ -6,6 +6,8 @@ from torch import einsum
 from einops import repeat, rearrange
 from inspect import isfunction
 
+from utils.utils import no_autocast
+
 
 def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     """
@@ -30,17 +32,21 @@ def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     return embedding
 
 # Borrowed from Nerf
-class Embedder:
+class Embedder(nn.Module):
+    """ NeRF positional encoding [x, p_0(f_0 x), p_1(f_0 x), p_0(f_1 x), ...], each term of input_dims channels
+
+    All frequencies are applied in one broadcasted product and every periodic function is called once,
+    the frequencies are a non-persistent buffer, so the ckpts are unchanged.
+    """
     def __init__(self, **kwargs):
+        super(Embedder, self).__init__()
         self.kwargs = kwargs
         self.create_embedding_fn()
         
     def create_embedding_fn(self):
-        embed_fns = []
         d = self.kwargs['input_dims']
         out_dim = 0
         if self.kwargs['include_input']:
-            embed_fns.append(lambda x : x)
             out_dim += d
             
         max_freq = self.kwargs['max_freq_log2']
@@ -50,17 +56,23 @@ class Embedder:
             freq_bands = 2.**torch.linspace(0., max_freq, steps=N_freqs)
         else:
             freq_bands = torch.linspace(2.**0., 2.**max_freq, steps=N_freqs)
-            
-        for freq in freq_bands:
-            for p_fn in self.kwargs['periodic_fns']:
-                embed_fns.append(lambda x, p_fn=p_fn, freq=freq : p_fn(x * freq))
-                out_dim += d
-                    
-        self.embed_fns = embed_fns
+        out_dim += d * N_freqs * len(self.kwargs['periodic_fns'])
+
+        self.register_buffer('freq_bands', freq_bands, persistent=False)
+        self.periodic_fns = self.kwargs['periodic_fns']
+        self.include_input = self.kwargs['include_input']
         self.out_dim = out_dim
-        
+
+    def forward(self, inputs):
+        ## <..., F, d> products, every periodic function stacked after them as <..., F, P, d>, i.e., the order of NeRF
+        x_freq = inputs[..., None, :] * self.freq_bands[:, None].to(inputs.dtype)
+        embedded = torch.stack([p_fn(x_freq) for p_fn in self.periodic_fns], dim=-2).flatten(-3)
+        if self.include_input:
+            return torch.cat([inputs, embedded], -1)
+        return embedded
+
     def embed(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        return self(inputs)
 
 
 def get_embedder(multires,in_dim=3, i=0):
@@ -77,8 +89,7 @@ def get_embedder(multires,in_dim=3, i=0):
     }
     
     embedder_obj = Embedder(**embed_kwargs)
-    embed = lambda x, eo=embedder_obj : eo.embed(x)
-    return embed, embedder_obj.out_dim
+    return embedder_obj, embedder_obj.out_dim
 
 class ResBlock(nn.Module):
     """
@@ -154,6 +165,12 @@ def default(val, d):
 def max_neg_value(t):
     return -torch.finfo(t.dtype).max
 
+def params_version(*tensors):
+    """ Identity of the current values of the given parameters, which changes when they are
+    updated in place (optimizer steps, loading a state dict) or moved to another device.
+    """
+    return tuple((t.data_ptr(), t._version) for t in tensors)
+
 def init_(tensor):
     dim = tensor.shape[-1]
     std = 1 / math.sqrt(dim)
@@ -263,13 +280,18 @@ class SpatialSelfAttention(nn.Module):
         return x+h_
 
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
+    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., backend='einsum'):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
 
         self.scale = dim_head ** -0.5
         self.heads = heads
+        ## 'einsum' is the reference implementation, 'sdpa' uses the fused F.scaled_dot_product_attention
+        assert backend in ['einsum', 'sdpa'], 'Unsupported attention backend.'
+        if backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            raise Exception('sdpa attention backend requires torch>=2.0.')
+        self.backend = backend
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
@@ -280,17 +302,66 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
 
-    def forward(self, x, context=None, mask=None):
-        h = self.heads
+        ## self-attention over a single token attends to itself with weight 1, i.e., to_out(to_v(x))
+        self.single_token_fast_path = True
+        self._folded_value_out = None
+        self._folded_value_out_version = None
 
-        q = self.to_q(x)
-        context = default(context, x)
+    def folded_value_out(self):
+        """
+        Fold to_v and the output projection into one linear layer, recomputed when the weights change.
+        :return: weight and bias of the folded [query_dim x query_dim] linear layer.
+        """
+        out = self.to_out[0]
+        version = params_version(self.to_v.weight, out.weight, out.bias)
+        if self._folded_value_out_version != version:
+            ## cached in float32, also when first built inside an autocast region
+            with torch.no_grad(), no_autocast():
+                self._folded_value_out = (out.weight @ self.to_v.weight, out.bias.clone())
+            self._folded_value_out_version = version
+        return self._folded_value_out
+
+    def context_kv(self, context):
+        """
+        Project the context into per-head keys and values.
+        :param context: an [N x L x context_dim] Tensor.
+        :return: keys and values, each an [(N * heads) x L x dim_head] Tensor.
+        """
+        h = self.heads
         k = self.to_k(context)
         v = self.to_v(context)
+        k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (k, v))
+        return k, v
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+    def forward(self, x, context=None, mask=None, context_kv=None):
+        h = self.heads
+
+        if self.single_token_fast_path and context is None and context_kv is None and mask is None and x.shape[1] == 1:
+            if self.training or not isinstance(self.to_v, nn.Linear) or not isinstance(self.to_out[0], nn.Linear):
+                ## the weights of quantized layers are not folded
+                return self.to_out(self.to_v(x))
+            weight, bias = self.folded_value_out()
+            return F.linear(x, weight, bias)
+
+        q = self.to_q(x)
+        if context_kv is None:
+            context = default(context, x)
+            k, v = self.context_kv(context)
+        else:
+            ## keys and values of a fixed context, precomputed with `context_kv`
+            k, v = context_kv
+
+        q = rearrange(q, 'b n (h d) -> (b h) n d', h=h)
+
+        if self.backend == 'sdpa':
+            return self.to_out(self._sdpa(q, k, v, mask))
+
+        ## several queries may share one context, stacked sample-major in the batch, i.e., <(k b h), n, d>
+        n_share = q.shape[0] // k.shape[0]
+        if n_share > 1:
+            q = q.unflatten(0, (n_share, -1))
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+        sim = einsum('... i d, ... j d -> ... i j', q, k) * self.scale
 
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
@@ -301,24 +372,49 @@ class CrossAttention(nn.Module):
         # attention, what we cannot get enough of
         attn = sim.softmax(dim=-1)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        out = einsum('... i j, ... j d -> ... i d', attn, v)
+        if n_share > 1:
+            out = out.flatten(0, 1)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
+    def _sdpa(self, q, k, v, mask=None):
+        """
+        Fused attention of per-head queries, keys and values in [(N * heads) x L x dim_head] layout,
+        N of the queries may be a multiple of N of the keys and values.
+        :return: an [N x L x inner_dim] Tensor.
+        """
+        h = self.heads
+        q, k, v = map(lambda t: t.unflatten(0, (-1, h)), (q, k, v))
+        n_share = q.shape[0] // k.shape[0]
+        if n_share > 1:
+            ## queries sharing one context, the keys and values are broadcast without copying
+            q = q.unflatten(0, (n_share, -1))
+            k, v = map(lambda t: t.expand(n_share, *t.shape), (k, v))
+        if exists(mask):
+            ## boolean mask, True marks the context tokens to attend
+            mask = rearrange(mask, 'b ... -> b () () (...)')
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        if n_share > 1:
+            out = out.flatten(0, 1)
+        return rearrange(out, 'b h n d -> b n (h d)')
+
 class BasicTransformerBlock(nn.Module):
-    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, mult_ff=2):
+    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, mult_ff=2, attn_backend='einsum'):
         super().__init__()
-        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
+        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    backend=attn_backend)  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff, mult=mult_ff)
         self.attn2 = CrossAttention(query_dim=dim, context_dim=context_dim,
-                                    heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
+                                    heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    backend=attn_backend)  # is self-attn if context is none
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
 
-    def forward(self, x, context=None):
+    def forward(self, x, context=None, context_kv=None):
         x = self.attn1(self.norm1(x)) + x
-        x = self.attn2(self.norm2(x), context=context) + x
+        x = self.attn2(self.norm2(x), context=context, context_kv=context_kv) + x
         x = self.ff(self.norm3(x)) + x
         return x
 
@@ -331,7 +427,7 @@ class SpatialTransformer(nn.Module):
     Finally, reshape to sequential data.
     """
     def __init__(self, in_channels, n_heads=8, d_head=64,
-                 depth=1, dropout=0., context_dim=None, mult_ff=2):
+                 depth=1, dropout=0., context_dim=None, mult_ff=2, attn_backend='einsum'):
         super().__init__()
         self.in_channels = in_channels
         inner_dim = n_heads * d_head
@@ -343,7 +439,8 @@ class SpatialTransformer(nn.Module):
                                  padding=0)
 
         self.transformer_blocks = nn.ModuleList(
-            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim, mult_ff=mult_ff)
+            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim, mult_ff=mult_ff,
+                                   attn_backend=attn_backend)
                 for d in range(depth)]
         )
 
@@ -353,16 +450,24 @@ class SpatialTransformer(nn.Module):
                                 stride=1,
                                 padding=0)
 
-    def forward(self, x, context=None):
+    def context_kv(self, context):
+        """
+        Keys and values of the cross-attention of every block, which are fixed for a fixed context.
+        """
+        return [block.attn2.context_kv(context) for block in self.transformer_blocks]
+
+    def forward(self, x, context=None, context_kv=None):
         # note: if no context is given, cross-attention defaults to self-attention
         B, C, L,  = x.shape
         x_in = x
         x = self.norm(x)
         x = self.proj_in(x)
 
+        if context_kv is None:
+            context_kv = [None] * len(self.transformer_blocks)
         x = rearrange(x, 'b c l -> b l c')
-        for block in self.transformer_blocks:
-            x = block(x, context=context)
+        for block, kv in zip(self.transformer_blocks, context_kv):
+            x = block(x, context=context, context_kv=kv)
         x = rearrange(x, 'b l c -> b c l')
         x = self.proj_out(x)
         return x + x_in
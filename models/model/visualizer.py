@@ -9,8 +9,12 @@ from plotly import graph_objects as go
 from typing import Any
 from random import randint
 
-from utils.handmodel import get_handmodel, angle_denormalize, trans_denormalize
+from utils.handmodel import get_handmodel, angle_denormalize, trans_denormalize, evaluator_normalize
 from utils.plotly_utils import plot_mesh, plot_point_cloud
+from models.model.scene_cache import SceneFeatureCache
+from models.dm.rng import condition_seeds
+from utils.scoring import score_grasps
+from utils.ranking import segmented_topk, diverse_topk
 from utils.rot6d import rot_to_orthod6d, robust_compute_rotation_matrix_from_ortho6d, random_rot, identity_rot
 from tqdm import tqdm
 from bps_torch.bps import bps_torch
@@ -98,6 +102,80 @@ class GraspGenURVisualizer():
                 elif vis_type == 'html':
                     fig.write_html(save_path)
     
+    def denormalize(self, outputs: torch.Tensor) -> torch.Tensor:
+        """ Denormalize the joint angles and the translation of sampled grasps in place
+        """
+        if self.cfg.task.dataset.normalize_x:
+            outputs[:,9:] = angle_denormalize(joint_angle=outputs[:,9:].to(torch.float32).cpu()).cuda()
+        if self.cfg.task.dataset.normalize_x_trans:
+            outputs[:, :3] = trans_denormalize(global_trans=outputs[:, :3].cpu()).cuda()
+        return outputs
+
+    def evaluator_input(self, outputs: torch.Tensor) -> torch.Tensor:
+        """ Denormalized grasps normalized as the evaluator inputs, following `cfg.task.dataset`
+        """
+        return evaluator_normalize(outputs, self.cfg.task.dataset.normalize_x, self.cfg.task.dataset.normalize_x_trans)
+
+    @torch.no_grad()
+    def vis_denoising(self, model: torch.nn.Module, data: dict, save_dir: str, scene_id: str, stride: int,
+                      guid_param: dict = None, solver: str = None, steps: int = None, vis_type: str = 'html', k: int = 1) -> torch.Tensor:
+        """ Sample with `DDPM.iter_sample` and save the hand of the predicted x0 of the first sample every
+        `stride` sampling steps, only the current step is kept in memory
+
+        Args:
+            model: diffusion model
+            data: test data of the sampler
+            save_dir: save directory, the frames are saved as `<vis_type>/<scene_id>+denoise-<i>-t<t>.<vis_type>`
+            scene_id: name of the frames
+            stride: sampling steps between two frames
+            k: the number of samples per condition
+
+        Return:
+            Final samples before denormalization, <k * B, ...>
+        """
+        os.makedirs(os.path.join(save_dir, vis_type), exist_ok=True)
+        for i, (t, x_t, pred_x0) in enumerate(model.iter_sample(data, guid_param, solver, steps, stride=stride, k=k)):
+            self.hand_model.update_kinematics(q=self.denormalize(pred_x0[0:1].to(torch.float32).clone()))
+            fig = go.Figure(data=self.hand_model.get_plotly_data(opacity=1.0, color='pink'))
+            save_path = os.path.join(save_dir, vis_type, f'{scene_id}+denoise-{i:03d}-t{t}.{vis_type}')
+            if vis_type == 'png':
+                fig.write_image(save_path)
+            elif vis_type == 'html':
+                fig.write_html(save_path)
+        return x_t.to(torch.float32)
+
+    @torch.no_grad()
+    def rank_grasps(self, evaluator: torch.nn.Module, candidates: list, obj_bps: list, num_sample: int,
+                    dedup_tol: dict = None) -> tuple:
+        """ Keep the num_sample best grasps of every point cloud of an object, all candidates are scored in one batch
+
+        Args:
+            evaluator: DexEvaluator
+            candidates: denormalized candidate grasps of every point cloud, each <M, D>
+            obj_bps: BPS of every point cloud, each <1, 4096>
+            num_sample: grasps kept per point cloud, at most M
+            dedup_tol: {'trans', 'rot', 'joint'} distances under which two grasps of a point cloud are duplicates,
+                see `diverse_topk`, None keeps the top-k
+
+        Return:
+            Kept grasps and their success probability of every point cloud, each <num_sample, D> and <num_sample, 1>
+        """
+        assert evaluator is not None, 'ranking the grasps requires the evaluator'
+        M = candidates[0].shape[0]
+        assert M >= num_sample, 'fewer candidates than kept grasps'
+        x = torch.cat(candidates)
+        group = torch.arange(len(candidates), device=x.device).repeat_interleave(M)
+        x_eval = self.evaluator_input(x)
+        scores = torch.from_numpy(score_grasps(evaluator, x_eval, torch.cat(obj_bps).cpu(), group.cpu())).to(x.device)
+
+        if dedup_tol is None:
+            keep = segmented_topk(scores, group, num_sample)
+        else:
+            ## compared in the input space of the evaluator: translation, rot6d and joint angles
+            blocks = [(0, 3, dedup_tol['trans']), (3, 9, dedup_tol['rot']), (9, x.shape[1], dedup_tol['joint'])]
+            keep = diverse_topk(x_eval, scores, group, num_sample, blocks)
+        return list(x[keep].split(num_sample)), list(scores[keep, None].split(num_sample))
+
     @torch.no_grad()
     def sample_grasps(
             self,
@@ -110,13 +188,35 @@ class GraspGenURVisualizer():
             evaluator: torch.nn.Module=None,
             device: str = 'cuda',
             num_sample:int =1,
-            vis_type:str = 'html'
+            vis_type:str = 'html',
+            solver: str = None,
+            steps: int = None,
+            guid_last_steps: int = None,
+            guid_timesteps: list = None,
+            guid_reuse_bps: bool = False,
+            vis_denoising: int = None,
+            scene_feat_cache: SceneFeatureCache = None,
+            sample_seed: int = None,
+            num_candidates: int = None,
+            dedup_tol: dict = None,
     ) -> None:
         """ Visualize method
         Args:
             model: diffusion model
             dataloader: test dataloader
             save_dir: save directory of rendering images
+            solver: sampling solver of the diffusion model, None uses the model config
+            steps: number of sampling steps, None uses the model config
+            guid_last_steps: only guide the timesteps t < guid_last_steps, None guides all timesteps
+            guid_timesteps: only guide the listed timesteps, None guides all timesteps
+            guid_reuse_bps: compute the BPS features of the evaluator once per sampling loop
+            vis_denoising: save the predicted x0 of the first sample every `vis_denoising` sampling steps, see `vis_denoising`
+            scene_feat_cache: cache of the condition features by (object, scale, cam_view), None encodes the scene every call
+            sample_seed: seed the noise of every grasp from (sample_seed, object, scale, cam_view, sample index), so the
+                grasps of an object are reproduced alone or in any batch, None uses the global RNG
+            num_candidates: sample num_candidates grasps per point cloud and only keep the num_sample best of the evaluator,
+                see `rank_grasps`, None keeps all num_sample samples
+            dedup_tol: tolerances of the de-duplication of the kept grasps, see `rank_grasps`
         """
         model.eval()        
         os.makedirs(os.path.join(save_dir, 'html'), exist_ok=True)
@@ -133,9 +233,14 @@ class GraspGenURVisualizer():
                'sample_qpos': {},
                }
             
+        ## grasps sampled per point cloud, only the num_sample best are kept when ranked
+        num_draw = num_sample if num_candidates is None else num_candidates
         if guid_scale is not None:
             guid_param = {'evaluator':evaluator,
-                          'guid_scale': guid_scale}
+                          'guid_scale': guid_scale,
+                          'guid_last_steps': guid_last_steps,
+                          'guid_timesteps': guid_timesteps,
+                          'reuse_bps': guid_reuse_bps}
             logger.info("using guided sampling")
         else:
             guid_param = None
@@ -151,39 +256,58 @@ class GraspGenURVisualizer():
             object_scale_list = ['0.06', '0.08', '0.1', '0.12', '0.15']
             p_success_list = []
             for object_name in tqdm(object_name_list):
-                grasp_list = []
+                grasp_list, candidates, candidate_bps = [], [], []
                 for object_scale in object_scale_list:
                     # res['sample_qpos'][object_name] = {}
                     for cam_view in cam_views[:len(cam_views)//5]:
-                        obj_bps = obj_bps_all[object_name][object_scale][cam_view].repeat(num_sample,1)
-                        data = {'x': torch.randn(num_sample, self.cfg.model.d_x, device=device),
+                        ## one condition shared by the num_sample grasps, which are folded into the batch by the sampler
+                        obj_bps = obj_bps_all[object_name][object_scale][cam_view].reshape(1, -1)
+                        data = {'x': torch.randn(1, self.cfg.model.d_x, device=device),
                                 'obj_bps': obj_bps.to(device),
-                                'scene_id': [object_name for i in range(num_sample)],
+                                'scene_id': [object_name],
                         }
                         if True:
-                            data['pos'] = scene_pcds[object_name][object_scale][cam_view].unsqueeze(0).repeat(num_sample,1, 1).to(device)
+                            data['pos'] = scene_pcds[object_name][object_scale][cam_view].unsqueeze(0).to(device)
+                        if sample_seed is not None:
+                            data['seed'] = condition_seeds([(object_name, object_scale, cam_view)], sample_seed, device)
+                        if scene_feat_cache is not None:
+                            data['scene_feat'] = scene_feat_cache.get_or_compute(
+                                (object_name, object_scale, cam_view), lambda: model.eps_model.condition(data), device)
                     
-                        outputs = model.sample(data, k=1,guid_param=guid_param).squeeze(1)[:, -1, :].to(torch.float32)
+                        if vis_denoising is None:
+                            outputs = model.sample(data, k=num_draw,guid_param=guid_param, solver=solver, steps=steps)[0, :, -1, :].to(torch.float32)
+                        else:
+                            outputs = self.vis_denoising(model, data, save_dir, f'{object_name}+{object_scale}+{cam_view}', vis_denoising, guid_param=guid_param,
+                                                         solver=solver, steps=steps, k=num_draw)
                         
                         ## denormalization
-                        if self.cfg.task.dataset.normalize_x:
-                            outputs[:,9:] = angle_denormalize(joint_angle=outputs[:,9:].to(torch.float32).cpu()).cuda()
-                        if self.cfg.task.dataset.normalize_x_trans:
-                            outputs[:, :3] = trans_denormalize(global_trans=outputs[:, :3].cpu()).cuda()
+                        outputs = self.denormalize(outputs)
+                        if num_candidates is not None:
+                            ## ranked with the other point clouds of the object
+                            candidates.append(outputs)
+                            candidate_bps.append(data['obj_bps'])
+                            continue
 
                         ## save visualization
                         if vis_type is not None:
                             self.save_res(vis_type, object_name, save_dir, outputs, None, num_sample, datasetname)
                         
                         if evaluator is not None:
-                            data['x_t'] = outputs
-                            p_success = evaluator(data)['p_success']
+                            p_success = evaluator({'x_t': self.evaluator_input(outputs), 'obj_bps': data['obj_bps'].expand(num_sample, -1)})['p_success']
                             p_success_list.append(p_success.detach().cpu().numpy())
                         
                         grasp_list.append(outputs.cpu().detach().numpy())
                         # scale_list+= [object_scale for _ in range(num_sample)]
                         # import pdb;pdb.set_trace()
 
+                if num_candidates is not None:
+                    survivors, p_success = self.rank_grasps(evaluator, candidates, candidate_bps, num_sample, dedup_tol)
+                    for outputs in survivors:
+                        if vis_type is not None:
+                            self.save_res(vis_type, object_name, save_dir, outputs, None, num_sample, datasetname)
+                        grasp_list.append(outputs.cpu().numpy())
+                    p_success_list += [p.cpu().numpy() for p in p_success]
+
                 # assert np.concatenate(grasp_list).shape[0] == 200
                 res['sample_qpos'][object_name] = np.concatenate(grasp_list)
                 # res['']
@@ -194,36 +318,56 @@ class GraspGenURVisualizer():
         else:
             p_success_list = []
             for object_name in tqdm(object_name_list):
-                grasp_list = []
+                grasp_list, candidates, candidate_bps, candidate_pcds = [], [], [], []
                 for cam_view in cam_views:
-                    obj_pcd_can = torch.from_numpy(scene_pcds['partial_pcs'][object_name][cam_view]).unsqueeze(0).repeat(num_sample,1, 1)
+                    ## one condition shared by the num_sample grasps, which are folded into the batch by the sampler
+                    obj_pcd_can = torch.from_numpy(scene_pcds['partial_pcs'][object_name][cam_view]).unsqueeze(0)
                     
-                    data = {'x': torch.randn(num_sample, self.cfg.model.d_x, device=device),
+                    data = {'x': torch.randn(1, self.cfg.model.d_x, device=device),
                             # 'pos': obj_pcd_rot.to(device),
                             'pos': obj_pcd_can.to(device),
                             # 'scene_rot_mat': i_rot,
-                            'scene_id': [object_name for i in range(num_sample)],
-                            'cam_trans': [None for i in range(num_sample)]}
+                            'scene_id': [object_name],
+                            'cam_trans': [None]}
                     data['obj_bps'] = self.bps.encode(obj_pcd_can,feature_type=['dists'])['dists']
-                    outputs = model.sample(data, k=1,guid_param=guid_param).squeeze(1)[:, -1, :].to(torch.float32)
+                    if sample_seed is not None:
+                        data['seed'] = condition_seeds([(object_name, cam_view)], sample_seed, device)
+                    if scene_feat_cache is not None:
+                        data['scene_feat'] = scene_feat_cache.get_or_compute(
+                            (object_name, cam_view), lambda: model.eps_model.condition(data), device)
+                    if vis_denoising is None:
+                        outputs = model.sample(data, k=num_draw,guid_param=guid_param, solver=solver, steps=steps)[0, :, -1, :].to(torch.float32)
+                    else:
+                        outputs = self.vis_denoising(model, data, save_dir, f'{object_name}+{cam_view}', vis_denoising, guid_param=guid_param,
+                                                     solver=solver, steps=steps, k=num_draw)
                     
                     ## denormalization
-                    if self.cfg.task.dataset.normalize_x:
-                        outputs[:,9:] = angle_denormalize(joint_angle=outputs[:,9:].to(torch.float32).cpu()).cuda()
-                    if self.cfg.task.dataset.normalize_x_trans:
-                        outputs[:, :3] = trans_denormalize(global_trans=outputs[:, :3].cpu()).cuda()
+                    outputs = self.denormalize(outputs)
+                    if num_candidates is not None:
+                        ## ranked with the other point clouds of the object
+                        candidates.append(outputs)
+                        candidate_bps.append(data['obj_bps'])
+                        candidate_pcds.append(obj_pcd_can)
+                        continue
 
                     ## save visualization
                     if vis_type is not None:
-                        self.save_res(vis_type, object_name, save_dir, outputs, obj_pcd_can, num_sample, datasetname)
+                        self.save_res(vis_type, object_name, save_dir, outputs, obj_pcd_can.expand(num_sample, -1, -1), num_sample, datasetname)
                     
                     if evaluator is not None:
-                        data['x_t'] = outputs
-                        p_success = evaluator(data)['p_success']
+                        p_success = evaluator({'x_t': self.evaluator_input(outputs), 'obj_bps': data['obj_bps'].expand(num_sample, -1)})['p_success']
                         p_success_list.append(p_success.detach().cpu().numpy())
                     
                     grasp_list.append(outputs.cpu().detach().numpy())
 
+                if num_candidates is not None:
+                    survivors, p_success = self.rank_grasps(evaluator, candidates, candidate_bps, num_sample, dedup_tol)
+                    for outputs, obj_pcd_can in zip(survivors, candidate_pcds):
+                        if vis_type is not None:
+                            self.save_res(vis_type, object_name, save_dir, outputs, obj_pcd_can.expand(num_sample, -1, -1), num_sample, datasetname)
+                        grasp_list.append(outputs.cpu().numpy())
+                    p_success_list += [p.cpu().numpy() for p in p_success]
+
                 res['sample_qpos'][object_name] = np.concatenate(grasp_list)
             pickle.dump(res, open(os.path.join(save_dir, 'res_diffuser.pkl'), 'wb'))
     
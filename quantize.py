@@ -0,0 +1,85 @@
+import os
+import torch
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+import hydra
+
+from utils.utils import load_ckpt
+from utils.io import mkdir_if_not_exists
+from utils.quantize import quantize_model, save_quantized_ckpt
+from models import create_ddpm, create_evaluator
+from dataset import create_dataset_sampler, collate_fn_general
+
+
+def calibration_batches(cfg: DictConfig) -> list:
+    """ A random slice of the DexGraspNetSamplerAllegro training data
+    """
+    dataset = create_dataset_sampler(cfg, 'train')
+    dataloader = dataset.get_dataloader(
+        batch_size=cfg.quantization.calib_batch_size,
+        collate_fn=collate_fn_general,
+        num_workers=0,
+        shuffle=True,
+    )
+    batches = []
+    for i, data in enumerate(dataloader):
+        if i >= cfg.quantization.calib_batches:
+            break
+        batches.append(data)
+    logger.info(f'{len(batches)} calibration batches of {cfg.quantization.calib_batch_size} grasps')
+    return batches
+
+def calibrate_sampler(model: torch.nn.Module, batches: list) -> None:
+    """ Run the noise prediction of the training objective, over timesteps drawn uniformly
+    """
+    for data in batches:
+        B = data['x'].shape[0]
+        ts = torch.randint(0, model.timesteps, (B, )).long()
+        x_t = model.q_sample(x0=data['x'], t=ts, noise=torch.randn_like(data['x']))
+        model.eps_model(x_t, ts, model.eps_model.condition(data))
+
+def calibrate_evaluator(evaluator: torch.nn.Module, batches: list) -> None:
+    for data in batches:
+        if 'obj_bps' not in data:
+            raise Exception('Static calibration of the evaluator needs obj_bps, use model=unet_grasp_bps.')
+        evaluator({'x_t': data['x'], 'obj_bps': data['obj_bps']})
+
+
+@hydra.main(version_base=None, config_path="./configs", config_name="sample")
+def main(cfg: DictConfig) -> None:
+    ## the quantized kernels run on CPU
+    mode = cfg.quantization.mode
+    mkdir_if_not_exists(cfg.quantization.output_dir)
+    logger.info('Quantization: \n' + OmegaConf.to_yaml(cfg.quantization))
+
+    batches = calibration_batches(cfg) if mode == 'static' else None
+
+    if 'sampler' in cfg.quantization.models:
+        model = create_ddpm(cfg)
+        if cfg.model.scene_model.name == 'obj_bps':
+            sampler_pth, name = cfg.sampler_bps_ckpt_pth, 'bps'
+        elif cfg.model.scene_model.name == 'PointNet2':
+            sampler_pth, name = cfg.sampler_pn2_ckpt_pth, 'pn2'
+        else:
+            raise NotImplementedError
+        load_ckpt(model, path=sampler_pth)
+        model.eval()
+
+        quantize_model(model, mode, calibrate=lambda m: calibrate_sampler(m, batches))
+        save_quantized_ckpt(model, mode, os.path.join(cfg.quantization.output_dir, f'sampler_{name}_int8_{mode}.pth'))
+
+    if 'evaluator' in cfg.quantization.models:
+        evaluator = create_evaluator(cfg, pos_enc_multires=[10, 4, -1])
+        load_ckpt(evaluator, path=cfg.evaluator_ckpt_pth)
+        evaluator.device = 'cpu'
+        evaluator.eval()
+
+        quantize_model(evaluator, mode, calibrate=lambda m: calibrate_evaluator(m, batches))
+        save_quantized_ckpt(evaluator, mode, os.path.join(cfg.quantization.output_dir, f'evaluator_int8_{mode}.pth'))
+
+    logger.info('done!')
+
+if __name__ == '__main__':
+    ## set random seed
+    torch.manual_seed(0)
+    main()
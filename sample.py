@@ -5,10 +5,11 @@ import random
 import numpy as np
 from omegaconf import DictConfig, OmegaConf
 from loguru import logger
-from utils.utils import load_ckpt
+from utils.utils import load_ckpt, autocast
 from utils.io import mkdir_if_not_exists
 import hydra
 from models import create_ddpm, create_evaluator, create_visualizer
+from models.model.scene_cache import SceneFeatureCache
 
 @hydra.main(version_base=None, config_path="./configs", config_name="sample")
 def main(cfg: DictConfig) -> None:
@@ -44,17 +45,41 @@ def main(cfg: DictConfig) -> None:
     load_ckpt(model, path=sampler_pth)
     load_ckpt(evaluator, path=cfg.evaluator_ckpt_pth)
     
+    ## condition features of the scene model by (object, scale, cam_view), only valid for the weights of sampler_pth
+    scene_feat_cache = None
+    enable_cache = cfg.scene_feat_cache.enable
+    if enable_cache is None:
+        ## obj_bps is its own feature, and random_condition must be drawn anew at every call
+        enable_cache = cfg.model.scene_model.name == 'PointNet2'
+    if enable_cache:
+        scene_feat_cache = SceneFeatureCache(cfg.scene_feat_cache.size, tag=sampler_pth)
+        if cfg.scene_feat_cache.path is not None:
+            scene_feat_cache.load(cfg.scene_feat_cache.path, device)
+
     ## create visualizer and visualize
     visualizer = create_visualizer(cfg, scale=True)
-    visualizer.sample_grasps(model, 
-                         cfg.dataset_name,
-                         cfg.data_root, 
-                         vis_dir, 
-                         cam_views=cfg.cam_views, 
-                         evaluator=evaluator, 
-                         guid_scale=cfg.guid_scale, 
-                         num_sample=cfg.num_sample,
-                         vis_type=None)
+    with autocast(device, cfg.get('amp_dtype', None)):
+        visualizer.sample_grasps(model, 
+                             cfg.dataset_name,
+                             cfg.data_root, 
+                             vis_dir, 
+                             cam_views=cfg.cam_views, 
+                             evaluator=evaluator, 
+                             guid_scale=cfg.guid_scale, 
+                             num_sample=cfg.num_sample,
+                             vis_type=None,
+                             solver=cfg.solver,
+                             steps=cfg.sample_steps,
+                             guid_last_steps=cfg.guid_last_steps,
+                             guid_timesteps=cfg.guid_timesteps,
+                             guid_reuse_bps=cfg.guid_reuse_bps,
+                             vis_denoising=cfg.get('vis_denoising', None),
+                             scene_feat_cache=scene_feat_cache,
+                             sample_seed=cfg.get('sample_seed', None),
+                             num_candidates=cfg.rank.num_candidates,
+                             dedup_tol=cfg.rank.dedup)
+    if scene_feat_cache is not None and cfg.scene_feat_cache.path is not None:
+        scene_feat_cache.save(cfg.scene_feat_cache.path)
     logger.info('done!') # set logger file
 
 if __name__ == '__main__':
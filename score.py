@@ -0,0 +1,112 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import json
+import pickle
+import argparse
+from loguru import logger
+
+import torch
+import numpy as np
+
+from models import create_evaluator
+from utils.utils import load_ckpt
+from utils.handmodel import evaluator_normalize
+from utils.scoring import score_grasps
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Score the grasps of res_diffuser.pkl with the evaluator')
+    parser.add_argument('--eval_dir', type=str, required=True,
+                        help='evaluation directory path of <dataset_name>/res_diffuser.pkl')
+    parser.add_argument('--ckpt_evaluator', type=str, default='ckpts/10_4_0_evaluator/model_20.pth')
+    parser.add_argument('--pos_enc_multires', type=int, nargs=3, default=[10, 4, -1])
+    parser.add_argument('--data_dir', type=str, default='/proj/berzelius-2023-338/users/x_haolu/dexdiffuser_data')
+    parser.add_argument('--dataset_name', type=str, default='multidex')
+    parser.add_argument('--grasp_number_per_object', type=int, default=20, help='grasps per point cloud')
+    parser.add_argument('--cam_views', type=int, nargs='+', default=None,
+                        help='camera views of the point clouds in the order of the grasps, defaults to 0, 1, ...')
+    parser.add_argument('--max_mem', type=int, default=1024, help='activation memory budget of one chunk in MB')
+    parser.add_argument('--no_normalize_x', action='store_true', default=False,
+                        help='the evaluator takes denormalized joint angles, i.e., task.dataset.normalize_x is false')
+    parser.add_argument('--normalize_x_trans', action='store_true', default=False,
+                        help='the evaluator takes normalized translations, i.e., task.dataset.normalize_x_trans is true')
+    parser.add_argument('--fuse', action='store_true', default=False, help='fold the batch norms of the evaluator')
+    parser.add_argument('--output', type=str, default=None, help='defaults to <eval_dir>/<dataset_name>/scores.npy')
+    parser.add_argument('--device', type=str, default='cuda')
+    return parser.parse_args()
+
+def load_grasp_index(args: argparse.Namespace, res: dict) -> tuple:
+    """ Flatten the grasps of res_diffuser.pkl and index the BPS of their point clouds
+
+    The grasps of an object are stored point cloud by point cloud, `grasp_number_per_object` each, and for
+    dexgraspnet scale by scale, see `GraspGenURVisualizer.sample_grasps`.
+
+    Return:
+        (grasps <N, d_x>, obj_bps_index <M, 4096>, object_ids <N>, {object_name: [start, end]})
+    """
+    n = args.grasp_number_per_object
+    if args.dataset_name == 'dexgraspnet':
+        obj_bps_all = torch.load(os.path.join(args.data_dir, 'obj_bps_dist_full.pt'))
+        object_scale_list = ['0.06', '0.08', '0.1', '0.12', '0.15']
+    else:
+        from bps_torch.bps import bps_torch
+        scene_pcds = pickle.load(open(os.path.join(args.data_dir, f'pc_data_{args.dataset_name}.pickle'), 'rb'))['partial_pcs']
+        bps = bps_torch(n_bps_points=4096, n_dims=3, custom_basis=np.load('./models/basis_point_set.npy'))
+
+    grasps, obj_bps_index, object_ids, ranges = [], [], [], {}
+    start = 0
+    for object_name, q in res['sample_qpos'].items():
+        num_pcds = len(q) // n
+        if args.dataset_name == 'dexgraspnet':
+            num_views = num_pcds // len(object_scale_list)
+            cam_views = args.cam_views if args.cam_views is not None else list(range(num_views))
+            keys = [(scale, cam_views[j]) for scale in object_scale_list for j in range(num_views)]
+            bps_list = [obj_bps_all[object_name][scale][cam_view].reshape(1, -1) for scale, cam_view in keys]
+        else:
+            cam_views = args.cam_views if args.cam_views is not None else list(range(num_pcds))
+            bps_list = [bps.encode(torch.from_numpy(scene_pcds[object_name][cam_views[j]]).unsqueeze(0),
+                                   feature_type=['dists'])['dists'].cpu() for j in range(num_pcds)]
+
+        object_ids.append(np.repeat(np.arange(len(obj_bps_index), len(obj_bps_index) + num_pcds), n))
+        obj_bps_index += [b.to(torch.float32).cpu() for b in bps_list]
+        grasps.append(np.asarray(q[:num_pcds * n], dtype=np.float32))
+        ranges[object_name] = [start, start + num_pcds * n]
+        start += num_pcds * n
+
+    return np.concatenate(grasps), torch.cat(obj_bps_index), np.concatenate(object_ids), ranges
+
+def main():
+    args = parse_args()
+    device = args.device
+
+    evaluator = create_evaluator(pos_enc_multires=args.pos_enc_multires)
+    evaluator.device = device
+    load_ckpt(evaluator, path=args.ckpt_evaluator)
+    evaluator.to(device=device)
+    evaluator.eval()
+    if args.fuse:
+        evaluator.fuse_for_inference()
+
+    res = pickle.load(open(os.path.join(args.eval_dir, args.dataset_name, 'res_diffuser.pkl'), 'rb'))
+    grasps, obj_bps_index, object_ids, ranges = load_grasp_index(args, res)
+    logger.info(f'Scoring {len(grasps)} grasps of {len(ranges)} objects and {len(obj_bps_index)} point clouds')
+
+    ## the grasps are normalized as the evaluator dataset, see `GraspGenURVisualizer.evaluator_input`
+    def normalize(x_t):
+        return evaluator_normalize(x_t, not args.no_normalize_x, args.normalize_x_trans)
+
+    output = args.output if args.output is not None else os.path.join(args.eval_dir, args.dataset_name, 'scores.npy')
+    scores = score_grasps(evaluator, grasps, obj_bps_index, object_ids, max_mem=args.max_mem * 2 ** 20, output=output,
+                          transform=normalize)
+    with open(os.path.splitext(output)[0] + '_objects.json', 'w') as f:
+        json.dump(ranges, f)
+
+    for object_name, (start, end) in ranges.items():
+        logger.info(f'{object_name}: mean p_success {scores[start:end].mean():.4f}')
+    logger.info(f'Done! mean p_success {scores.mean():.4f}')
+
+if __name__ == '__main__':
+    main()
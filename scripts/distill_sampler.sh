@@ -0,0 +1,13 @@
+EXP_NAME=dexdiffuser_distill
+MODEL=$1 #['bps', 'pn2']
+TEACHER=$2
+
+python distill.py hydra/job_logging=none hydra/hydra_logging=none \
+                exp_name=${EXP_NAME} \
+                diffuser=ddpm \
+                diffuser.loss_type=l1 \
+                diffuser.steps=100 \
+                model=unet_grasp_${MODEL} \
+                task=grasp_gen_ur_dexgn_slurm \
+                teacher_ckpt_pth=${TEACHER} \
+                distill.student_steps=4
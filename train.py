@@ -6,7 +6,7 @@ from loguru import logger
 # from utils.misc import compute_model_dim
 from utils.io import mkdir_if_not_exists
 from utils.plot import Ploter
-from utils.utils import save_ckpt, load_ckpt
+from utils.utils import save_ckpt, load_ckpt, autocast
 import hydra
 from omegaconf import DictConfig, OmegaConf
 from models import create_ddpm, create_evaluator, create_visualizer
@@ -99,7 +99,9 @@ def train(cfg) -> None:
 
             optimizer.zero_grad()
             data['epoch'] = epoch
-            outputs = model(data)
+            ## bf16 needs no loss scaling, the backward pass runs outside the autocast region
+            with autocast(device, cfg.get('amp_dtype', None)):
+                outputs = model(data)
             loss = outputs['loss'].mean()
             loss.backward()
             # outputs['loss'].backward()
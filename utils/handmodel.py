@@ -407,6 +407,14 @@ def angle_denormalize(joint_angle: torch.Tensor):
     joint_angle_denorm = joint_angle_denorm * (_joint_angle_upper.to(device) - _joint_angle_lower.to(device)) + _joint_angle_lower.to(device)
     return joint_angle_denorm
 
+def evaluator_normalize(x: torch.Tensor, normalize_x: bool=True, normalize_x_trans: bool=False):
+    """ Denormalized grasps in the input space of the evaluator, i.e., normalized as in its dataset,
+    the returned grasps are a copy
+    """
+    trans = trans_normalize(global_trans=x[:, :3]) if normalize_x_trans else x[:, :3]
+    joint_angle = angle_normalize(joint_angle=x[:, 9:]) if normalize_x else x[:, 9:]
+    return torch.cat([trans, x[:, 3:9], joint_angle], dim=1)
+
 
 if __name__ == '__main__':
     from plotly_utils import plot_point_cloud
@@ -0,0 +1,121 @@
+import os
+from typing import List
+import numpy as np
+import torch
+import torch.nn as nn
+from loguru import logger
+
+from models.dm.schedule import COEF_PACK_KEYS
+from models.model.denoise_step import DenoiseStep
+
+
+class OnnxConditionCache(nn.Module):
+    """ Cross-attention keys and values of the BPS condition, flattened in [block][depth] order
+    """
+    def __init__(self, unet: nn.Module) -> None:
+        super().__init__()
+        if unet.scene_model_name != 'obj_bps':
+            raise Exception('Unsupported scene model for onnx export, only obj_bps is supported.')
+        self.unet = unet
+
+    def forward(self, obj_bps: torch.Tensor) -> tuple:
+        cond_cache = self.unet.condition_cache(self.unet.condition({'obj_bps': obj_bps}))
+        return tuple(t for block in cond_cache for kv in block for t in kv)
+
+
+class OnnxDenoiseStep(nn.Module):
+    """ `DenoiseStep` with the condition cache as flat inputs, in the order of `OnnxConditionCache`
+    """
+    def __init__(self, unet: nn.Module) -> None:
+        super().__init__()
+        self.step = DenoiseStep(unet)
+        self.nblocks = unet.nblocks
+        self.depth = unet.transformer_depth
+
+    def forward(self, x_t: torch.Tensor, ts: torch.Tensor, *kv: torch.Tensor) -> torch.Tensor:
+        cond_cache = [[(kv[2 * (i * self.depth + j)], kv[2 * (i * self.depth + j) + 1]) for j in range(self.depth)]
+                      for i in range(self.nblocks)]
+        return self.step(x_t, ts, cond_cache)
+
+
+class OnnxEvaluator(nn.Module):
+    """ DexEvaluator as a function of (x_t, obj_bps), the positional embedding is traced into the graph,
+    the BPS products are traced without the per-object dedup of eval mode
+    """
+    def __init__(self, evaluator: nn.Module) -> None:
+        super().__init__()
+        self.evaluator = evaluator
+
+    def forward(self, x_t: torch.Tensor, obj_bps: torch.Tensor) -> torch.Tensor:
+        if self.evaluator.split_bps and self.evaluator.can_split_bps():
+            return self.evaluator({'x_t': x_t, 'obj_bps_feat': self.evaluator.bps_features(obj_bps)})['p_success']
+        return self.evaluator({'x_t': x_t, 'obj_bps': obj_bps})['p_success']
+
+
+def kv_names(unet: nn.Module) -> List[str]:
+    return [f'{kv}_{i}_{j}' for i in range(unet.nblocks) for j in range(unet.transformer_depth) for kv in ('k', 'v')]
+
+@torch.no_grad()
+def export_sampler(model: nn.Module, output_dir: str, name: str, opset: int=17, in_bps: int=4096) -> List[str]:
+    """ Export the sampler as a condition graph, a denoising step graph and the schedule coefficients
+
+    Args:
+        model: DDPM in eval mode on CPU, with an obj_bps UNet
+        output_dir: directory of the exported files
+        name: name of the sampler, e.g., 'bps'
+        opset: onnx opset version
+
+    Return:
+        Paths of `sampler_<name>_condition.onnx`, `sampler_<name>_step.onnx` and `sampler_<name>_schedule.npz`
+    """
+    unet = model.eps_model
+    names = kv_names(unet)
+    B, k = 2, 2
+    obj_bps = torch.rand(B, in_bps)
+    condition = OnnxConditionCache(unet).eval()
+    cond_cache = condition(obj_bps)
+
+    condition_pth = os.path.join(output_dir, f'sampler_{name}_condition.onnx')
+    torch.onnx.export(condition, (obj_bps, ), condition_pth, opset_version=opset,
+                      input_names=['obj_bps'], output_names=names,
+                      dynamic_axes={'obj_bps': {0: 'b'}, **{n: {0: 'bh'} for n in names}})
+
+    ## k samples share one condition, the queries are folded sample-major into the batch as in `DDPM.p_sample_loop`
+    step = OnnxDenoiseStep(unet).eval()
+    x_t = torch.randn(k * B, unet.d_x)
+    ts = torch.tensor([model.timesteps - 1])
+    step_pth = os.path.join(output_dir, f'sampler_{name}_step.onnx')
+    torch.onnx.export(step, (x_t, ts, *cond_cache), step_pth, opset_version=opset,
+                      input_names=['x_t', 'ts'] + names, output_names=['pred_noise'],
+                      dynamic_axes={'x_t': {0: 'n'}, 'pred_noise': {0: 'n'}, **{n: {0: 'bh'} for n in names}})
+
+    schedule_pth = os.path.join(output_dir, f'sampler_{name}_schedule.npz')
+    np.savez(schedule_pth,
+             coef_pack=model.coef_pack().cpu().double().numpy(),
+             coef_keys=np.array(COEF_PACK_KEYS),
+             alphas_cumprod=model.alphas_cumprod.cpu().double().numpy(),
+             timestep_spacing=np.array(model.timestep_spacing),
+             d_x=np.array(unet.d_x))
+
+    logger.info(f'Exported the {name} sampler to {output_dir}')
+    return [condition_pth, step_pth, schedule_pth]
+
+@torch.no_grad()
+def export_evaluator(evaluator: nn.Module, output_dir: str, opset: int=17, d_x: int=25) -> str:
+    """ Export DexEvaluator as `evaluator.onnx` with inputs (x_t, obj_bps) and output p_success
+
+    Args:
+        evaluator: DexEvaluator in eval mode on CPU
+        output_dir: directory of the exported file
+        opset: onnx opset version
+    """
+    B = 2
+    x_t = torch.randn(B, d_x)
+    obj_bps = torch.rand(B, evaluator.in_bps)
+    evaluator_pth = os.path.join(output_dir, 'evaluator.onnx')
+    torch.onnx.export(OnnxEvaluator(evaluator).eval(), (x_t, obj_bps), evaluator_pth, opset_version=opset,
+                      input_names=['x_t', 'obj_bps'], output_names=['p_success'],
+                      dynamic_axes={'x_t': {0: 'n'}, 'obj_bps': {0: 'n'}, 'p_success': {0: 'n'}})
+
+    logger.info(f'Exported the evaluator to {output_dir}')
+    return evaluator_pth
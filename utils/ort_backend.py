@@ -0,0 +1,131 @@
+""" ONNX Runtime inference of the sampler and the evaluator exported by export_onnx.py
+
+Only NumPy and onnxruntime are needed, i.e., no PyTorch, pytorch3d or bps_torch, so keep this
+module free of torch imports.
+"""
+import os
+from typing import Dict, List
+import numpy as np
+import onnxruntime as ort
+
+
+def make_session(path: str, threads: int=None) -> ort.InferenceSession:
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads is not None:
+        options.intra_op_num_threads = threads
+    return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+class OrtSampler:
+    """ DDPM sampling loop of an exported sampler, the counterpart of `DDPM.sample` with the 'ddpm'
+    and 'ddim' solvers and without guidance
+    """
+    def __init__(self, model_dir: str, name: str='bps', threads: int=None) -> None:
+        self.condition = make_session(os.path.join(model_dir, f'sampler_{name}_condition.onnx'), threads)
+        self.step = make_session(os.path.join(model_dir, f'sampler_{name}_step.onnx'), threads)
+        self.kv_names = [o.name for o in self.condition.get_outputs()]
+
+        schedule = np.load(os.path.join(model_dir, f'sampler_{name}_schedule.npz'))
+        self.coef_rows = schedule['coef_pack'].tolist()
+        self.coef = {str(k): i for i, k in enumerate(schedule['coef_keys'])}
+        self.alphas_cumprod = schedule['alphas_cumprod']
+        self.timesteps = len(self.alphas_cumprod)
+        self.timestep_spacing = str(schedule['timestep_spacing'])
+        self.d_x = int(schedule['d_x'])
+        ## 1-element timestep inputs
+        self.ts = [np.array([t], dtype=np.int64) for t in range(self.timesteps)]
+
+    def condition_cache(self, obj_bps: np.ndarray) -> Dict:
+        """ Cross-attention keys and values of the condition, fixed during the whole loop
+        """
+        outputs = self.condition.run(self.kv_names, {'obj_bps': obj_bps.astype(np.float32)})
+        return dict(zip(self.kv_names, outputs))
+
+    def predict_noise(self, x_t: np.ndarray, t: int, cond_cache: Dict) -> np.ndarray:
+        return self.step.run(['pred_noise'], {'x_t': x_t, 'ts': self.ts[t], **cond_cache})[0]
+
+    def make_timesteps(self, steps: int=None) -> List[int]:
+        """ Strided subset of the diffusion timesteps, as `DDPM.make_timesteps`
+        """
+        if steps is None or steps >= self.timesteps:
+            return list(reversed(range(0, self.timesteps)))
+        if self.timestep_spacing == 'linspace':
+            ts = np.linspace(0, self.timesteps - 1, steps).round().astype(np.int64)
+            return sorted(set(ts.tolist()), reverse=True)
+        elif self.timestep_spacing == 'halving':
+            stride = 1
+            while (self.timesteps + stride - 1) // stride > steps:
+                stride *= 2
+            return list(range(self.timesteps - 1, -1, -stride))
+        else:
+            raise Exception('Unsupported timestep spacing.')
+
+    def p_sample(self, x_t: np.ndarray, t: int, cond_cache: Dict, rng: np.random.Generator) -> np.ndarray:
+        """ Fused DDPM reverse step, see `make_coef_pack` """
+        coefs = self.coef_rows[t]
+        pred_noise = self.predict_noise(x_t, t, cond_cache)
+        x = coefs[self.coef['step_x_coef']] * x_t + coefs[self.coef['step_eps_coef']] * pred_noise
+        if t > 0:
+            x += coefs[self.coef['step_std']] * rng.standard_normal(x_t.shape, dtype=np.float32)
+        return x.astype(np.float32)
+
+    def ddim_sample(self, x_t: np.ndarray, t: int, t_prev: int, cond_cache: Dict, eta: float,
+                    rng: np.random.Generator) -> np.ndarray:
+        """ DDIM step from t to t_prev, see `DDPM.ddim_sample` """
+        coefs = self.coef_rows[t]
+        pred_noise = self.predict_noise(x_t, t, cond_cache)
+        pred_x0 = coefs[self.coef['sqrt_recip_alphas_cumprod']] * x_t - coefs[self.coef['sqrt_recipm1_alphas_cumprod']] * pred_noise
+
+        alpha_bar = self.alphas_cumprod[t]
+        alpha_bar_prev = self.alphas_cumprod[t_prev] if t_prev >= 0 else 1.
+        sigma = eta * np.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar) * (1 - alpha_bar / alpha_bar_prev))
+        x = np.sqrt(alpha_bar_prev) * pred_x0 + np.sqrt(max(1 - alpha_bar_prev - sigma ** 2, 0.)) * pred_noise
+        if t_prev >= 0 and sigma > 0:
+            x += sigma * rng.standard_normal(x_t.shape, dtype=np.float32)
+        return x.astype(np.float32)
+
+    def sample(self, obj_bps: np.ndarray, k: int=1, solver: str='ddpm', steps: int=None, eta: float=0.,
+               seed: int=None) -> np.ndarray:
+        """ Sample k grasps of every object
+
+        Args:
+            obj_bps: basis point set of the objects, <B, 4096>
+            k: the number of samples per object, folded sample-major into the batch
+            solver: 'ddpm' or 'ddim'
+            steps: number of ddim steps, None uses all diffusion steps
+            eta: stochasticity of ddim
+            seed: seed of the noise
+
+        Return:
+            Sampled data, <B, k, d_x>
+        """
+        rng = np.random.default_rng(seed)
+        B = obj_bps.shape[0]
+        cond_cache = self.condition_cache(obj_bps)
+        x_t = rng.standard_normal((k * B, self.d_x), dtype=np.float32)
+
+        if solver == 'ddpm':
+            for t in reversed(range(0, self.timesteps)):
+                x_t = self.p_sample(x_t, t, cond_cache, rng)
+        elif solver == 'ddim':
+            timesteps = self.make_timesteps(steps)
+            for i, t in enumerate(timesteps):
+                t_prev = timesteps[i + 1] if i + 1 < len(timesteps) else -1
+                x_t = self.ddim_sample(x_t, t, t_prev, cond_cache, eta, rng)
+        else:
+            raise Exception('Unsupported solver of the onnx runtime backend.')
+
+        return x_t.reshape(k, B, self.d_x).transpose(1, 0, 2)
+
+
+class OrtEvaluator:
+    """ Grasp scoring with an exported DexEvaluator
+    """
+    def __init__(self, model_dir: str, threads: int=None) -> None:
+        self.session = make_session(os.path.join(model_dir, 'evaluator.onnx'), threads)
+
+    def __call__(self, x_t: np.ndarray, obj_bps: np.ndarray) -> np.ndarray:
+        """ Success probability of the grasps x_t <N, d_x> on the objects obj_bps <N, 4096>, <N, 1>
+        """
+        return self.session.run(['p_success'], {'x_t': x_t.astype(np.float32), 'obj_bps': obj_bps.astype(np.float32)})[0]
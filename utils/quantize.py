@@ -0,0 +1,179 @@
+from typing import Callable, Tuple
+import torch
+import torch.nn as nn
+from loguru import logger
+
+from utils.utils import load_ckpt
+
+try:
+    import torch.ao.nn.quantized as nnq
+    import torch.ao.nn.quantized.dynamic as nnqd
+    from torch.ao.quantization import MinMaxObserver, PerChannelMinMaxObserver, per_channel_dynamic_qconfig
+except ImportError: # torch<1.13
+    import torch.nn.quantized as nnq
+    import torch.nn.quantized.dynamic as nnqd
+    from torch.quantization import MinMaxObserver, PerChannelMinMaxObserver, per_channel_dynamic_qconfig
+
+## the quantized kernels run on CPU only, the scene encoders are kept in float, and so is the
+## time embedding MLP of UNetModel, which is tabulated once at eval time
+SKIP_MODULES = ('scene_model', 'time_embed')
+
+
+class Conv1dAsLinear(nn.Module):
+    """ Conv1d with kernel size 1 as a linear layer over the channels, so that it is quantized as nn.Linear
+    """
+    def __init__(self, conv: nn.Conv1d) -> None:
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[..., 0])
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+class ObservedLinear(nn.Module):
+    """ Linear layer recording the ranges of its input and output activations during calibration
+    """
+    def __init__(self, linear: nn.Linear) -> None:
+        super().__init__()
+        self.linear = linear
+        self.input_observer = MinMaxObserver(dtype=torch.quint8, reduce_range=True)
+        self.output_observer = MinMaxObserver(dtype=torch.quint8, reduce_range=True)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.linear(self.input_observer(x))
+        return self.output_observer(out)
+
+
+class StaticQuantLinear(nn.Module):
+    """ Linear layer with per-channel int8 weights and calibrated uint8 input and output activations,
+    the input is quantized and the output dequantized around the quantized kernel
+    """
+    def __init__(self, observed: ObservedLinear) -> None:
+        super().__init__()
+        linear = observed.linear
+        weight_observer = PerChannelMinMaxObserver(dtype=torch.qint8, qscheme=torch.per_channel_symmetric)
+        weight = linear.weight.detach().float()
+        weight_observer(weight)
+        weight_scale, weight_zero_point = weight_observer.calculate_qparams()
+        qweight = torch.quantize_per_channel(weight, weight_scale.double(), weight_zero_point.long(), 0, torch.qint8)
+
+        self.qlinear = nnq.Linear(linear.in_features, linear.out_features, bias_=linear.bias is not None)
+        self.qlinear.set_weight_bias(qweight, None if linear.bias is None else linear.bias.detach().float())
+        output_scale, output_zero_point = observed.output_observer.calculate_qparams()
+        self.qlinear.scale = float(output_scale)
+        self.qlinear.zero_point = int(output_zero_point)
+
+        input_scale, input_zero_point = observed.input_observer.calculate_qparams()
+        self.register_buffer('input_scale', input_scale.float())
+        self.register_buffer('input_zero_point', input_zero_point.long())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        qx = torch.quantize_per_tensor(x.reshape(-1, shape[-1]), float(self.input_scale), int(self.input_zero_point), torch.quint8)
+        return self.qlinear(qx).dequantize().reshape(list(shape[:-1]) + [-1])
+
+
+def replace_modules(model: nn.Module, fn: Callable, skip: Tuple=SKIP_MODULES) -> nn.Module:
+    """ Replace every submodule m for which fn(m) returns a module, the subtrees named in skip are left untouched
+    """
+    for name, child in model.named_children():
+        if name in skip:
+            continue
+        new = fn(child)
+        if new is not None:
+            setattr(model, name, new)
+        else:
+            replace_modules(child, fn, skip)
+    return model
+
+def is_pointwise_conv1d(m: nn.Module) -> bool:
+    return isinstance(m, nn.Conv1d) and m.kernel_size == (1, ) and m.stride == (1, ) and m.padding == (0, ) \
+        and m.dilation == (1, ) and m.groups == 1
+
+def convert_pointwise_conv1d(model: nn.Module, skip: Tuple=SKIP_MODULES) -> nn.Module:
+    """ Replace the Conv1d layers with kernel size 1 by equivalent linear layers
+    """
+    return replace_modules(model, lambda m: Conv1dAsLinear(m) if is_pointwise_conv1d(m) else None, skip)
+
+def quantize_dynamic(model: nn.Module, skip: Tuple=SKIP_MODULES) -> nn.Module:
+    """ Dynamic int8 quantization of the linear and pointwise Conv1d layers, the activation ranges are
+    computed on the fly at every call, so no calibration is needed
+
+    Args:
+        model: float model on CPU, e.g., DDPM or DexEvaluator
+        skip: names of the submodules kept in float
+
+    Return:
+        The quantized model, modified in place
+    """
+    def quantize(m):
+        if type(m) != nn.Linear:
+            return None
+        m.qconfig = per_channel_dynamic_qconfig
+        return nnqd.Linear.from_float(m)
+
+    convert_pointwise_conv1d(model, skip)
+    return replace_modules(model, quantize, skip)
+
+def prepare_static(model: nn.Module, skip: Tuple=SKIP_MODULES) -> nn.Module:
+    """ Insert the activation observers of static int8 quantization, run the calibration data through
+    the model and then call `convert_static`
+    """
+    convert_pointwise_conv1d(model, skip)
+    return replace_modules(model, lambda m: ObservedLinear(m) if type(m) == nn.Linear else None, skip)
+
+def convert_static(model: nn.Module) -> nn.Module:
+    """ Replace the calibrated linear layers by statically quantized ones
+    """
+    return replace_modules(model, lambda m: StaticQuantLinear(m) if isinstance(m, ObservedLinear) else None, skip=())
+
+def quantize_model(model: nn.Module, mode: str, calibrate: Callable=None) -> nn.Module:
+    """ Quantize a float model
+
+    Args:
+        model: float model on CPU, in eval mode
+        mode: 'dynamic' or 'static'
+        calibrate: runs the calibration data through the prepared model, required by 'static'
+
+    Return:
+        The quantized model, modified in place
+    """
+    if mode == 'dynamic':
+        return quantize_dynamic(model)
+    elif mode == 'static':
+        prepare_static(model)
+        if calibrate is not None:
+            with torch.no_grad():
+                calibrate(model)
+        return convert_static(model)
+    else:
+        raise Exception('Unsupported quantization mode.')
+
+def save_quantized_ckpt(model: nn.Module, mode: str, path: str) -> None:
+    """ Save a quantized model, in the format of `save_ckpt` with the quantization mode
+    """
+    logger.info(f'Saving {mode} int8 model!!!')
+    torch.save({
+        'model': model.state_dict(),
+        'quantization': mode,
+    }, path)
+
+def load_quantized_ckpt(model: nn.Module, path: str) -> nn.Module:
+    """ Quantize the float model as the saved one, then load the quantized weights and activation ranges
+
+    Args:
+        model: float model of the same config, on CPU
+        path: ckpt saved by `save_quantized_ckpt`
+
+    Return:
+        The quantized model, modified in place
+    """
+    mode = torch.load(path, map_location='cpu')['quantization']
+    ## the structure only, the quantization parameters are overwritten by the ckpt
+    quantize_model(model, mode)
+    load_ckpt(model, path)
+    return model
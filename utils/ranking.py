@@ -0,0 +1,80 @@
+from typing import Sequence, Tuple
+import torch
+
+
+def group_layout(scores: torch.Tensor, group: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """ Order of the items by group and then by descending score
+
+    Args:
+        scores: score of every item, <N>
+        group: group index of every item, <N>
+
+    Return:
+        (order <N>, rank of the item order[i] in its group <N>, group id of order[i] in 0..G-1 <N>)
+    """
+    ## two stable sorts, by score and then by group, keep the scores sorted in every group
+    order = torch.sort(scores, descending=True, stable=True).indices
+    order = order[torch.sort(group[order], stable=True).indices]
+    _, group_id, counts = torch.unique_consecutive(group[order], return_inverse=True, return_counts=True)
+    starts = torch.cumsum(counts, dim=0) - counts
+    rank = torch.arange(order.shape[0], device=order.device) - starts[group_id]
+    return order, rank, group_id
+
+def segmented_topk(scores: torch.Tensor, group: torch.Tensor, k: int) -> torch.Tensor:
+    """ Indices of the k best items of every group
+
+    Args:
+        scores: score of every item, <N>
+        group: group index of every item, <N>
+        k: items kept per group, a smaller group is kept whole
+
+    Return:
+        Indices of the kept items, ordered by group and then by descending score
+    """
+    order, rank, _ = group_layout(scores, group)
+    return order[rank < k]
+
+def diverse_topk(x: torch.Tensor, scores: torch.Tensor, group: torch.Tensor, k: int,
+                 blocks: Sequence[Tuple[int, int, float]], fill: bool=True) -> torch.Tensor:
+    """ Greedy diverse top-k of every group: the items are visited by descending score, and an item is
+    kept unless it is a duplicate of a better kept item of its group, i.e., closer than the tolerance
+    in every block of dimensions. All groups are processed at once, padded to the largest group.
+
+    Args:
+        x: items, e.g., grasps, <N, D>
+        scores: score of every item, <N>
+        group: group index of every item, <N>
+        k: items kept per group
+        blocks: (start, end, tol) of the dimensions compared with the Euclidean distance, e.g., the translation,
+            the rotation and the joint angles of a grasp
+        fill: fill the groups with fewer than k diverse items with their best duplicates
+
+    Return:
+        Indices of the kept items, ordered by group and then by descending score
+    """
+    order, rank, group_id = group_layout(scores, group)
+    G, M = int(group_id.max()) + 1, int(rank.max()) + 1
+    pad = torch.full((G, M), -1, dtype=torch.long, device=x.device)
+    pad[group_id, rank] = order
+    valid = pad >= 0
+    X = x[pad.clamp(min=0)]
+
+    ## duplicates are within the tolerance of every block, <G, M, M>
+    dup = torch.ones((G, M, M), dtype=torch.bool, device=x.device)
+    for start, end, tol in blocks:
+        dup &= torch.cdist(X[..., start:end], X[..., start:end]) < tol
+
+    keep = torch.zeros_like(valid)
+    suppressed = torch.zeros_like(valid)
+    kept = torch.zeros(G, dtype=torch.long, device=x.device)
+    for i in range(M):
+        cand = valid[:, i] & ~suppressed[:, i] & (kept < k)
+        keep[:, i] = cand
+        kept += cand
+        suppressed |= cand[:, None] & dup[:, i]
+
+    if fill:
+        ## the best remaining items of the groups short of k
+        rest = valid & ~keep
+        keep |= rest & (rest.cumsum(dim=1) <= (k - kept)[:, None])
+    return pad[keep]
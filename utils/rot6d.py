@@ -2,6 +2,8 @@ import torch
 import numpy as np
 import transforms3d
 
+from utils.utils import fp32_island
+
 
 def random_rot(device='cuda'):
     rot_angles = np.random.random(3) * np.pi * 2
@@ -52,6 +54,7 @@ def compute_rotation_matrix_from_ortho6d(poses):
     return matrix
 
 
+@fp32_island
 def robust_compute_rotation_matrix_from_ortho6d(poses):
     """
     Instead of making 2nd vector orthogonal to first
@@ -0,0 +1,86 @@
+import os
+from typing import Callable, Union
+import numpy as np
+import torch
+import torch.nn as nn
+from loguru import logger
+
+
+def bytes_per_grasp(evaluator: nn.Module) -> int:
+    """ Rough float32 activation memory of scoring one grasp with DexEvaluator, used to size the chunks
+
+    Args:
+        evaluator: DexEvaluator
+
+    Return:
+        Bytes per grasp
+    """
+    n = evaluator.n_neurons
+    ## from the sizes of the evaluator, the layers may be quantized wrappers without in_features
+    if evaluator.can_split_bps():
+        ## only the grasp columns are per grasp, plus the gathered (fc1, fc3) BPS products of the three blocks
+        width = evaluator.grasp_dim + 6 * n
+    else:
+        width = evaluator.in_bps + evaluator.grasp_dim
+    ## the input, the inputs [X, X0] of rb2 and rb3, and about 8 hidden activations per block
+    return 4 * (width + 2 * (width + n) + 3 * 8 * n)
+
+@torch.no_grad()
+def score_grasps(evaluator: nn.Module, grasps: Union[np.ndarray, torch.Tensor], obj_bps_index: Union[np.ndarray, torch.Tensor],
+                 object_ids: Union[np.ndarray, torch.Tensor], max_mem: int=2 ** 30, output: str=None,
+                 transform: Callable=None) -> np.ndarray:
+    """ Score a large set of grasps with the evaluator in chunks that fit a memory budget
+
+    Every grasp only carries the index of its object BPS, the 4096-wide BPS are looked up once per
+    object of a chunk. Unless the evaluator is quantized, only their products with the first layers,
+    see `DexEvaluator.bps_features`, are gathered per grasp.
+
+    Args:
+        evaluator: DexEvaluator in eval mode
+        grasps: grasps, <N, d_x>, on CPU, e.g., a memory-mapped array
+        obj_bps_index: BPS of the objects, <M, in_bps>
+        object_ids: index in obj_bps_index of the object of every grasp, <N>
+        max_mem: activation memory budget of one chunk in bytes
+        output: stream the scores to this .npy file, None keeps them in memory
+        transform: applied to every chunk of grasps on the evaluator device before scoring, e.g., the normalization
+
+    Return:
+        Success probability of every grasp, <N>, memory-mapped from `output` if given
+    """
+    N = len(grasps)
+    chunk = max(1, int(max_mem // bytes_per_grasp(evaluator)))
+    device = evaluator.device
+    ## the grasps of an object share its BPS products, whatever the `split_bps` mode of the evaluator
+    split = evaluator.can_split_bps()
+    obj_bps_index = torch.as_tensor(obj_bps_index, dtype=torch.float32)
+    object_ids = torch.as_tensor(object_ids, dtype=torch.long).cpu()
+
+    if output is None:
+        scores = np.empty(N, dtype=np.float32)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        scores = np.lib.format.open_memmap(output, mode='w+', dtype=np.float32, shape=(N, ))
+
+    for start in range(0, N, chunk):
+        end = min(start + chunk, N)
+        x_t = torch.as_tensor(grasps[start:end], dtype=torch.float32).to(device)
+        if transform is not None:
+            x_t = transform(x_t)
+
+        ids, inverse = torch.unique(object_ids[start:end], return_inverse=True)
+        obj_bps = obj_bps_index[ids].to(device)
+        inverse = inverse.to(device)
+        if split:
+            ## BPS products of the objects of the chunk, a single object broadcasts to the chunk
+            bps_feat = evaluator.bps_features(obj_bps)
+            if ids.shape[0] > 1:
+                bps_feat = [tuple(f[inverse] for f in feat) for feat in bps_feat]
+            data = {'x_t': x_t, 'obj_bps_feat': bps_feat}
+        else:
+            data = {'x_t': x_t, 'obj_bps': obj_bps[inverse]}
+        scores[start:end] = evaluator(data)['p_success'][:, 0].float().cpu().numpy()
+
+    if output is not None:
+        scores.flush()
+        logger.info(f'Saved the scores of {N} grasps to {output}')
+    return scores
@@ -1,5 +1,7 @@
 import torch
 import os
+import contextlib
+import functools
 from loguru import logger
 
 def load_ckpt(model: torch.nn.Module, path: str) -> None:
@@ -10,10 +12,11 @@ def load_ckpt(model: torch.nn.Module, path: str) -> None:
         path: save path
     """
     assert os.path.exists(path), 'Can\'t find provided ckpt.'
+    ## loaded on CPU first, so that ckpts trained on GPU can be loaded on CPU-only nodes
     if path.split('.')[-1] == 'pth':
-        saved_state_dict = torch.load(path)['model']
+        saved_state_dict = torch.load(path, map_location='cpu')['model']
     else:
-        saved_state_dict = torch.load(path)['ffhevaluator_state_dict']
+        saved_state_dict = torch.load(path, map_location='cpu')['ffhevaluator_state_dict']
     model_state_dict = model.state_dict()
     total = 0
     
@@ -58,4 +61,36 @@ def save_ckpt(model: torch.nn.Module, epoch: int, step: int, path: str, save_sce
     torch.save({
         'model': saved_state_dict,
         'epoch': epoch, 'step': step,
-    }, path)
\ No newline at end of file
+    }, path)
+
+def autocast(device, amp_dtype: str=None):
+    """ Autocast context of the mixed-precision mode, a no-op in float32
+
+    Args:
+        device: device of the models, e.g., 'cpu' or 'cuda:0'
+        amp_dtype: None for float32, or 'bf16'
+    """
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    if amp_dtype not in ['bf16', 'bfloat16']:
+        raise Exception('Unsupported amp dtype.')
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+@contextlib.contextmanager
+def no_autocast():
+    """ Disable autocast on both CPU and CUDA
+    """
+    with torch.autocast('cpu', enabled=False), torch.autocast('cuda', enabled=False):
+        yield
+
+def fp32_island(fn):
+    """ Run fn in float32 inside an autocast region, floating point tensor arguments are cast to float32
+    """
+    def to_fp32(x):
+        return x.float() if torch.is_tensor(x) and torch.is_floating_point(x) else x
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with no_autocast():
+            return fn(*[to_fp32(a) for a in args], **{k: to_fp32(v) for k, v in kwargs.items()})
+    return wrapper